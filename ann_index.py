@@ -0,0 +1,492 @@
+import os, re, sqlite3, threading
+from contextlib import contextmanager
+from typing import Iterator, Optional, Sequence
+import numpy as np
+from embedding_codec import decode_embeddings
+
+TRAIN_MIN = 16_384  #         below this every query is an exact scan
+TRAIN_SAMPLE = 50_000  #      vectors k-means is fitted on
+RETRAIN_GROWTH = 4  #         retrain once the index is this many times its trained size
+REBUILD_FRACTION = 4  #       rewrite the lists once 1/4 as many rows are new or dead
+NPROBE = 8  #                 lists scanned per query
+KMEANS_ITERATIONS = 10
+ASSIGN_CHUNK = 16_384
+SYNC_BATCH = 1_000
+# the layout before the lists were stored grouped, rebuilt from the db by sync
+OLD_FILES = ["meta.json", "centroids.npy", "vectors.f32", "lists.i32", "keys.txt"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+CREATE TABLE IF NOT EXISTS rows (
+    position INTEGER PRIMARY KEY, url TEXT NOT NULL, list INTEGER NOT NULL, live INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rows_live_url ON rows (url) WHERE live = 1;
+CREATE INDEX IF NOT EXISTS rows_dead ON rows (position) WHERE live = 0;
+"""
+META = {
+    "dim": 0,
+    "nlist": 1,
+    "trained_count": 0,
+    "generation": 0,
+    "built": 0,  #       rows before this are in the grouped files, the rest in the tail
+    "count": 0,  #       rows ever added, the next row's position
+    "live": 0,
+    "dead": 0,  #        rows killed since the last rewrite
+    "writes": 0,
+    "synced_seq": -1,  # papers.write_seq sync has caught up to, -1 before the first sync
+}
+
+
+# an IVF index over papers.embedding, kept in a directory next to the db:
+#   index.db             every row added: its url, its list and whether it's live, and the
+#                        meta. sqlite, so writers in several processes take turns
+#   ivf.<gen>.f32        normalized vectors grouped by list, each list contiguous. a query
+#                        memory maps it and only reads the lists it probes
+#   ids.<gen>.i64        the row of each of those vectors
+#   offsets.<gen>.i64    where each list starts in them, nlist + 1 entries
+#   slots.<gen>.i64      where each row is in them, -1 for rows dead when they were written
+#   tail.<gen>.f32       vectors of rows added since, in row order, append only
+#   centroids.<gen>.npy  (nlist, dim) float32, only once trained
+# a url added again (a replaced paper) kills its older row, dead rows are dropped the next
+# time the lists are rewritten. every rewrite is a new generation, the files of the
+# previous one are removed once the new one is committed
+class AnnIndex:
+    def __init__(self, path: str, nprobe: int = NPROBE):
+        self.path = path
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        _remove([self._file(name) for name in OLD_FILES])
+
+        self._conn = sqlite3.connect(
+            self._file("index.db"), timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.executemany("INSERT OR IGNORE INTO meta VALUES (?, ?)", META.items())
+        self.meta = self._read_meta()
+        self.centroids: Optional[np.ndarray] = None
+
+        # the generation that's memory mapped, and what refresh() read of its rows
+        self._generation: Optional[int] = None
+        self._layout: Optional[_Layout] = None
+        self._writes: Optional[int] = None
+        self._tail_lists = np.zeros(0, np.int32)
+        self._dead = np.zeros(0, bool)
+
+    @classmethod
+    def for_db(cls, db_name: str, **kwargs) -> "AnnIndex":
+        return cls(os.path.splitext(db_name)[0] + ".ann", **kwargs)
+
+    @property
+    def dim(self) -> int:
+        return self.meta["dim"]
+
+    @property
+    def nlist(self) -> int:
+        return self.meta["nlist"]
+
+    def __len__(self) -> int:
+        with self._lock:
+            self.meta = self._read_meta()
+        return self.meta["live"]
+
+    def close(self):
+        self._conn.close()
+
+    def add(self, keys: Sequence[str], vectors: np.ndarray):
+        # before the reshape, an empty batch can't be reshaped to (0, -1)
+        if not len(keys):
+            return
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(keys), -1))
+        # the last vector of a key that's in the batch twice wins
+        last = {key: i for i, key in enumerate(keys)}
+        keys, vectors = list(last), vectors[list(last.values())]
+
+        with self._writing() as meta:
+            if meta["dim"] == 0:
+                meta["dim"] = vectors.shape[1]
+                self._load(meta, reload=True)
+            elif vectors.shape[1] != meta["dim"]:
+                raise ValueError(
+                    f"expected {meta['dim']} dimensional vectors, got {vectors.shape[1]}"
+                )
+
+            # bytes past the committed rows are from a write that was rolled back
+            tail, tail_rows = self._layout.tail_path, meta["count"] - meta["built"]
+            if os.path.exists(tail) and os.path.getsize(tail) > tail_rows * meta["dim"] * 4:
+                with open(tail, "r+b") as f:
+                    f.truncate(tail_rows * meta["dim"] * 4)
+            with open(tail, "ab") as f:
+                f.write(vectors.tobytes())
+
+            killed = self._kill(keys)
+            positions = range(meta["count"], meta["count"] + len(keys))
+            lists = self._assign(vectors).tolist()
+            self._conn.executemany(
+                "INSERT INTO rows (position, url, list, live) VALUES (?, ?, ?, 1)",
+                zip(positions, keys, lists),
+            )
+            meta.update(
+                count=positions.stop,
+                live=meta["live"] + len(keys) - killed,
+                dead=meta["dead"] + killed,
+            )
+            self._layout.map_tail(meta["count"] - meta["built"])
+            self._maybe_rebuild(meta)
+
+    def remove(self, keys: Sequence[str]):
+        if not len(keys):
+            return
+        with self._writing() as meta:
+            killed = self._kill(keys)
+            meta.update(live=meta["live"] - killed, dead=meta["dead"] + killed)
+
+    def add_blobs(self, keys: Sequence[str], blobs: Sequence[bytes]):
+        # an empty or unreadable embedding takes the key out of the index
+        vectors, valid = decode_embeddings(blobs, self.dim or None)
+        self.add([key for key, ok in zip(keys, valid) if ok], vectors[valid])
+        self.remove([key for key, ok in zip(keys, valid) if not ok])
+
+    def sync(self, db_name: str) -> int:
+        # catches up with papers written since the last sync, all of them the first time,
+        # e.g. rows written before the index existed or while it was failing. returns how
+        # many keys were added, changed or removed
+        with self._lock:
+            synced = self._read_meta()["synced_seq"]
+        conn = sqlite3.connect(db_name)
+        try:
+            high = conn.execute("SELECT COALESCE(MAX(write_seq), 0) FROM papers").fetchone()[0]
+            if synced < 0:
+                cursor = conn.execute("SELECT url, embedding FROM papers")
+            else:
+                cursor = conn.execute(
+                    "SELECT url, embedding FROM papers WHERE write_seq > ?", (synced,)
+                )
+            changed = 0
+            while rows := cursor.fetchmany(SYNC_BATCH):
+                changed += self._sync_rows([url for url, _ in rows], [blob for _, blob in rows])
+        finally:
+            conn.close()
+        if high > synced:
+            with self._writing() as meta:
+                meta["synced_seq"] = max(meta["synced_seq"], high)
+        return changed
+
+    def _sync_rows(self, urls: list[str], blobs: list[bytes]) -> int:
+        vectors, valid = decode_embeddings(blobs, self.dim or None)
+        vectors = _normalize(vectors)
+        with self._lock, self._reading():
+            stored = self._positions(urls)
+            current = self._layout.read([stored[url] for url in urls if url in stored])
+        current = dict(zip([url for url in urls if url in stored], current))
+
+        added = [
+            i
+            for i, url in enumerate(urls)
+            if valid[i] and (url not in current or not np.allclose(current[url], vectors[i]))
+        ]
+        removed = [url for i, url in enumerate(urls) if not valid[i] and url in current]
+        self.add([urls[i] for i in added], vectors[added])
+        self.remove(removed)
+        return len(added) + len(removed)
+
+    def search(
+        self, vector: Sequence[float], k: int = 10, nprobe: Optional[int] = None
+    ) -> list[tuple[str, float]]:
+        # cosine similarity, highest first
+        with self._lock, self._reading() as meta:
+            if not meta["live"]:
+                return []
+            layout = self._layout
+            query = _normalize(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0]
+            probes = np.array([0])
+            if self.centroids is not None:
+                nprobe = min(nprobe or self.nprobe, len(self.centroids))
+                probes = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+
+            # only the probed lists are read from the grouped file, and the tail rows in them
+            tail = np.flatnonzero(np.isin(self._tail_lists, probes))
+            spans = [(layout.offsets[i], layout.offsets[i + 1]) for i in probes]
+            ids = np.concatenate([layout.ids[lo:hi] for lo, hi in spans] + [layout.built + tail])
+            scores = np.concatenate(
+                [layout.vectors[lo:hi] @ query for lo, hi in spans] + [layout.tail[tail] @ query]
+            )
+            scores[self._dead[ids]] = -np.inf
+
+            k = min(k, int(np.isfinite(scores).sum()))
+            if k == 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            urls = self._urls(ids[top].tolist())
+            return [(urls[ids[i]], float(scores[i])) for i in top]
+
+    def similar_to(
+        self, key: str, k: int = 10, nprobe: Optional[int] = None
+    ) -> list[tuple[str, float]]:
+        vector = self.vector(key)
+        if vector is None:
+            raise KeyError(key)
+        return [hit for hit in self.search(vector, k + 1, nprobe) if hit[0] != key][:k]
+
+    def vector(self, key: str) -> Optional[np.ndarray]:
+        with self._lock, self._reading():
+            position = self._positions([key]).get(key)
+            if position is None:
+                return None
+            return self._layout.read([position])[0]
+
+    def refresh(self):
+        # maps the current generation and reads which rows were added or killed since
+        with self._lock, self._reading():
+            pass
+
+    @contextmanager
+    def _reading(self) -> Iterator[dict]:
+        # a read transaction, with the generation it sees loaded
+        for attempt in range(3):
+            self._conn.execute("BEGIN")
+            try:
+                meta = self._read_meta()
+                self._load(meta)
+            except FileNotFoundError:
+                # rewritten and removed by another process since
+                self._conn.execute("ROLLBACK")
+                if attempt == 2:
+                    raise
+                continue
+            try:
+                if meta["writes"] != self._writes:
+                    self._read_rows(meta)
+                yield meta
+            finally:
+                self._conn.execute("COMMIT")
+            return
+
+    @contextmanager
+    def _writing(self) -> Iterator[dict]:
+        # the meta yielded is written back on commit
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                meta = self._read_meta()
+                self._load(meta)
+                generation = meta["generation"]
+                yield meta
+                meta["writes"] += 1
+                self._conn.executemany(
+                    "UPDATE meta SET value = ? WHERE name = ?",
+                    [(value, name) for name, value in meta.items()],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                # a rewrite that was rolled back may be loaded
+                self._generation = None
+                raise
+            self.meta = meta
+            if meta["generation"] != generation:
+                self._remove_generations(meta["generation"])
+
+    def _load(self, meta: dict, reload: bool = False):
+        if reload or meta["generation"] != self._generation:
+            self._layout = _Layout(self.path, meta)
+            self.centroids = None
+            if meta["trained_count"]:
+                self.centroids = np.load(self._file(f"centroids.{meta['generation']}.npy"))
+            self._generation = meta["generation"]
+            self._writes = None
+            self._tail_lists = np.zeros(0, np.int32)
+        self._layout.map_tail(meta["count"] - meta["built"])
+        self.meta = meta
+
+    def _read_rows(self, meta: dict):
+        # tail rows are never deleted before a rewrite, so only the new ones are read
+        start = meta["built"] + len(self._tail_lists)
+        lists = self._conn.execute(
+            "SELECT list FROM rows WHERE position >= ? ORDER BY position", (start,)
+        ).fetchall()
+        self._tail_lists = np.concatenate(
+            [self._tail_lists, np.array([row[0] for row in lists], np.int32)]
+        )
+        self._dead = np.zeros(meta["count"], bool)
+        self._dead[
+            [row[0] for row in self._conn.execute("SELECT position FROM rows WHERE live = 0")]
+        ] = True
+        self._writes = meta["writes"]
+
+    def _kill(self, keys: Sequence[str]) -> int:
+        killed = 0
+        for start in range(0, len(keys), SYNC_BATCH):
+            batch = keys[start : start + SYNC_BATCH]
+            killed += self._conn.execute(
+                f"UPDATE rows SET live = 0 WHERE live = 1 AND url IN ({', '.join('?' * len(batch))})",
+                batch,
+            ).rowcount
+        return killed
+
+    def _positions(self, urls: Sequence[str]) -> dict[str, int]:
+        positions = {}
+        for start in range(0, len(urls), SYNC_BATCH):
+            batch = urls[start : start + SYNC_BATCH]
+            positions.update(
+                self._conn.execute(
+                    "SELECT url, position FROM rows"
+                    f" WHERE live = 1 AND url IN ({', '.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+        return positions
+
+    def _urls(self, positions: Sequence[int]) -> dict[int, str]:
+        return dict(
+            self._conn.execute(
+                f"SELECT position, url FROM rows WHERE position IN ({', '.join('?' * len(positions))})",
+                positions,
+            )
+        )
+
+    def _maybe_rebuild(self, meta: dict):
+        live, trained = meta["live"], meta["trained_count"]
+        if (not trained and live >= TRAIN_MIN) or (trained and live >= trained * RETRAIN_GROWTH):
+            self._rebuild(meta, retrain=True)
+        elif trained and meta["count"] - meta["built"] + meta["dead"] > live // REBUILD_FRACTION:
+            self._rebuild(meta, retrain=False)
+
+    def _rebuild(self, meta: dict, retrain: bool):
+        # writes the live rows grouped by list as the next generation, retraining first
+        rows = np.array(
+            self._conn.execute(
+                "SELECT position, list FROM rows WHERE live = 1 ORDER BY position"
+            ).fetchall(),
+            np.int64,
+        ).reshape(-1, 2)
+        positions, lists = rows[:, 0], rows[:, 1]
+        centroids = self.centroids
+        if retrain:
+            # spherical k-means on a sample, then every live vector is reassigned
+            nlist = int(np.clip(2 * np.sqrt(len(positions)), 1, 4096))
+            rng = np.random.default_rng(0)
+            sample = rng.choice(positions, min(len(positions), TRAIN_SAMPLE), replace=False)
+            centroids = _kmeans(self._layout.read(np.sort(sample)), nlist, rng)
+            lists = np.concatenate(
+                [np.zeros(0, np.int64)]
+                + [
+                    _nearest(self._layout.read(positions[i : i + ASSIGN_CHUNK]), centroids)
+                    for i in range(0, len(positions), ASSIGN_CHUNK)
+                ]
+            )
+            self._conn.executemany(
+                "UPDATE rows SET list = ? WHERE position = ?",
+                zip(lists.tolist(), positions.tolist()),
+            )
+            meta.update(nlist=nlist, trained_count=len(positions))
+
+        generation = meta["generation"] + 1
+        order = np.argsort(lists, kind="stable")
+        grouped = positions[order]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=meta["nlist"]))])
+        slots = np.full(meta["count"], -1, np.int64)
+        slots[grouped] = np.arange(len(grouped))
+
+        with open(self._file(f"ivf.{generation}.f32"), "wb") as f:
+            for i in range(0, len(grouped), ASSIGN_CHUNK):
+                f.write(self._layout.read(grouped[i : i + ASSIGN_CHUNK]).tobytes())
+        grouped.astype(np.int64).tofile(self._file(f"ids.{generation}.i64"))
+        offsets.astype(np.int64).tofile(self._file(f"offsets.{generation}.i64"))
+        slots.tofile(self._file(f"slots.{generation}.i64"))
+        open(self._file(f"tail.{generation}.f32"), "wb").close()
+        np.save(self._file(f"centroids.{generation}.npy"), centroids)
+
+        self._conn.execute("DELETE FROM rows WHERE live = 0")
+        meta.update(generation=generation, built=meta["count"], dead=0)
+        self._load(meta)
+
+    def _remove_generations(self, current: int):
+        for name in os.listdir(self.path):
+            match = re.fullmatch(r"\w+\.(\d+)\.\w+", name)
+            if match and int(match[1]) < current:
+                _remove([self._file(name)])
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        if self.centroids is None:
+            return np.zeros(len(vectors), dtype=np.int32)
+        return _nearest(vectors, self.centroids)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read_meta(self) -> dict:
+        return dict(self._conn.execute("SELECT name, value FROM meta"))
+
+
+class _Layout:
+    # the files of one generation, memory mapped
+    def __init__(self, path: str, meta: dict):
+        generation, self.dim, self.built = meta["generation"], meta["dim"], meta["built"]
+        self.tail_path = os.path.join(path, f"tail.{generation}.f32")
+        file = lambda name: os.path.join(path, f"{name}.{generation}")
+        self.vectors = np.zeros((0, self.dim), np.float32)
+        self.ids = self.slots = np.zeros(0, np.int64)
+        self.offsets = np.zeros(meta["nlist"] + 1, np.int64)
+        if self.built:
+            self.vectors = _map(file("ivf") + ".f32", np.float32).reshape(-1, self.dim)
+            self.ids = _map(file("ids") + ".i64", np.int64)
+            self.slots = _map(file("slots") + ".i64", np.int64)
+            self.offsets = np.fromfile(file("offsets") + ".i64", np.int64)
+        self.tail = np.zeros((0, self.dim), np.float32)
+
+    def map_tail(self, rows: int):
+        # the tail only grows within a generation, bytes past the committed rows are ignored
+        if rows != len(self.tail):
+            self.tail = _map(self.tail_path, np.float32, rows * self.dim).reshape(rows, self.dim)
+
+    def read(self, positions: Sequence[int]) -> np.ndarray:
+        # vectors of live rows by position
+        positions = np.asarray(positions, np.int64)
+        vectors = np.empty((len(positions), self.dim), np.float32)
+        built = positions < self.built
+        vectors[built] = self.vectors[self.slots[positions[built]]]
+        vectors[~built] = self.tail[positions[~built] - self.built]
+        return vectors
+
+
+def _map(path: str, dtype, count: int = -1) -> np.ndarray:
+    # an empty file can't be memory mapped. a missing one raises, it was rewritten since
+    if count == 0 or (count < 0 and not os.path.getsize(path)):
+        return np.zeros(0, dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=None if count < 0 else (count,))
+
+
+def _remove(paths: list[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+
+def _kmeans(sample: np.ndarray, nlist: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = _nearest(sample, centroids)
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=nlist)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        centroids[filled] = np.add.reduceat(sample[order], starts, axis=0)
+        # empty lists are reseeded from random vectors
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        centroids = _normalize(centroids)
+    return centroids
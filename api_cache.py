@@ -0,0 +1,119 @@
+import hashlib, json, logging, sqlite3, threading, time
+from typing import Optional
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024  #    ~2GB
+TOUCH_BATCH = 1000  #                            hits whose last_used is written in one commit
+
+
+# content addressed, so the same pdf under a mirror url or a rebuilt papers.db
+# hits the cache. kept in its own file so it survives wiping the papers db
+class ApiCache:
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # last_used of recent hits, written with the next put or every TOUCH_BATCH hits,
+        # so a hit is a read and never waits on a commit
+        self._touched: dict[str, float] = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB,
+                size INTEGER,
+                last_used FLOAT
+            )
+        """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        self._conn.commit()
+        self.total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_BATCH:
+                self._write_touches()
+                self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, value: bytes):
+        self.put_many([(key, value)])
+
+    def put_many(self, items: list[tuple[str, bytes]]):
+        # one transaction, a request's worth of embeddings is one commit rather than one each
+        if not items:
+            return
+        with self._lock:
+            now = time.time()
+            for key, value in items:
+                old = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                    (key, value, len(value), now),
+                )
+                self.total_bytes += len(value) - (old[0] if old else 0)
+            # eviction goes by last_used, it needs to see the recent hits
+            self._write_touches()
+            self._evict()
+            self._conn.commit()
+
+    def _write_touches(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE cache SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._touched.items()],
+            )
+            self._touched = {}
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM cache ORDER BY last_used LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.evictions += 1
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        print(
+            f"api cache: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['evictions']} evictions, {stats['bytes'] / 1024 / 1024:.1f}MB"
+        )
+        logging.info(f"api cache stats {stats}")
+
+    def close(self):
+        with self._lock:
+            self._write_touches()
+            self._conn.commit()
+            self._conn.close()
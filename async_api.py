@@ -0,0 +1,210 @@
+import asyncio, logging, random, re, threading, time
+from typing import Any, Awaitable, Callable, Optional
+from openai import APIConnectionError, APIStatusError, APITimeoutError, AsyncOpenAI
+from metrics import RETRIES, STAGE_SECONDS, count_usage
+
+MAX_IN_FLIGHT = 8
+MAX_ATTEMPTS = 6
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+EXTRACT_COMPLETION_TOKENS = 1024  #     counted against the token limit with each prompt
+
+
+class TokenBucket:
+    # filled from the api's rate limit headers, unlimited until the first response
+    def __init__(self):
+        self.capacity: Optional[float] = None
+        self.available = 0.0
+        self.rate = 0.0
+        self.updated = time.monotonic()
+
+    def wait_time(self, cost: float) -> float:
+        if self.capacity is None:
+            return 0.0
+        self._refill()
+        cost = min(cost, self.capacity)
+        if self.available >= cost or self.rate <= 0:
+            return 0.0
+        return (cost - self.available) / self.rate
+
+    def take(self, cost: float):
+        if self.capacity is not None:
+            self.available -= cost
+
+    def update(self, limit: Optional[str], remaining: Optional[str], reset: Optional[str]):
+        if limit is None or remaining is None:
+            return
+        capacity, available = float(limit), float(remaining)
+        seconds = parse_duration(reset) if reset else 0.0
+        # time until the bucket is full again, or the usual per minute window
+        if seconds > 0 and capacity > available:
+            self.rate = (capacity - available) / seconds
+        else:
+            self.rate = capacity / 60
+        self.capacity, self.available = capacity, available
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    def __init__(self):
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+
+    async def acquire(self, tokens: int):
+        while True:
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait <= 0:
+                self.requests.take(1)
+                self.tokens.take(tokens)
+                return
+            await asyncio.sleep(wait)
+
+    def update(self, headers):
+        self.requests.update(
+            headers.get("x-ratelimit-limit-requests"),
+            headers.get("x-ratelimit-remaining-requests"),
+            headers.get("x-ratelimit-reset-requests"),
+        )
+        self.tokens.update(
+            headers.get("x-ratelimit-limit-tokens"),
+            headers.get("x-ratelimit-remaining-tokens"),
+            headers.get("x-ratelimit-reset-tokens"),
+        )
+
+
+# openai calls on AsyncOpenAI, run on an event loop in its own thread so the threaded
+# pipeline can hand it a batch and block on the result. at most `max_in_flight` calls are
+# open at once, new ones wait on the rate limit headers, and a call told to come back later
+# sleeps without holding its slot
+class AsyncApi:
+    def __init__(
+        self,
+        client: Optional[AsyncOpenAI] = None,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        # retries are ours, the client's own would sleep while holding a slot
+        self.client = (client or AsyncOpenAI()).with_options(max_retries=0)
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.limiter = RateLimiter()
+        self.requests_sent = 0
+        self.retries = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+
+    def run(self, coro: Awaitable) -> Any:
+        # blocks the calling thread until `coro` is done on the api loop
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop()).result()
+
+    def gather(self, coros: list[Awaitable]) -> list:
+        async def gather_all():
+            return await asyncio.gather(*coros)
+
+        return self.run(gather_all())
+
+    async def embed(self, model: str, texts: list[str], tokens: int) -> list[list[float]]:
+        with STAGE_SECONDS.time(stage="embed"):
+            response = await self._call(
+                "embeddings",
+                lambda: self.client.embeddings.with_raw_response.create(model=model, input=texts),
+                tokens,
+            )
+        data = sorted(response.data, key=lambda d: d.index)
+        if len(data) != len(texts):
+            raise ValueError(f"expected {len(texts)} embeddings, got {len(data)}")
+        return [d.embedding for d in data]
+
+    async def chat_function_call(self, model: str, content: str, functions: list) -> str:
+        response = await self._call(
+            "chat",
+            lambda: self.client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=[{"role": "user", "content": content}],
+                functions=functions,
+                function_call={"name": functions[0]["name"]},
+            ),
+            len(content) // 4 + EXTRACT_COMPLETION_TOKENS,
+        )
+        return response.choices[0].message.function_call.arguments
+
+    async def _call(self, endpoint: str, request: Callable[[], Awaitable], tokens: int) -> Any:
+        for attempt in range(1, self.max_attempts + 1):
+            await self.limiter.acquire(tokens)
+            async with self._semaphore:
+                try:
+                    self.requests_sent += 1
+                    raw = await request()
+                    self.limiter.update(raw.headers)
+                    response = raw.parse()
+                    count_usage(endpoint, response)
+                    return response
+                except APIStatusError as e:
+                    self.limiter.update(e.response.headers)
+                    if e.status_code not in RETRY_STATUSES or attempt == self.max_attempts:
+                        raise
+                    delay = retry_after(e.response.headers) or backoff(attempt)
+                except (APIConnectionError, APITimeoutError):
+                    if attempt == self.max_attempts:
+                        raise
+                    delay = backoff(attempt)
+
+            # outside the semaphore, other calls go ahead while this one waits
+            self.retries += 1
+            RETRIES.inc(kind=endpoint)
+            logging.info(f"openai call failed, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="openai-loop", daemon=True).start()
+                self._semaphore = asyncio.run_coroutine_threadsafe(
+                    _make_semaphore(self.max_in_flight), loop
+                ).result()
+                self._loop = loop
+            return self._loop
+
+    def close(self):
+        with self._lock:
+            if self._loop is not None:
+                asyncio.run_coroutine_threadsafe(self.client.close(), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+
+
+async def _make_semaphore(size: int) -> asyncio.Semaphore:
+    return asyncio.Semaphore(size)
+
+
+def retry_after(headers) -> Optional[float]:
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            # an http date, not worth parsing, fall back to backoff
+            pass
+    return None
+
+
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(30, 2**attempt))
+
+
+def parse_duration(value: str) -> float:
+    # the reset headers look like "1s", "6m0s" or "20ms"
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(
+        float(amount) * units[unit] for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value)
+    )
@@ -0,0 +1,501 @@
+import argparse, json, logging, multiprocessing, os, platform, random, resource, shutil, sys
+import tempfile, threading, time, zlib
+from base64 import b64encode
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Iterator
+import numpy as np
+
+# benchmarks of the ingest and read paths on a synthetic library. the vault, the pdfs and
+# openai are all local, so numbers compare between runs on the same machine, not to prod.
+#   python bench.py --sizes 1000 10000 100000 --save-baseline
+#   python bench.py --sizes 1000 --fail-on-regression
+
+BASELINE_PATH = "bench_baseline.json"
+REGRESSION_THRESHOLD = 0.2  #       fraction a stage can get slower or bigger before it's flagged
+SAMPLE_CALLS = 200  #               calls timed one by one for latency percentiles
+PDF_TEMPLATES = 32  #               distinct pdfs, every paper is one of them with its own bytes
+PAGE_COUNTS = [1, 2, 4, 8, 16, 32]
+LINKS_PER_NOTE = 5
+EMBEDDING_DIM = 1536
+WORDS = (
+    "attention transformer embedding gradient sparse latent diffusion protein graph "
+    "kernel bayesian inference retrieval language vision policy reward convolution "
+    "manifold spectral entropy variational contrastive causal quantum lattice ablation"
+).split()
+
+
+def make_pdf_templates(count: int = PDF_TEMPLATES, seed: int = 0) -> list[bytes]:
+    import fitz
+
+    rng = random.Random(seed)
+    templates = []
+    for i in range(count):
+        doc = fitz.open()
+        for page_number in range(PAGE_COUNTS[i % len(PAGE_COUNTS)]):
+            page = doc.new_page()
+            if page_number == 0:
+                page.insert_text((72, 72), f"Synthetic Paper {i}", fontsize=18)
+            words = " ".join(rng.choice(WORDS) for _ in range(400))
+            page.insert_textbox(fitz.Rect(72, 100, 540, 760), words, fontsize=9)
+        templates.append(doc.tobytes(garbage=3, deflate=True))
+        doc.close()
+    return templates
+
+
+def paper_pdf(templates: list[bytes], paper_id: int) -> bytes:
+    # bytes after %%EOF are ignored by readers, so each paper hashes to its own blob
+    return templates[paper_id % len(templates)] + f"\n%paperweight-bench {paper_id}\n".encode()
+
+
+def paper_url(base_url: str, paper_id: int) -> str:
+    return f"{base_url}/papers/{paper_id}.pdf"
+
+
+def make_vault(directory: str, papers: int, base_url: str, links_per_note: int = LINKS_PER_NOTE):
+    os.makedirs(directory, exist_ok=True)
+    for note in range((papers + links_per_note - 1) // links_per_note):
+        ids = range(note * links_per_note, min(papers, (note + 1) * links_per_note))
+        lines = [f"# note {note}", ""] + [f"- read {paper_url(base_url, i)} later" for i in ids]
+        # a few subfolders, like a real vault
+        folder = os.path.join(directory, f"folder_{note % 16}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"note_{note}.md"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+class CorpusHandler(BaseHTTPRequestHandler):
+    templates: list[bytes] = []
+    # every nth paper is a 404, for the failure path
+    missing_every = 0
+    latency = 0.0
+
+    def do_GET(self):
+        name = self.path.rsplit("/", 1)[-1]
+        if not name.endswith(".pdf") or not name[:-4].isdigit():
+            self.send_error(404)
+            return
+        paper_id = int(name[:-4])
+        if self.missing_every and paper_id % self.missing_every == self.missing_every - 1:
+            self.send_error(404)
+            return
+
+        time.sleep(self.latency)
+        body = paper_pdf(self.templates, paper_id)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", f'"{paper_id}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    # answers the two endpoints paperweight calls after `latency` seconds, with rate limit
+    # headers that never run out
+    latency = 0.0
+    dim = EMBEDDING_DIM
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        time.sleep(self.latency)
+        if self.path.endswith("/embeddings"):
+            body = self.embeddings(request)
+        elif self.path.endswith("/chat/completions"):
+            body = self.chat(request)
+        else:
+            self.send_error(404)
+            return
+
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for kind in ["requests", "tokens"]:
+            self.send_header(f"x-ratelimit-limit-{kind}", "100000000")
+            self.send_header(f"x-ratelimit-remaining-{kind}", "100000000")
+            self.send_header(f"x-ratelimit-reset-{kind}", "1s")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def embeddings(self, request: dict) -> dict:
+        inputs = request["input"]
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        data = []
+        for i, text in enumerate(inputs):
+            # the same input always gets the same vector
+            seed = zlib.crc32(json.dumps(text).encode("utf-8"))
+            vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+            vector /= np.linalg.norm(vector)
+            if request.get("encoding_format") == "base64":
+                embedding = b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(str(text)) // 4 for text in inputs)
+        return {
+            "object": "list",
+            "data": data,
+            "model": request.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def chat(self, request: dict) -> dict:
+        content = request["messages"][-1]["content"]
+        words = content.split()
+        arguments = {
+            "title": " ".join(words[:6]),
+            "authors": ["A. Author", "B. Author"],
+            "keywords": sorted(set(words[6:30]))[:5],
+            "abstract": " ".join(words[6:80]),
+            "summary": " ".join(words[80:120]),
+        }
+        return {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "function_call",
+                    "message": {
+                        "role": "assistant",
+                        "content": None,
+                        "function_call": {"name": "find_data", "arguments": json.dumps(arguments)},
+                    },
+                }
+            ],
+            "usage": {"prompt_tokens": len(words), "completion_tokens": 100, "total_tokens": 0},
+        }
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(conn, pdf_latency: float, api_latency: float, missing_every: int, dim: int):
+    # runs in its own process, so serving doesn't count towards the benchmark's cpu or rss
+    CorpusHandler.templates = make_pdf_templates()
+    CorpusHandler.latency = pdf_latency
+    CorpusHandler.missing_every = missing_every
+    StubOpenAIHandler.latency = api_latency
+    StubOpenAIHandler.dim = dim
+    corpus = ThreadingHTTPServer(("127.0.0.1", 0), CorpusHandler)
+    api = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAIHandler)
+    for server in [corpus, api]:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.send((corpus.server_address[1], api.server_address[1]))
+    # until the benchmark is done
+    conn.recv()
+
+
+@contextmanager
+def servers(args) -> Iterator[tuple[str, str]]:
+    context = multiprocessing.get_context("spawn")
+    parent, child = context.Pipe()
+    process = context.Process(
+        target=serve,
+        args=(child, args.pdf_latency, args.api_latency, args.missing_every, EMBEDDING_DIM),
+        daemon=True,
+    )
+    process.start()
+    try:
+        corpus_port, api_port = parent.recv()
+        yield f"http://127.0.0.1:{corpus_port}", f"http://127.0.0.1:{api_port}/v1"
+    finally:
+        parent.send(None)
+        process.join(timeout=5)
+        if process.is_alive():
+            process.kill()
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        # the peak since the process started, kilobytes on linux and bytes on macos
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class PeakRss:
+    # samples this process's rss in the background, the peak over the block is the stage's
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.peak = rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_mb())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+
+def summarize(latencies: list[float], count: int, seconds: float, peak_rss: float) -> dict:
+    result = {
+        "count": count,
+        "seconds": round(seconds, 4),
+        "per_second": round(count / seconds, 2) if seconds > 0 else None,
+        "peak_rss_mb": round(peak_rss, 1),
+    }
+    if latencies:
+        p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+        result.update(p50_ms=round(p50, 4), p90_ms=round(p90, 4), p99_ms=round(p99, 4))
+    return result
+
+
+def timed(fn: Callable, calls: Iterable) -> dict:
+    # each call timed on its own, for percentiles, and all of them for throughput
+    latencies = []
+    with PeakRss() as rss:
+        started = time.perf_counter()
+        for call in calls:
+            start = time.perf_counter()
+            fn(*call)
+            latencies.append(time.perf_counter() - start)
+        seconds = time.perf_counter() - started
+    return summarize(latencies, len(latencies), seconds, rss.peak)
+
+
+def run_size(papers: int, args, corpus_url: str) -> dict:
+    from db import ReaderPool, connect, fetch_papers_as_df, init_db, insert_paper
+    from dedup import simhash
+    from embedding_codec import decode_embedding, encode_embedding
+    from extract_pool import ExtractPool
+    from http_client import HttpClient
+    from link_extractor import LinkExtractor
+    from models import MyFile, ProcessedPaper
+    from text_extractor import fetch_and_extract_text_from_pdf
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix=f"paperweight_bench_{papers}_", dir=args.workdir)
+    vault = os.path.join(workdir, "vault")
+    db_name = os.path.join(workdir, "bench.db")
+    results = {}
+    try:
+        make_vault(vault, papers, corpus_url)
+        init_db(db_name)
+        # one host serves every pdf, politeness limits would only measure themselves
+        http = HttpClient(args.download_workers, 0)
+        with ExtractPool(args.parse_workers) as pool:
+            # the synthetic pdfs reuse PDF_TEMPLATES texts, with dedup on most of them would
+            # be aliased as near duplicates instead of processed
+            link_extractor = LinkExtractor(
+                vault, db_name, "gpt-3.5-turbo", http=http, extract_pool=pool, dedup=False
+            )
+            print(f"[{papers}] extract_links")
+            with PeakRss() as rss:
+                started = time.perf_counter()
+                if args.serial:
+                    link_extractor.extract_links()
+                else:
+                    link_extractor.extract_links_concurrently(
+                        download_workers=args.download_workers
+                    )
+                seconds = time.perf_counter() - started
+            results["extract_links"] = summarize([], papers, seconds, rss.peak)
+
+            sample = random.Random(papers).sample(range(papers), min(SAMPLE_CALLS, papers))
+            print(f"[{papers}] fetch_and_extract_text_from_pdf")
+            fetched = []
+            results["fetch_and_extract_text_from_pdf"] = timed(
+                lambda url: fetched.append(
+                    fetch_and_extract_text_from_pdf(
+                        url, http, pool, **link_extractor.extract_options
+                    )
+                ),
+                [(paper_url(corpus_url, i),) for i in sample],
+            )
+
+        print(f"[{papers}] simhash")
+        results["simhash"] = timed(simhash, [(paper.text,) for paper in fetched])
+
+        print(f"[{papers}] insert_paper")
+        rng = np.random.default_rng(0)
+        processed = []
+        for paper in fetched:
+            processed_paper = ProcessedPaper(paper)
+            processed_paper.embedding = encode_embedding(rng.standard_normal(EMBEDDING_DIM))
+            processed.append(processed_paper)
+        # into the full library, each call is its own transaction as it is for callers
+        my_file = MyFile(os.path.join(vault, "bench.md"), time.time(), time.time())
+        results["insert_paper"] = timed(
+            lambda processed_paper: insert_paper(processed_paper, my_file, db_name, replace=True),
+            [(processed_paper,) for processed_paper in processed],
+        )
+        for paper in fetched:
+            paper.release()
+
+        print(f"[{papers}] decode_embedding")
+        conn = connect(db_name, read_only=True)
+        blobs = [
+            row[0]
+            for row in conn.execute("SELECT embedding FROM papers WHERE embedding IS NOT NULL")
+        ]
+        conn.close()
+        results["decode_embedding"] = timed(decode_embedding, [(blob,) for blob in blobs])
+        del blobs
+
+        print(f"[{papers}] fetch_papers_as_df")
+        readers = ReaderPool(db_name)
+        results["fetch_papers_as_df"] = timed(
+            lambda: fetch_papers_as_df(readers), [()] * args.repeat
+        )
+
+        from dash_app import DashApp
+
+        print(f"[{papers}] DashApp.fetch_and_process_new_papers")
+        dash_app = DashApp(db_name)
+        # the first call loads and projects the library, later ones only look for new rows
+        results["fetch_and_process_new_papers_cold"] = timed(
+            dash_app.fetch_and_process_new_papers, [()]
+        )
+        results["fetch_and_process_new_papers_warm"] = timed(
+            dash_app.fetch_and_process_new_papers, [()] * args.repeat
+        )
+        return results
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list[str]:
+    # a stage regresses when it got slower or used more memory than the baseline allows
+    found = []
+    for size, stages in results["sizes"].items():
+        for stage, current in stages.items():
+            previous = baseline.get("sizes", {}).get(size, {}).get(stage)
+            if not previous:
+                continue
+            for metric, higher_is_better in [
+                ("per_second", True),
+                ("p50_ms", False),
+                ("p99_ms", False),
+                ("peak_rss_mb", False),
+            ]:
+                old, new = previous.get(metric), current.get(metric)
+                if not old or new is None:
+                    continue
+                change = (old - new) / old if higher_is_better else (new - old) / old
+                if change > threshold:
+                    found.append(f"{size} {stage} {metric}: {old} -> {new} ({change:+.0%} worse)")
+    return found
+
+
+def print_results(results: dict):
+    columns = ["per_second", "p50_ms", "p90_ms", "p99_ms", "peak_rss_mb"]
+    print(f"\n{'papers':>8} {'stage':<36}" + "".join(f"{column:>13}" for column in columns))
+    for size, stages in results["sizes"].items():
+        for stage, result in stages.items():
+            values = "".join(
+                f"{result[column]:>13}" if result.get(column) is not None else f"{'-':>13}"
+                for column in columns
+            )
+            print(f"{size:>8} {stage:<36}{values}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="benchmark paperweight on a synthetic library")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000], help="papers per run")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline results json")
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="store these results as the new baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="how much worse than the baseline a metric can get before it's a regression",
+    )
+    parser.add_argument(
+        "--fail-on-regression", action="store_true", help="exit with 1 when something regressed"
+    )
+    parser.add_argument("--output", help="also write the results json here")
+    parser.add_argument(
+        "--api-latency", type=float, default=0.05, help="seconds the stub openai takes per call"
+    )
+    parser.add_argument(
+        "--pdf-latency", type=float, default=0.0, help="seconds the pdf server takes per request"
+    )
+    parser.add_argument(
+        "--missing-every", type=int, default=50, help="every nth pdf is a 404, 0 for none"
+    )
+    parser.add_argument("--serial", action="store_true", help="benchmark extract_links serially")
+    parser.add_argument("--download-workers", type=int, default=8)
+    parser.add_argument("--parse-workers", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=5, help="runs of the read path benchmarks")
+    parser.add_argument("--workdir", default=None, help="where the vault and db are generated")
+    parser.add_argument("--keep", action="store_true", help="keep the generated vault and db")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    # failed downloads are part of the benchmark, not worth a traceback each
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    with servers(args) as (corpus_url, api_url):
+        # the openai client reads these, nothing is sent to openai
+        os.environ["OPENAI_BASE_URL"] = api_url
+        os.environ["OPENAI_API_KEY"] = "bench"
+        results = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "machine": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+            },
+            "settings": {
+                "api_latency": args.api_latency,
+                "pdf_latency": args.pdf_latency,
+                "missing_every": args.missing_every,
+                "serial": args.serial,
+                "download_workers": args.download_workers,
+            },
+            "sizes": {str(size): run_size(size, args, corpus_url) for size in args.sizes},
+        }
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    found = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != results["settings"]:
+            print(f"\n{args.baseline} was run with other settings, comparing anyway")
+        found = regressions(results, baseline, args.threshold)
+        print(f"\n{len(found)} regression(s) against {args.baseline}")
+        for regression in found:
+            print(f"  {regression}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+
+    if found and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import base64, hashlib, logging, sqlite3
+from typing import Iterable, Iterator, Optional
+
+READ_CHUNK_SIZE = 1024 * 1024  #     ~1MB
+
+
+# content addressed storage for pdfs and thumbnails, keyed by sha256. the same pdf
+# behind different urls is stored once, and bytes are only read and written through
+# sqlite's incremental blob I/O so a big pdf never has to be in memory at once
+def put_blob(conn: sqlite3.Connection, sha256: str, size: int, chunks: Iterable[bytes]) -> bool:
+    c = conn.execute(
+        "INSERT OR IGNORE INTO blobs (sha256, size, data) VALUES (?, ?, zeroblob(?))",
+        (sha256, size, size),
+    )
+    if c.rowcount == 0:
+        return False
+
+    with conn.blobopen("blobs", "data", c.lastrowid) as blob:
+        for chunk in chunks:
+            blob.write(chunk)
+    return True
+
+
+def put_bytes(conn: sqlite3.Connection, data: bytes) -> str:
+    sha256 = hashlib.sha256(data).hexdigest()
+    put_blob(conn, sha256, len(data), [data])
+    return sha256
+
+
+def iter_blob(
+    conn: sqlite3.Connection, sha256: str, chunk_size: int = READ_CHUNK_SIZE
+) -> Iterator[bytes]:
+    row = conn.execute("SELECT rowid FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+    if row is None:
+        raise KeyError(sha256)
+
+    with conn.blobopen("blobs", "data", row[0], readonly=True) as blob:
+        while chunk := blob.read(chunk_size):
+            yield chunk
+
+
+def read_blob(conn: sqlite3.Connection, sha256: str) -> bytes:
+    return b"".join(iter_blob(conn, sha256))
+
+
+def delete_unreferenced(conn: sqlite3.Connection, hashes: Iterable[Optional[str]]):
+    for sha256 in {h for h in hashes if h}:
+        conn.execute(
+            """
+            DELETE FROM blobs WHERE sha256 = ?
+            AND NOT EXISTS (
+                SELECT 1 FROM papers WHERE pdf_sha256 = ? OR thumbnail_sha256 = ?
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM work_queue WHERE pdf_sha256 = ? OR thumbnail_sha256 = ?
+            )
+        """,
+            (sha256, sha256, sha256, sha256, sha256),
+        )
+
+
+def migrate_inline_blobs(conn: sqlite3.Connection):
+    # rows written before the blob store kept the pdf in papers.blob and a base64 png
+    # in papers.encoded_pic, move them over one row at a time
+    rows = conn.execute(
+        """
+        SELECT rowid, length(blob), encoded_pic FROM papers
+        WHERE (blob IS NOT NULL AND pdf_sha256 IS NULL)
+        OR (encoded_pic IS NOT NULL AND thumbnail_sha256 IS NULL)
+    """
+    ).fetchall()
+    if not rows:
+        return
+
+    print(f"moving {len(rows)} pdfs and thumbnails into the blob store")
+    for rowid, size, encoded_pic in rows:
+        with conn:
+            pdf_sha256 = None
+            if size:
+                pdf_sha256 = _hash_column(conn, rowid)
+                put_blob(conn, pdf_sha256, size, _iter_column(conn, rowid))
+
+            thumbnail_sha256 = None
+            if encoded_pic:
+                thumbnail_sha256 = put_bytes(conn, base64.b64decode(encoded_pic))
+
+            conn.execute(
+                """
+                UPDATE papers SET pdf_sha256 = COALESCE(?, pdf_sha256),
+                thumbnail_sha256 = COALESCE(?, thumbnail_sha256), blob = NULL, encoded_pic = NULL
+                WHERE rowid = ?
+            """,
+                (pdf_sha256, thumbnail_sha256, rowid),
+            )
+    logging.info("blob store migration done, VACUUM the db to reclaim the space")
+
+
+def _iter_column(conn: sqlite3.Connection, rowid: int) -> Iterator[bytes]:
+    with conn.blobopen("papers", "blob", rowid, readonly=True) as blob:
+        while chunk := blob.read(READ_CHUNK_SIZE):
+            yield chunk
+
+
+def _hash_column(conn: sqlite3.Connection, rowid: int) -> str:
+    digest = hashlib.sha256()
+    for chunk in _iter_column(conn, rowid):
+        digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,60 @@
+from typing import Iterator, Optional
+import tiktoken
+import numpy as np
+from models import PaperChunk
+
+CHUNK_TOKENS = 1024
+CHUNK_OVERLAP = 128
+
+
+def chunk_text(
+    text: str,
+    encoding: tiktoken.Encoding,
+    chunk_tokens: int = CHUNK_TOKENS,
+    overlap: int = CHUNK_OVERLAP,
+) -> list[PaperChunk]:
+    if overlap >= chunk_tokens:
+        raise ValueError("chunk overlap must be smaller than the chunk size")
+
+    tokens = encoding.encode(text, disallowed_special=())
+    # chunks are offsets into the text rather than copies of it, the text is stored once
+    _, offsets = encoding.decode_with_offsets(tokens)
+    offsets.append(len(text))
+    return [
+        PaperChunk(index=i, start=offsets[start], end=offsets[stop], token_count=stop - start)
+        for i, (start, stop) in enumerate(_windows(len(tokens), chunk_tokens, overlap))
+    ]
+
+
+def chunk_offsets(text: str, texts: list[str]) -> list[Optional[tuple[int, int]]]:
+    # where chunks stored as copies of the text start and end in it. a window that split a
+    # character decoded with replacement characters at its ends, they're left out
+    offsets, at = [], 0
+    for chunk in texts:
+        chunk = chunk.strip("\ufffd")
+        start = text.find(chunk, at)
+        offsets.append((start, start + len(chunk)) if chunk and start >= 0 else None)
+        at = start if start >= 0 else at
+    return offsets
+
+
+def _windows(count: int, size: int, overlap: int) -> Iterator[tuple[int, int]]:
+    step = size - overlap
+    for start in range(0, count, step):
+        yield start, min(start + size, count)
+        if start + size >= count:
+            break
+
+
+def pool_embeddings(embeddings: list[list[float]], weights: list[int]) -> list[float]:
+    # token weighted mean, renormalized since openai embeddings are unit length
+    pairs = [(embedding, weight) for embedding, weight in zip(embeddings, weights) if embedding]
+    if not pairs:
+        return []
+
+    matrix = np.asarray([embedding for embedding, _ in pairs], dtype=np.float32)
+    pooled = np.average(matrix, axis=0, weights=[weight for _, weight in pairs])
+    norm = np.linalg.norm(pooled)
+    if norm > 0:
+        pooled = pooled / norm
+    return pooled.astype(np.float32).tolist()
@@ -1,19 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import io
+import hashlib, json, os, sqlite3, threading
+from typing import Optional
 import boto3
+from boto3.s3.transfer import TransferConfig
 from tqdm import tqdm
 
+CHUNK_SIZE = 8 * 1024 * 1024  #     ~8MB, multipart part size and incremental chunk size
+CONCURRENCY = 8  #                  parts or chunks uploaded at once
 
-class ProgressBytesIO(io.BytesIO):
-    def __init__(self, bytes_io, progress_bar):
-        self._bytes_io = bytes_io
-        self._progress_bar = progress_bar
-        super().__init__(bytes_io)
 
-    def read(self, size=-1):
-        chunk = super().read(size)
-        self._progress_bar.update(len(chunk))
-        return chunk
+def s3_client(endpoint_url: str, access_key_id: str, access_key_secret: str, region_name: str):
+    return boto3.client(
+        service_name="s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=access_key_secret,
+        region_name=region_name,
+    )
 
 
 def backup_db(
@@ -23,25 +27,165 @@ def backup_db(
     access_key_id: str,
     access_key_secret: str,
     region_name: str,
+    mode: str = "full",
+    concurrency: int = CONCURRENCY,
 ):
-    s3 = boto3.client(
-        service_name="s3",
-        endpoint_url=endpoint_url,
-        aws_access_key_id=access_key_id,
-        aws_secret_access_key=access_key_secret,
-        region_name=region_name,
+    s3 = s3_client(endpoint_url, access_key_id, access_key_secret, region_name)
+    print(f"snapshotting {db_name}")
+    snapshot = snapshot_db(db_name)
+    try:
+        if mode == "incremental":
+            upload_incremental(s3, snapshot, bucket_name, backup_prefix(db_name), concurrency)
+        else:
+            upload_full(s3, snapshot, bucket_name, backup_prefix(db_name), concurrency)
+    finally:
+        os.remove(snapshot)
+    print("backup complete")
+
+
+def backup_prefix(db_name: str) -> str:
+    return os.path.basename(db_name).split(".")[0]
+
+
+def snapshot_db(db_name: str) -> str:
+    # a consistent copy through sqlite's online backup api, taken while the pipeline and
+    # the dash keep using the db. it goes next to the db, /tmp may not fit a library
+    directory, base = os.path.split(os.path.abspath(db_name))
+    path = os.path.join(directory, f".{base}.backup")
+    if os.path.exists(path):
+        os.remove(path)
+
+    source = sqlite3.connect(db_name)
+    target = sqlite3.connect(path)
+    try:
+        # in one step, a step by step copy starts over whenever the pipeline writes. it
+        # only holds a read transaction, under WAL writers carry on
+        source.backup(target)
+    except BaseException:
+        target.close()
+        os.remove(path)
+        raise
+    finally:
+        source.close()
+    target.close()
+    return path
+
+
+def upload_full(s3, snapshot: str, bucket_name: str, prefix: str, concurrency: int = CONCURRENCY):
+    # one timestamped copy, streamed from disk as a multipart upload with parallel parts
+    key = f"{prefix}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.db"
+    size = os.path.getsize(snapshot)
+    print(f"backing up to bucket {bucket_name} as {key}")
+    config = TransferConfig(
+        multipart_threshold=CHUNK_SIZE, multipart_chunksize=CHUNK_SIZE, max_concurrency=concurrency
     )
+    with tqdm(total=size, unit="B", unit_scale=True, desc=key) as progress_bar:
+        s3.upload_file(snapshot, bucket_name, key, Config=config, Callback=progress_bar.update)
+    return key
 
-    with open(db_name, "rb") as db:
-        file_content = db.read()
 
-    file_size = len(file_content)
-    file_name = f"{db_name.split('.')[0]}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.db"
+# incremental backups split the snapshot into fixed size chunks, stored once each under
+# their sha256. sqlite pages don't move when others change, so a run only uploads the
+# chunks holding pages written since the last one, plus a manifest listing every chunk
+def upload_incremental(
+    s3, snapshot: str, bucket_name: str, prefix: str, concurrency: int = CONCURRENCY
+) -> str:
+    previous = latest_manifest(s3, bucket_name, prefix)
+    stored = set(previous["chunks"]) if previous else set()
+    size = os.path.getsize(snapshot)
 
-    print(f"backing up {db_name} to bucket {bucket_name} as {file_name}")
-    print("initial file progress will stall as the initial connection is established")
-    with tqdm(total=file_size, unit="B", unit_scale=True, desc=file_name) as progress_bar:
-        progress_bytes_io = ProgressBytesIO(file_content, progress_bar)
-        s3.upload_fileobj(progress_bytes_io, bucket_name, file_name)
+    chunks: list[str] = []
+    uploaded = 0
+    # chunks read but not uploaded yet are capped, so memory stays at a few parts
+    slots = threading.Semaphore(concurrency * 2)
+    with tqdm(total=size, unit="B", unit_scale=True, desc=prefix) as progress_bar:
+        with ThreadPoolExecutor(concurrency) as executor, open(snapshot, "rb") as f:
+            futures = []
+            while chunk := f.read(CHUNK_SIZE):
+                sha256 = hashlib.sha256(chunk).hexdigest()
+                chunks.append(sha256)
+                if sha256 in stored:
+                    progress_bar.update(len(chunk))
+                    continue
 
-    print("backup complete")
+                stored.add(sha256)
+                uploaded += 1
+                slots.acquire()
+                futures.append(
+                    executor.submit(
+                        _put_chunk, s3, bucket_name, chunk_key(prefix, sha256), chunk, slots
+                    )
+                )
+                futures[-1].add_done_callback(lambda _, n=len(chunk): progress_bar.update(n))
+            for future in futures:
+                future.result()
+
+    manifest = {
+        "created_at": datetime.now().isoformat(),
+        "size": size,
+        "chunk_size": CHUNK_SIZE,
+        "chunks": chunks,
+    }
+    # written last, a run that dies halfway leaves the previous manifest as the latest
+    key = f"{prefix}/manifests/{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
+    s3.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(manifest).encode("utf-8"))
+    print(f"uploaded {uploaded} of {len(chunks)} chunks, manifest {key}")
+    return key
+
+
+def latest_manifest(s3, bucket_name: str, prefix: str) -> Optional[dict]:
+    key = latest_manifest_key(s3, bucket_name, prefix)
+    if key is None:
+        return None
+    return json.loads(s3.get_object(Bucket=bucket_name, Key=key)["Body"].read())
+
+
+def latest_manifest_key(s3, bucket_name: str, prefix: str) -> Optional[str]:
+    # manifest names are timestamps, the last one listed is the newest
+    latest = None
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"{prefix}/manifests/"):
+        for item in page.get("Contents", []):
+            if latest is None or item["Key"] > latest:
+                latest = item["Key"]
+    return latest
+
+
+def restore_db(s3, bucket_name: str, manifest_key: str, target: str):
+    # rebuilds the db an incremental backup's manifest describes, chunk by chunk. it's
+    # written next to `target` and only moved over it once every chunk and the size check out
+    manifest = json.loads(s3.get_object(Bucket=bucket_name, Key=manifest_key)["Body"].read())
+    prefix = manifest_key.split("/manifests/")[0]
+    partial = target + ".tmp"
+    try:
+        with open(partial, "wb") as f:
+            for sha256 in tqdm(manifest["chunks"], unit="chunk", desc=target):
+                key = chunk_key(prefix, sha256)
+                chunk = s3.get_object(Bucket=bucket_name, Key=key)["Body"].read()
+                if hashlib.sha256(chunk).hexdigest() != sha256:
+                    raise ValueError(f"chunk {sha256} of {manifest_key} is corrupt")
+                f.write(chunk)
+
+        if os.path.getsize(partial) != manifest["size"]:
+            raise ValueError(f"restored {target} doesn't match the size in {manifest_key}")
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    # an old db's wal would be replayed over the restored one
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    os.replace(partial, target)
+
+
+def chunk_key(prefix: str, sha256: str) -> str:
+    return f"{prefix}/chunks/{sha256}"
+
+
+def _put_chunk(s3, bucket_name: str, key: str, chunk: bytes, slots: threading.Semaphore):
+    try:
+        s3.put_object(Bucket=bucket_name, Key=key, Body=chunk)
+    finally:
+        slots.release()
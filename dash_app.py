@@ -1,33 +1,76 @@
 import logging
 import dash
 from dash.dependencies import Input, Output
-from dash import dcc, html, dash_table
+from dash.exceptions import PreventUpdate
+from dash import ctx, dcc, html, dash_table
 import plotly.graph_objs as go
-from sklearn.decomposition import PCA
 import numpy as np
 import pandas as pd
-from db import fetch_papers_as_df
-from link_extractor import decode_embedding
-from flask import Flask
+from db import ReaderPool
+from dash_state import COLUMNS, DashState
+from full_text import HIGHLIGHT_END, HIGHLIGHT_START, search_papers
+from projection import Projection
+from flask import Flask, Response
+from metrics import REGISTRY
+
+DETAIL_LEVELS = [2_000, 5_000, 20_000]  #    points drawn, the scatter never gets more
+PAGE_SIZE = 25
+SEARCH_RESULTS = 20
+MAX_PAGE_SIZE = 500
+LIVE_INTERVAL_MS = 3000
+TABLE_COLUMNS = COLUMNS + ["x", "y", "z"]
 
 
 # This is very much a v1, but we are at least rendering the embeddings in 3d,
 # and showing a table with the paper data.
 class DashApp:
-    def __init__(self, db_name):
+    def __init__(self, db_name, live: bool = False):
         logging.getLogger("werkzeug").setLevel(logging.WARNING)
         self.db_name = db_name
+        # polls for new papers and redraws when there are some, for the watch mode
+        self.live = live
+        self.readers = ReaderPool(db_name)
+        self.state = DashState(self.readers)
+        self.projection = Projection(self.state)
+        self._table = None
+        self._table_version = -1
+        self._sorted: dict[tuple, np.ndarray] = {}
         self.app = dash.Dash(__name__, server=Flask(__name__))
         self.setup_layout()
         self.register_callbacks()
+        # the ingest runs in this process, prometheus can scrape it next to the dash
+        self.app.server.add_url_rule("/metrics", "metrics", self.metrics)
 
     def setup_layout(self):
         self.app.layout = html.Div(
             [
                 html.Button("Refresh Data", id="refresh-button"),
+                dcc.RadioItems(
+                    id="detail",
+                    options=[{"label": f"{n:,} points", "value": n} for n in DETAIL_LEVELS],
+                    value=DETAIL_LEVELS[1],
+                    inline=True,
+                ),
+                dcc.Input(
+                    id="search",
+                    type="search",
+                    placeholder="search paper text",
+                    debounce=True,
+                    style={"width": "100%", "margin": "10px 0"},
+                ),
+                html.Div(id="search-results"),
+                dcc.Store(id="data-version"),
+                dcc.Interval(id="live", interval=LIVE_INTERVAL_MS, disabled=not self.live),
                 dcc.Graph(id="3d-plot"),
                 dash_table.DataTable(
                     id="paper-table",
+                    columns=[{"name": i, "id": i} for i in TABLE_COLUMNS],
+                    page_action="custom",
+                    page_current=0,
+                    page_size=PAGE_SIZE,
+                    sort_action="custom",
+                    sort_mode="single",
+                    sort_by=[],
                     style_table={"overflowX": "auto", "width": "100%", "maxWidth": "100%"},
                     style_cell={"textAlign": "left", "padding": "5px"},
                     style_header={"backgroundColor": "lightgrey", "fontWeight": "bold"},
@@ -38,25 +81,29 @@ class DashApp:
 
     def register_callbacks(self):
         @self.app.callback(
+            [Output("3d-plot", "figure"), Output("data-version", "data")],
             [
-                Output("3d-plot", "figure"),
-                Output("paper-table", "data"),
-                Output("paper-table", "columns"),
+                Input("refresh-button", "n_clicks"),
+                Input("detail", "value"),
+                Input("live", "n_intervals"),
             ],
-            [Input("refresh-button", "n_clicks")],
         )
-        def update_graph(n_clicks):
-            df = self.fetch_and_process_new_papers()
+        def update_graph(n_clicks, detail, n_intervals):
+            # a tick only redraws when papers were written since the last draw
+            if ctx.triggered_id == "live" and self.state.refresh() == 0:
+                raise PreventUpdate
+            df = self.fetch_and_process_new_papers(detail or DETAIL_LEVELS[1])
 
             if not df.empty and len(df) > 3:
-                created_at_float = (df["created_at"] - df["created_at"].min()) / (
-                    df["created_at"].max() - df["created_at"].min()
+                created_at = df["created_at"].to_numpy(dtype=float)
+                created_at_float = (created_at - self.created_at_min) / max(
+                    self.created_at_max - self.created_at_min, 1e-9
                 )
 
                 marker_args = dict(
-                    size=10,
+                    size=10 if len(df) < 2000 else 4,
                     opacity=0.8,
-                    color=created_at_float,
+                    color=np.round(created_at_float, 3),
                     colorscale="Plotly3",
                     colorbar=dict(title="created at. 1=new 0=old"),
                 )
@@ -66,7 +113,7 @@ class DashApp:
                     y=df["y"],
                     z=df["z"],
                     mode="markers",
-                    hovertext=df.apply(get_text, axis=1),
+                    hovertext=hover_texts(df),
                     hoverinfo="text",
                     hoverinfosrc="hovertext",
                     marker=marker_args,
@@ -75,56 +122,130 @@ class DashApp:
                     margin={"l": 0, "r": 0, "b": 0, "t": 0},
                     scene=dict(xaxis=dict(title=""), yaxis=dict(title=""), zaxis=dict(title="")),
                     height=900,
+                    # keeps the camera where it was when the plot is redrawn
+                    uirevision="papers",
                 )
                 graph_figure = {"data": [trace], "layout": layout}
-                table_data = df.to_dict("records")
-                columns = [{"name": i, "id": i} for i in df.columns]
-
-                return (graph_figure, table_data, columns)
+                return (graph_figure, self.state.version)
             else:
-                return ({"data": [], "layout": dict()}, [], [])
+                return ({"data": [], "layout": dict()}, self.state.version)
 
-    def fetch_and_process_new_papers(self):
-        df = fetch_papers_as_df(self.db_name)
+        @self.app.callback(
+            [Output("paper-table", "data"), Output("paper-table", "page_count")],
+            [
+                Input("paper-table", "page_current"),
+                Input("paper-table", "page_size"),
+                Input("paper-table", "sort_by"),
+                Input("data-version", "data"),
+            ],
+        )
+        def update_table(page_current, page_size, sort_by, version):
+            return self.table_page(page_current or 0, page_size or PAGE_SIZE, sort_by or [])
 
-        if df.empty or len(df) <= 3:
-            return pd.DataFrame(columns=["x", "y", "z", "created_at", "url"])
+        @self.app.callback(
+            Output("search-results", "children"),
+            [Input("search", "value"), Input("data-version", "data")],
+        )
+        def update_search(query, version):
+            return self.search_results(query or "")
 
-        df["decoded_embedding"] = df["embedding"].apply(decode_embedding)
-        df = df[df["decoded_embedding"].apply(lambda x: x.shape[0]) > 0]
+    def search_results(self, query: str) -> list:
+        if not query.strip():
+            return []
+        with self.readers.connection() as conn:
+            hits = search_papers(conn, query, SEARCH_RESULTS)
+        if not hits:
+            return [html.P("no papers match")]
+        return [
+            html.Div(
+                [
+                    html.A(hit.title or hit.url.split("/")[-1], href=hit.url, target="_blank"),
+                    html.Div(trim_url(hit.url), style={"color": "grey", "fontSize": "small"}),
+                    html.P(highlight(hit.snippet)),
+                ],
+                style={"marginBottom": "10px"},
+            )
+            for hit in hits
+        ]
 
-        embeddings_matrix = np.stack(df["decoded_embedding"].values)
-        pca = PCA(n_components=3)
-        pca_result = pca.fit_transform(embeddings_matrix)
-        df["x"], df["y"], df["z"] = pca_result[:, 0], pca_result[:, 1], pca_result[:, 2]
+    def fetch_and_process_new_papers(self, max_points: int = DETAIL_LEVELS[1]) -> pd.DataFrame:
+        # only new or changed rows are projected, and only a bounded sample is returned
+        self.state.refresh()
+        self.projection.update()
 
-        df["url"] = df["url"].transform(trim_url)
+        positions = self.projection.sample(max_points)
+        if len(positions) <= 3:
+            return pd.DataFrame(columns=["x", "y", "z", "created_at", "url", "title"])
 
-        return df[
-            [
-                "url",
-                "title",
-                "authors",
-                "published_date",
-                "summary",
-                "institution",
-                "location",
-                "status",
-                "created_at",
-                "x",
-                "y",
-                "z",
-            ]
-        ]
+        frame = self.state.frame()
+        created_at = frame["created_at"].to_numpy(dtype=float)
+        self.created_at_min = np.nanmin(created_at)
+        self.created_at_max = np.nanmax(created_at)
+
+        df = frame.iloc[positions][["url", "title", "created_at"]].reset_index(drop=True)
+        coords = np.round(self.projection.coords[positions], 4)
+        df["x"], df["y"], df["z"] = coords[:, 0], coords[:, 1], coords[:, 2]
+        return df
+
+    def table_page(self, page: int, page_size: int, sort_by: list[dict]) -> tuple[list, int]:
+        # one page of rows per request, sorted server side, whatever the library size
+        table = self.table()
+        page_size = min(page_size, MAX_PAGE_SIZE)
+        order = None
+        if sort_by:
+            column, ascending = sort_by[0]["column_id"], sort_by[0]["direction"] == "asc"
+            key = (column, ascending, self._table_version)
+            if key not in self._sorted:
+                ordered = table[column].sort_values(ascending=ascending, kind="stable")
+                self._sorted = {key: ordered.index.to_numpy()}
+            order = self._sorted[key]
+
+        start = page * page_size
+        rows = (
+            order[start : start + page_size]
+            if order is not None
+            else slice(start, start + page_size)
+        )
+        page_df = table.iloc[rows].copy()
+        page_df["url"] = page_df["url"].transform(trim_url)
+        page_count = max(1, -(-len(table) // page_size))
+        return page_df.to_dict("records"), page_count
+
+    def table(self) -> pd.DataFrame:
+        # rebuilt only when the data changed since the last table request
+        if self._table is None or self._table_version != self.projection.version:
+            positions = np.flatnonzero(self.projection.projected)
+            table = self.state.frame().iloc[positions].reset_index(drop=True)
+            coords = np.round(self.projection.coords[positions], 4)
+            table["x"], table["y"], table["z"] = coords[:, 0], coords[:, 1], coords[:, 2]
+            self._table = table[TABLE_COLUMNS]
+            self._table_version = self.projection.version
+        return self._table
+
+    def metrics(self) -> Response:
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
     def run(self, debug=False):
         self.app.run_server(debug=debug)
 
 
-def get_text(row):
-    parts = [row["url"].split("/")[-1], row.get("title", "")]
-    filtered_parts = [part for part in parts if part]
-    return "<br>".join(filtered_parts)
+def hover_texts(df: pd.DataFrame) -> pd.Series:
+    # the file name and title of each point, without a python call per row
+    file_names = df["url"].str.rsplit("/", n=1).str[-1]
+    titles = df["title"].fillna("").astype(str)
+    return file_names.where(titles == "", file_names + "<br>" + titles)
+
+
+def highlight(snippet: str) -> list:
+    # matched terms in bold, the snippet is never parsed as html or markdown
+    parts = []
+    for i, part in enumerate(snippet.split(HIGHLIGHT_START)):
+        if i == 0:
+            parts.append(part)
+            continue
+        match, _, rest = part.partition(HIGHLIGHT_END)
+        parts += [html.Mark(match), rest]
+    return [part for part in parts if part != ""]
 
 
 def trim_url(url, max_length=50):
@@ -0,0 +1,127 @@
+import threading
+from typing import Optional
+import numpy as np
+import pandas as pd
+from db import ReaderPool, fetch_papers_after
+from embedding_codec import decode_embeddings
+
+# only what the dashboard shows, never text or blobs
+COLUMNS = [
+    "url",
+    "title",
+    "authors",
+    "published_date",
+    "summary",
+    "institution",
+    "location",
+    "status",
+    "created_at",
+]
+
+
+# the dashboard's copy of the papers table, grown in place on every refresh.
+# only rows written after the last seen write_seq are read, and their embeddings are appended
+# to a preallocated float32 matrix instead of decoding the whole column again
+class DashState:
+    def __init__(self, readers: ReaderPool, initial_capacity: int = 1024):
+        self.readers = readers
+        # None until the first refresh, which reads every row
+        self.last_write_seq: Optional[int] = None
+        self.size = 0
+        self.dim = 0
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        self.has_embedding = np.zeros(0, dtype=bool)
+        # the refresh each row last changed in, so consumers only redo changed rows
+        self.version = 0
+        self.versions = np.zeros(0, dtype=np.int64)
+        self.initial_capacity = initial_capacity
+        self._columns: dict[str, list] = {column: [] for column in COLUMNS}
+        self._positions: dict[str, int] = {}
+        self._df = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> int:
+        with self._lock:
+            rows = fetch_papers_after(self.readers, self.last_write_seq, COLUMNS)
+            # rows from before write_seq existed have none, they were all in the first read
+            self.last_write_seq = max(
+                [self.last_write_seq or 0, *(row[0] for row in rows if row[0] is not None)]
+            )
+            if not rows:
+                return 0
+
+            self.version += 1
+            # the whole batch is decoded in one go, whatever format each row was written in
+            vectors, valid = decode_embeddings([row[-1] for row in rows], self.dim or None)
+            if self.dim == 0 and valid.any():
+                self.dim = vectors.shape[1]
+                self.embeddings = np.zeros((self.has_embedding.shape[0], self.dim), np.float32)
+
+            for (_, *values, _), vector, ok in zip(rows, vectors, valid):
+                self._upsert(values, vector if ok else None)
+
+            self._df = None
+            return len(rows)
+
+    def _upsert(self, values: list, vector: Optional[np.ndarray]):
+        url = values[0]
+        position = self._positions.get(url)
+        if position is None:
+            # replaced rows come back with a new write_seq, they overwrite their old slot
+            position = self.size
+            self._positions[url] = position
+            self._grow(position + 1)
+            self.size += 1
+            for column, value in zip(COLUMNS, values):
+                self._columns[column].append(value)
+        else:
+            for column, value in zip(COLUMNS, values):
+                self._columns[column][position] = value
+
+        self.versions[position] = self.version
+        if vector is not None:
+            self.embeddings[position] = vector
+            self.has_embedding[position] = True
+        else:
+            self.has_embedding[position] = False
+
+    def _grow(self, needed: int):
+        capacity = self.has_embedding.shape[0]
+        if needed <= capacity:
+            return
+
+        capacity = max(self.initial_capacity, capacity * 2, needed)
+        has_embedding = np.zeros(capacity, dtype=bool)
+        has_embedding[: self.size] = self.has_embedding[: self.size]
+        self.has_embedding = has_embedding
+        versions = np.zeros(capacity, dtype=np.int64)
+        versions[: self.size] = self.versions[: self.size]
+        self.versions = versions
+        if self.dim:
+            embeddings = np.zeros((capacity, self.dim), dtype=np.float32)
+            embeddings[: self.size] = self.embeddings[: self.size]
+            self.embeddings = embeddings
+
+    def frame(self) -> pd.DataFrame:
+        with self._lock:
+            if self._df is None:
+                self._df = pd.DataFrame(self._columns, columns=COLUMNS)
+            return self._df
+
+    def vectors(self) -> tuple[np.ndarray, np.ndarray]:
+        # positions that have an embedding, and a view of those rows
+        with self._lock:
+            positions = np.flatnonzero(self.has_embedding[: self.size])
+            if positions.shape[0] == self.size:
+                # the common case, no copy
+                return positions, self.embeddings[: self.size]
+            return positions, self.embeddings[positions]
+
+    def changed_since(self, version: int) -> tuple[int, np.ndarray, np.ndarray]:
+        # the current version, the positions with an embedding that changed after `version`,
+        # and their vectors
+        with self._lock:
+            positions = np.flatnonzero(
+                self.has_embedding[: self.size] & (self.versions[: self.size] > version)
+            )
+            return self.version, positions, self.embeddings[positions]
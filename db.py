@@ -1,12 +1,40 @@
-import logging, json, sqlite3
+import logging, json, os, queue, sqlite3, threading, time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Union
 from models import MyFile, ProcessedPaper
+from ann_index import AnnIndex
+from blob_store import delete_unreferenced, migrate_inline_blobs, put_blob, put_bytes
+from chunker import chunk_offsets
+from dedup import add_fingerprint, create_dedup_tables, fill_fingerprints, fill_url_keys, url_key
+from full_text import create_fts_index
+from metrics import STAGE_SECONDS
 import pandas as pd
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+
+BUSY_TIMEOUT_MS = 30_000
+
+DASH_COLUMNS = [
+    "url",
+    "title",
+    "authors",
+    "keywords",
+    "abstract",
+    "published_date",
+    "summary",
+    "institution",
+    "location",
+    "status",
+    "embedding",
+    "file_path",
+    "created_at",
+    "updated_at",
+]
 
 
 def init_db(db_name: str):
     conn = sqlite3.connect(db_name)
     c = conn.cursor()
+    # persistent, readers and the writer stop blocking each other
+    c.execute("PRAGMA journal_mode = WAL")
 
     # LATER use `BLOB CHECK (jsonb_valid(authors))`
     # to validate jsonb on keywords and authors -
@@ -34,71 +62,526 @@ def init_db(db_name: str):
         )
     """
     )
+    # `blob` and `encoded_pic` are only set on rows from before the blob store
+    # text_complete is 0 when only the first pages were extracted. written_at is when the
+    # row was inserted, updated_at is the note's. write_seq numbers the rows in the order
+    # they were committed, incremental exports go by it
+    add_missing_columns(
+        c,
+        "papers",
+        {
+            "pdf_sha256": "TEXT",
+            "thumbnail_sha256": "TEXT",
+            "text_complete": "INTEGER",
+            "written_at": "FLOAT",
+            "url_key": "TEXT",
+            "write_seq": "INTEGER",
+        },
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS papers_write_seq ON papers (write_seq)")
+    # work_queue.FAILED_PAPERS, failed papers are queued again after a while
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS papers_failed ON papers (written_at)"
+        " WHERE status NOT LIKE 'success%'"
+    )
+    # where write_seq comes from, it never goes down, even when the newest paper is replaced
+    c.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+    c.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('papers', 0)")
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER,
+            data BLOB
+        )
+    """
+    )
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS paper_chunks (
+            url TEXT,
+            chunk_index INTEGER,
+            start_char INTEGER,
+            end_char INTEGER,
+            token_count INTEGER,
+            embedding BLOB,
+            PRIMARY KEY (url, chunk_index)
+        )
+    """
+    )
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS md_files (
+            path TEXT PRIMARY KEY,
+            mtime FLOAT,
+            ctime FLOAT,
+            size INTEGER
+        )
+    """
+    )
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS md_links (
+            path TEXT,
+            url TEXT,
+            PRIMARY KEY (path, url)
+        )
+    """
+    )
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS http_validators (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            checked_at FLOAT
+        )
+    """
+    )
+    # links that aren't papers yet, with the output of each stage they got through.
+    # next_attempt_at is NULL once a link is given up on, see work_queue.WorkQueue
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS work_queue (
+            url TEXT PRIMARY KEY,
+            file_path TEXT,
+            created_at FLOAT,
+            updated_at FLOAT,
+            stage TEXT,
+            attempts INTEGER,
+            next_attempt_at FLOAT,
+            lease_until FLOAT,
+            lease_owner TEXT,
+            last_error TEXT,
+            pdf_sha256 TEXT,
+            thumbnail_sha256 TEXT,
+            text TEXT,
+            text_complete INTEGER,
+            embedding BLOB,
+            chunks TEXT,
+            data BLOB
+        )
+    """
+    )
+    # the url's dedup.url_key, and from the extracted stage on a simhash of its text
+    add_missing_columns(c, "work_queue", {"url_key": "TEXT", "simhash": "INTEGER"})
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS work_queue_due ON work_queue (next_attempt_at, lease_until)"
+    )
+    create_fts_index(c)
+    create_dedup_tables(c)
     conn.commit()
+    migrate_inline_blobs(conn)
+    migrate_chunk_text(conn)
+    fill_url_keys(conn)
+    fill_fingerprints(conn)
     conn.close()
 
 
-def insert_paper(processed_paper: ProcessedPaper, my_file: MyFile, db_name: str):
-    conn = sqlite3.connect(db_name)
+def migrate_chunk_text(conn: sqlite3.Connection):
+    # chunks written before they were offsets into papers.text kept a copy of their text,
+    # their offsets are found in the paper's text and the copies dropped
+    if "text" not in {row[1] for row in conn.execute("PRAGMA table_info(paper_chunks)")}:
+        return
+    add_missing_columns(
+        conn.cursor(), "paper_chunks", {"start_char": "INTEGER", "end_char": "INTEGER"}
+    )
+    urls = [url for (url,) in conn.execute("SELECT DISTINCT url FROM paper_chunks")]
+    if urls:
+        print(f"moving the chunks of {len(urls)} papers to offsets into their text")
+    for url in urls:
+        with conn:
+            row = conn.execute("SELECT text FROM papers WHERE url = ?", (url,)).fetchone()
+            chunks = conn.execute(
+                "SELECT chunk_index, text FROM paper_chunks WHERE url = ? ORDER BY chunk_index",
+                (url,),
+            ).fetchall()
+            offsets = chunk_offsets(row[0] or "" if row else "", [text or "" for _, text in chunks])
+            conn.executemany(
+                "UPDATE paper_chunks SET start_char = ?, end_char = ? WHERE url = ? AND chunk_index = ?",
+                [(*offset, url, index) for (index, _), offset in zip(chunks, offsets) if offset],
+            )
+    conn.execute("ALTER TABLE paper_chunks DROP COLUMN text")
+    conn.commit()
+
+
+def add_missing_columns(c: sqlite3.Cursor, table: str, columns: dict[str, str]):
+    existing = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    for name, column_type in columns.items():
+        if name not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+
+def connect(db_name: str, read_only: bool = False) -> sqlite3.Connection:
+    if read_only:
+        conn = sqlite3.connect(
+            f"file:{os.path.abspath(db_name)}?mode=ro", uri=True, check_same_thread=False
+        )
+    else:
+        # autocommit, PaperWriter opens its own transactions
+        conn = sqlite3.connect(db_name, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    return conn
+
+
+# the one connection that writes papers. inserts are grouped into transactions of
+# `batch_size` papers (or whatever arrived within `flush_interval` seconds), each paper
+# in its own savepoint so a bad row doesn't roll back the rest of its batch.
+# embeddings of committed papers are appended to the ann index next to the db
+class PaperWriter:
+    def __init__(
+        self,
+        db_name: str,
+        batch_size: int = 20,
+        flush_interval: float = 5.0,
+        index: Optional[AnnIndex] = None,
+    ):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.conn = connect(db_name)
+        self.index = index or AnnIndex.for_db(db_name)
+        self._owns_index = index is None
+        # reentrant, a paper being inserted can read its text back through read()
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._first_pending_at = 0.0
+        self._embeddings: list[tuple[str, bytes]] = []
+
+    def insert(
+        self,
+        processed_paper: ProcessedPaper,
+        my_file: MyFile,
+        replace: bool = False,
+        done: Optional[Callable[[sqlite3.Connection, Optional[Exception]], None]] = None,
+    ):
+        # `done` runs in the paper's transaction, with the error it failed with or None
+        with self._lock:
+            # timed once the lock is held, waiting on other writers isn't write time
+            with STAGE_SECONDS.time(stage="write"):
+                self._begin()
+                self.conn.execute("SAVEPOINT paper")
+                try:
+                    insert_paper_rows(self.conn, processed_paper, my_file, replace)
+                    if done is not None:
+                        done(self.conn, None)
+                    self.conn.execute("RELEASE paper")
+                    self._pending += 1
+                    if processed_paper.embedding or replace:
+                        # an empty one takes the replaced paper's old vector out of the index
+                        self._embeddings.append(
+                            (processed_paper.url, processed_paper.embedding or b"")
+                        )
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO paper")
+                    self.conn.execute("RELEASE paper")
+                    logging.info(f"Error inserting {processed_paper.url}: {e}")
+                    if done is not None:
+                        done(self.conn, e)
+
+                self._maybe_commit()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        # other writes that go in with the current batch, rolled back alone if they fail
+        with self._lock:
+            self._begin()
+            self.conn.execute("SAVEPOINT work")
+            try:
+                yield self.conn
+                self.conn.execute("RELEASE work")
+            except BaseException:
+                self.conn.execute("ROLLBACK TO work")
+                self.conn.execute("RELEASE work")
+                raise
+            self._maybe_commit()
+
+    def read(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        # one row, seeing what this writer hasn't committed yet
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def _begin(self):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+            self._first_pending_at = time.monotonic()
+
+    def _maybe_commit(self):
+        elapsed = time.monotonic() - self._first_pending_at
+        if self._pending >= self.batch_size or elapsed >= self.flush_interval:
+            self._commit()
+
+    def _commit(self):
+        if self.conn.in_transaction:
+            with STAGE_SECONDS.time(stage="commit"):
+                self.conn.execute("COMMIT")
+        self._pending = 0
+
+        if self._embeddings:
+            urls, blobs = zip(*self._embeddings)
+            self._embeddings = []
+            try:
+                self.index.add_blobs(urls, blobs)
+            except Exception as e:
+                # the db is the source of truth, `AnnIndex.sync` catches the index up later
+                logging.info(f"Error updating the ann index: {e}")
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+        if self._owns_index:
+            self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# read only connections for the dash app, under WAL they never block the writer
+class ReaderPool:
+    def __init__(self, db_name: str, size: int = 4):
+        self.db_name = db_name
+        self._connections: queue.Queue = queue.Queue()
+        for _ in range(size):
+            self._connections.put(connect(db_name, read_only=True))
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get().close()
+
+
+def insert_paper(
+    processed_paper: ProcessedPaper, my_file: MyFile, db_name: str, replace: bool = False
+):
+    with PaperWriter(db_name, batch_size=1) as writer:
+        writer.insert(processed_paper, my_file, replace)
+
+
+def insert_paper_rows(
+    conn: sqlite3.Connection, processed_paper: ProcessedPaper, my_file: MyFile, replace: bool
+):
     c = conn.cursor()
+    spool = processed_paper.spool
 
-    try:
-        processed_paper.encoded_pic
+    pdf_sha256 = processed_paper.pdf_sha256
+    if spool is not None:
+        pdf_sha256 = spool.sha256
+        put_blob(conn, pdf_sha256, spool.size, spool.iter_chunks())
+
+    thumbnail_sha256 = processed_paper.thumbnail_sha256
+    if processed_paper.thumbnail:
+        thumbnail_sha256 = put_bytes(conn, processed_paper.thumbnail)
+
+    # taken under the write lock, which is held until the commit, so no other connection
+    # can commit a lower write_seq after this one
+    c.execute("UPDATE counters SET value = value + 1 WHERE name = 'papers'")
+    write_seq = c.execute("SELECT value FROM counters WHERE name = 'papers'").fetchone()[0]
+
+    old_hashes = []
+    if replace:
+        old_hashes = (
+            c.execute(
+                "SELECT pdf_sha256, thumbnail_sha256 FROM papers WHERE url = ?",
+                (processed_paper.url,),
+            ).fetchone()
+            or []
+        )
+        c.execute("DELETE FROM paper_chunks WHERE url = ?", (processed_paper.url,))
+        # deleted rather than INSERT OR REPLACE, whose delete doesn't fire the fts trigger
+        c.execute("DELETE FROM papers WHERE url = ?", (processed_paper.url,))
 
+    c.execute(
+        """
+        INSERT INTO papers (
+            url, status, text, pdf_sha256, thumbnail_sha256, title, keywords, authors,
+            abstract, published_date, summary, institution, location,
+            embedding, file_path, created_at, updated_at, text_complete, written_at, url_key,
+            write_seq
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+        (
+            processed_paper.url,
+            processed_paper.status,
+            processed_paper.text,
+            pdf_sha256,
+            thumbnail_sha256,
+            processed_paper.title,
+            json.dumps(processed_paper.keywords),
+            json.dumps(processed_paper.authors),
+            processed_paper.abstract,
+            processed_paper.published_date,
+            processed_paper.summary,
+            processed_paper.institution,
+            processed_paper.location,
+            processed_paper.embedding,
+            my_file.full_path,
+            my_file.created_at,
+            my_file.updated_at,
+            int(processed_paper.text_complete),
+            time.time(),
+            url_key(processed_paper.url),
+            write_seq,
+        ),
+    )
+    add_fingerprint(conn, processed_paper.url, processed_paper.simhash)
+    c.executemany(
+        """
+        INSERT INTO paper_chunks (url, chunk_index, start_char, end_char, token_count, embedding)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """,
+        [
+            (
+                processed_paper.url,
+                chunk.index,
+                chunk.start,
+                chunk.end,
+                chunk.token_count,
+                chunk.embedding,
+            )
+            for chunk in processed_paper.chunks
+        ],
+    )
+    if spool is not None and (spool.etag or spool.last_modified):
         c.execute(
             """
-            INSERT INTO papers (
-                url, status, text, blob, title, keywords, authors,
-                abstract, published_date, summary, institution, location,
-                embedding, encoded_pic, file_path, created_at, updated_at
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT OR REPLACE INTO http_validators (url, etag, last_modified, checked_at)
+            VALUES (?, ?, ?, ?)
         """,
-            (
-                processed_paper.url,
-                processed_paper.status,
-                processed_paper.text,
-                processed_paper.blob,
-                processed_paper.title,
-                json.dumps(processed_paper.keywords),
-                json.dumps(processed_paper.authors),
-                processed_paper.abstract,
-                processed_paper.published_date,
-                processed_paper.summary,
-                processed_paper.institution,
-                processed_paper.location,
-                processed_paper.embedding,
-                processed_paper.encoded_pic,
-                my_file.full_path,
-                my_file.created_at,
-                my_file.updated_at,
-            ),
+            (processed_paper.url, spool.etag, spool.last_modified, time.time()),
         )
-        conn.commit()
-    except Exception as e:
-        logging.info(f"Error inserting {processed_paper.url}: {e}")
-    finally:
-        conn.close()
+    if old_hashes:
+        delete_unreferenced(conn, old_hashes)
 
 
-@retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(5))
-def fetch_papers_as_df(db_name: str) -> pd.DataFrame:
+def fetch_papers_as_df(db: Union[str, ReaderPool]) -> pd.DataFrame:
+    # never pulls text or blob bytes. takes the dash app's ReaderPool, or a db path as
+    # notebooks pass it, read through a pool of one opened for the call
+    readers = ReaderPool(db, size=1) if isinstance(db, str) else db
     try:
-        conn = sqlite3.connect(db_name)
-        df = pd.read_sql_query("SELECT * FROM papers", conn)
-        conn.close()
-        return df
-    except sqlite3.OperationalError as e:
-        logging.info(f"Encountered a SQLite error: {e}, retrying...")
-        logging.exception(e)
-        raise  # re-raising the exception to allow the retry mechanism to kick in
+        with readers.connection() as conn:
+            return pd.read_sql_query(f"SELECT {', '.join(DASH_COLUMNS)} FROM papers", conn)
+    finally:
+        if readers is not db:
+            readers.close()
 
 
-def check_paper_exists(url, db_name):
+def fetch_papers_after(
+    readers: ReaderPool, write_seq: Optional[int], columns: list[str]
+) -> list[tuple]:
+    # rows written after `write_seq`, or all of them. by write_seq rather than rowid, a
+    # replaced paper gets a new write_seq but can get its old rowid back
+    where, params = ("WHERE write_seq > ?", (write_seq,)) if write_seq is not None else ("", ())
+    with readers.connection() as conn:
+        return conn.execute(
+            f"""
+            SELECT write_seq, {', '.join(columns)}, embedding FROM papers
+            {where} ORDER BY rowid
+        """,
+            params,
+        ).fetchall()
+
+
+def fetch_md_index(db_name: str) -> dict[str, tuple[float, int]]:
+    conn = sqlite3.connect(db_name)
+    rows = conn.execute("SELECT path, mtime, size FROM md_files")
+    index = {path: (mtime, size) for path, mtime, size in rows}
+    conn.close()
+    return index
+
+
+def update_md_index(
+    changed: list[tuple[str, float, float, int, set[str]]], removed: list[str], db_name: str
+):
+    if not changed and not removed:
+        return
+
+    conn = sqlite3.connect(db_name)
+    with conn:
+        stale = [(path,) for path in removed] + [(path,) for path, *_ in changed]
+        conn.executemany("DELETE FROM md_files WHERE path = ?", stale)
+        conn.executemany("DELETE FROM md_links WHERE path = ?", stale)
+        conn.executemany(
+            "INSERT INTO md_files (path, mtime, ctime, size) VALUES (?, ?, ?, ?)",
+            [(path, mtime, ctime, size) for path, mtime, ctime, size, _ in changed],
+        )
+        conn.executemany(
+            "INSERT INTO md_links (path, url) VALUES (?, ?)",
+            [(path, url) for path, *_, links in changed for url in links],
+        )
+    conn.close()
+
+
+def fetch_unsaved_links(
+    db_name: str, paths: Optional[list[str]] = None
+) -> list[tuple[str, MyFile]]:
+    # links from the md index that have no papers row yet and aren't a known duplicate of
+    # one, in a single query. with `paths`, only the links of those notes
     conn = sqlite3.connect(db_name)
+    query = """
+        SELECT l.url, f.path, f.ctime, f.mtime
+        FROM md_links l JOIN md_files f ON f.path = l.path
+        WHERE NOT EXISTS (SELECT 1 FROM papers p WHERE p.url = l.url)
+        AND NOT EXISTS (SELECT 1 FROM paper_aliases a WHERE a.url = l.url)
+    """
+    if paths is None:
+        rows = conn.execute(query + " ORDER BY f.path").fetchall()
+    else:
+        rows = []
+        # under sqlite's limit on bound parameters
+        for i in range(0, len(paths), 500):
+            batch = paths[i : i + 500]
+            rows += conn.execute(
+                query + f" AND l.path IN ({', '.join('?' * len(batch))}) ORDER BY f.path", batch
+            ).fetchall()
+    conn.close()
+    return [(url, MyFile(path, ctime, mtime)) for url, path, ctime, mtime in rows]
 
+
+def fetch_papers_to_recheck(db_name: str) -> list[tuple[str, str, str, MyFile]]:
+    conn = sqlite3.connect(db_name)
     c = conn.cursor()
-    c.execute("SELECT url FROM papers WHERE url = ?", (url,))
-    exists = c.fetchone() is not None
+    c.execute(
+        """
+        SELECT v.url, v.etag, v.last_modified, p.file_path, p.created_at, p.updated_at
+        FROM http_validators v JOIN papers p ON p.url = v.url
+        ORDER BY v.checked_at
+    """
+    )
+    rows = [(url, etag, modified, MyFile(*file_info)) for url, etag, modified, *file_info in c]
+    conn.close()
+    return rows
+
+
+def fetch_incomplete_papers(db_name: str) -> list[tuple[str, str, MyFile]]:
+    conn = sqlite3.connect(db_name)
+    rows = conn.execute(
+        """
+        SELECT url, pdf_sha256, file_path, created_at, updated_at FROM papers
+        WHERE text_complete = 0 AND pdf_sha256 IS NOT NULL
+    """
+    ).fetchall()
+    conn.close()
+    return [(url, sha256, MyFile(*file_info)) for url, sha256, *file_info in rows]
+
+
+def mark_paper_checked(url: str, db_name: str):
+    conn = sqlite3.connect(db_name)
+    conn.execute("UPDATE http_validators SET checked_at = ? WHERE url = ?", (time.time(), url))
+    conn.commit()
     conn.close()
-    return exists
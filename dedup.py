@@ -0,0 +1,277 @@
+import re, sqlite3, time, zlib
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import numpy as np
+from models import MyFile
+
+# the same paper is often linked more than once: an arxiv abs and pdf link, two versions,
+# a mirror, a url with tracking params. a link is checked three times before it costs an
+# api call, by its normalized url before the download, by the pdf's sha256 after it, and
+# by a simhash of the text after extraction. a duplicate is stored in paper_aliases,
+# pointing at the paper it duplicates, instead of being processed again
+
+SHINGLE_WORDS = 3
+FINGERPRINT_CHARS = 100_000  #  text hashed, enough to tell papers apart and keep it ~20ms
+MIN_FINGERPRINT_WORDS = 50  #   shorter texts (scans, cover pages) all look alike
+MAX_DISTANCE = 3  #             bits of 64 two texts can differ by and be the same paper
+BANDS = 4  #                    MAX_DISTANCE + 1, two close hashes share at least one band
+BAND_BITS = 64 // BANDS
+FILL_BATCH = 200  #             papers fingerprinted per commit when filling in old ones
+
+# query params that only say where a link was clicked
+TRACKING_PARAMS = re.compile(r"^(utm_\w+|fbclid|gclid|ref|ref_src|source|via)$")
+ARXIV_HOSTS = {"arxiv.org", "export.arxiv.org", "xxx.lanl.gov"}
+# new style 2101.00001 and old style hep-th/9901001 ids, with an optional version
+ARXIV_PATH = re.compile(
+    r"^/(?:abs|pdf)/((?:\d{4}\.\d{4,5})|(?:[a-z\-]+(?:\.[A-Z]{2})?/\d{7}))(?:v\d+)?(?:\.pdf)?/?$"
+)
+
+
+def url_key(url: str) -> str:
+    # links that point at the same paper get the same key
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+
+    match = ARXIV_PATH.match(parts.path)
+    if host in ARXIV_HOSTS and match:
+        return f"arxiv:{match.group(1)}"
+
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not TRACKING_PARAMS.match(name)
+    )
+    # the scheme and fragment never change which pdf comes back
+    return urlunsplit(("https", host, parts.path.rstrip("/") or "/", urlencode(query), ""))
+
+
+def simhash(text: Optional[str]) -> Optional[int]:
+    # a 64 bit simhash of the text's word shingles, near identical texts get hashes a few
+    # bits apart. None when there is too little text to tell papers apart
+    words = re.findall(r"\w+", (text or "")[:FINGERPRINT_CHARS].lower())
+    if len(words) < MIN_FINGERPRINT_WORDS:
+        return None
+
+    # crc32 is stable across runs, unlike hash(). shingles are mixed from their words'
+    # hashes in numpy rather than hashed one by one
+    hashes = np.fromiter((zlib.crc32(word.encode()) for word in words), np.uint64, len(words))
+    shingles = np.zeros(len(words) - SHINGLE_WORDS + 1, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for i in range(SHINGLE_WORDS):
+            shingles = _mix(shingles ^ hashes[i : len(hashes) - SHINGLE_WORDS + 1 + i])
+
+    bits = (shingles[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    ones = bits.sum(axis=0)
+    value = 0
+    for i in np.flatnonzero(ones * 2 > len(shingles)):
+        value |= 1 << int(i)
+    # sqlite integers are signed
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def distance(a: int, b: int) -> int:
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+def bands(value: int) -> list[tuple[int, int]]:
+    unsigned = value & ((1 << 64) - 1)
+    mask = (1 << BAND_BITS) - 1
+    return [(band, (unsigned >> (band * BAND_BITS)) & mask) for band in range(BANDS)]
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    # splitmix64's finalizer
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def create_dedup_tables(c: sqlite3.Cursor):
+    # a text's simhash split in BANDS bands, near duplicates are found by an exact band match
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS paper_fingerprints (
+            band INTEGER,
+            bits INTEGER,
+            url TEXT,
+            simhash INTEGER,
+            PRIMARY KEY (band, bits, url)
+        )
+    """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS paper_fingerprints_url ON paper_fingerprints (url)")
+    # links that weren't processed, they are the same paper as canonical_url
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS paper_aliases (
+            url TEXT PRIMARY KEY,
+            canonical_url TEXT,
+            reason TEXT,
+            file_path TEXT,
+            created_at FLOAT
+        )
+    """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS paper_aliases_canonical ON paper_aliases (canonical_url)")
+    c.execute("CREATE INDEX IF NOT EXISTS papers_url_key ON papers (url_key)")
+    c.execute("CREATE INDEX IF NOT EXISTS papers_pdf_sha256 ON papers (pdf_sha256)")
+
+
+def fill_url_keys(conn: sqlite3.Connection):
+    # papers and queued links from before url_key existed
+    for table in ("papers", "work_queue"):
+        rows = conn.execute(f"SELECT url FROM {table} WHERE url_key IS NULL").fetchall()
+        conn.executemany(
+            f"UPDATE {table} SET url_key = ? WHERE url = ?", [(url_key(u), u) for (u,) in rows]
+        )
+    conn.commit()
+
+
+def find_duplicate(
+    conn: sqlite3.Connection,
+    url: str,
+    key: Optional[str] = None,
+    pdf_sha256: Optional[str] = None,
+    fingerprint: Optional[int] = None,
+) -> Optional[tuple[str, str]]:
+    # the url of a stored paper, or of a link queued before this one, that `url` is the same
+    # paper as, and why. failed papers don't count, another link to them might work
+    if key is not None:
+        row = conn.execute(
+            """
+            SELECT url FROM papers
+            WHERE url_key = ? AND url != ? AND status LIKE 'success%' LIMIT 1
+        """,
+            (key, url),
+        ).fetchone()
+        row = (
+            row
+            or conn.execute(
+                """
+            SELECT url FROM work_queue
+            WHERE url_key = ? AND url != ? AND next_attempt_at IS NOT NULL
+            AND rowid < (SELECT rowid FROM work_queue WHERE url = ?) LIMIT 1
+        """,
+                (key, url, url),
+            ).fetchone()
+        )
+        if row:
+            return row[0], "url"
+
+    if pdf_sha256 is not None:
+        row = conn.execute(
+            "SELECT url FROM papers WHERE pdf_sha256 = ? AND url != ? LIMIT 1", (pdf_sha256, url)
+        ).fetchone()
+        # queued links get here in whatever order their downloads finish, first one wins
+        row = (
+            row
+            or conn.execute(
+                """
+            SELECT url FROM work_queue
+            WHERE pdf_sha256 = ? AND url != ? AND next_attempt_at IS NOT NULL LIMIT 1
+        """,
+                (pdf_sha256, url),
+            ).fetchone()
+        )
+        if row:
+            return row[0], "pdf"
+
+    if fingerprint is not None:
+        pairs = bands(fingerprint)
+        candidates = conn.execute(
+            f"""
+            SELECT DISTINCT url, simhash FROM paper_fingerprints
+            WHERE (band, bits) IN (VALUES {", ".join(["(?, ?)"] * len(pairs))})
+            AND url != ?
+        """,
+            (*[value for pair in pairs for value in pair], url),
+        ).fetchall()
+        candidates += conn.execute(
+            """
+            SELECT url, simhash FROM work_queue
+            WHERE simhash IS NOT NULL AND url != ? AND next_attempt_at IS NOT NULL
+        """,
+            (url,),
+        ).fetchall()
+        for other, other_hash in candidates:
+            if distance(fingerprint, other_hash) <= MAX_DISTANCE:
+                return other, "text"
+
+    return None
+
+
+def add_fingerprint(conn: sqlite3.Connection, url: str, fingerprint: Optional[int]):
+    conn.execute("DELETE FROM paper_fingerprints WHERE url = ?", (url,))
+    if fingerprint is not None:
+        conn.executemany(
+            "INSERT INTO paper_fingerprints (band, bits, url, simhash) VALUES (?, ?, ?, ?)",
+            [(band, bits, url, fingerprint) for band, bits in bands(fingerprint)],
+        )
+
+
+def add_alias(conn: sqlite3.Connection, url: str, canonical_url: str, reason: str, my_file: MyFile):
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO paper_aliases (url, canonical_url, reason, file_path, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+        (url, canonical_url, reason, my_file.full_path, time.time()),
+    )
+    # links that were aliased to `url` follow it
+    conn.execute(
+        "UPDATE paper_aliases SET canonical_url = ? WHERE canonical_url = ?", (canonical_url, url)
+    )
+
+
+def pop_aliases(conn: sqlite3.Connection, canonical_url: str) -> list[tuple[str, MyFile]]:
+    # the links skipped as the same paper as `canonical_url`, which failed. they're no longer
+    # aliases, one of them may be a mirror that works. links no note has anymore are dropped
+    rows = conn.execute(
+        """
+        SELECT a.url, f.path, f.ctime, f.mtime
+        FROM paper_aliases a
+        JOIN md_links l ON l.url = a.url JOIN md_files f ON f.path = l.path
+        WHERE a.canonical_url = ?
+        ORDER BY f.path
+    """,
+        (canonical_url,),
+    ).fetchall()
+    conn.execute("DELETE FROM paper_aliases WHERE canonical_url = ?", (canonical_url,))
+    jobs = {}
+    for url, path, ctime, mtime in rows:
+        jobs.setdefault(url, MyFile(path, ctime, mtime))
+    return list(jobs.items())
+
+
+def fill_fingerprints(conn: sqlite3.Connection):
+    # papers stored before fingerprints existed. done a batch at a time, the last rowid
+    # done is kept in counters so an interrupted fill picks up there, and -1 once it's over
+    conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('fingerprints', 0)")
+    done = conn.execute("SELECT value FROM counters WHERE name = 'fingerprints'").fetchone()[0]
+    if done < 0:
+        return
+
+    count = conn.execute(
+        "SELECT COUNT(*) FROM papers WHERE rowid > ? AND status LIKE 'success%'", (done,)
+    ).fetchone()[0]
+    if count:
+        print(f"fingerprinting the text of {count} papers for duplicate detection")
+    while rows := conn.execute(
+        """
+        SELECT rowid, url, substr(text, 1, ?) FROM papers
+        WHERE rowid > ? AND status LIKE 'success%'
+        ORDER BY rowid LIMIT ?
+    """,
+        (FINGERPRINT_CHARS, done, FILL_BATCH),
+    ).fetchall():
+        for _, url, text in rows:
+            add_fingerprint(conn, url, simhash(text))
+        done = rows[-1][0]
+        conn.execute("UPDATE counters SET value = ? WHERE name = 'fingerprints'", (done,))
+        conn.commit()
+    conn.execute("UPDATE counters SET value = -1 WHERE name = 'fingerprints'")
+    conn.commit()
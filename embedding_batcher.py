@@ -0,0 +1,135 @@
+import logging
+from typing import Iterator, Optional
+import tiktoken
+import numpy as np
+from tenacity import retry, wait_random_exponential, stop_after_attempt
+from metrics import STAGE_SECONDS, count_retry, count_usage
+
+# limits of the embeddings endpoint, https://platform.openai.com/docs/api-reference/embeddings
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300_000
+MAX_TOKENS_PER_INPUT = 8191
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        client,
+        model: str,
+        max_inputs: int = MAX_INPUTS_PER_REQUEST,
+        max_tokens: int = MAX_TOKENS_PER_REQUEST,
+        encoding: Optional[tiktoken.Encoding] = None,
+        cache=None,
+        api=None,
+    ):
+        self.client = client
+        # an async_api.AsyncApi, when set every batch of one embed() call is sent at once
+        self.api = api
+        self.model = model
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self._encoding = encoding
+        self.cache = cache
+        self.requests_sent = 0
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        # loaded lazily, tiktoken downloads the bpe file on first use
+        if self._encoding is None:
+            self._encoding = tiktoken.encoding_for_model(self.model)
+        return self._encoding
+
+    def embed(
+        self, texts: list[str], token_counts: Optional[list[int]] = None
+    ) -> list[list[float]]:
+        embeddings: list[list[float]] = [[] for _ in texts]
+        if token_counts is None:
+            inputs = [self._fit(text) for text in texts]
+        else:
+            # callers that already tokenized (the chunker) skip a second encode
+            inputs = [
+                (text, n) if n <= MAX_TOKENS_PER_INPUT else self._fit(text)
+                for text, n in zip(texts, token_counts)
+            ]
+
+        keys = (
+            [self.cache.key("embed", self.model, text) for text, _ in inputs] if self.cache else []
+        )
+        pending = []
+        for i, (text, n_tokens) in enumerate(inputs):
+            cached = self.cache.get(keys[i]) if self.cache and text else None
+            if cached is not None:
+                embeddings[i] = np.frombuffer(cached, dtype=np.float32).tolist()
+            else:
+                pending.append(i)
+
+        batches = list(self._pack([(i, *inputs[i]) for i in pending]))
+        if self.api is not None:
+            self.requests_sent += len(batches)
+            results = self.api.gather(
+                [
+                    self.api.embed(
+                        self.model, [inputs[i][0] for i in batch], sum(inputs[i][1] for i in batch)
+                    )
+                    for batch in batches
+                ]
+            )
+        else:
+            # lazily, so each batch is cached before the next one is sent
+            results = (self._create([inputs[i][0] for i in batch]) for batch in batches)
+
+        for batch, vectors in zip(batches, results):
+            for i, vector in zip(batch, vectors):
+                embeddings[i] = vector
+            if self.cache:
+                # a commit per request, not per vector
+                self.cache.put_many(
+                    [
+                        (keys[i], np.asarray(vector, dtype=np.float32).tobytes())
+                        for i, vector in zip(batch, vectors)
+                    ]
+                )
+
+        return embeddings
+
+    def _fit(self, text: str) -> tuple[str, int]:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) > MAX_TOKENS_PER_INPUT:
+            logging.info(f"truncating embedding input from {len(tokens)} tokens")
+            tokens = tokens[:MAX_TOKENS_PER_INPUT]
+            text = self.encoding.decode(tokens)
+        return text, len(tokens)
+
+    def _pack(self, inputs: list[tuple[int, str, int]]) -> Iterator[list[int]]:
+        batch: list[int] = []
+        batch_tokens = 0
+        for i, text, n_tokens in inputs:
+            if not text:
+                # the endpoint rejects empty strings, these keep an empty embedding
+                continue
+            if batch and (
+                len(batch) >= self.max_inputs or batch_tokens + n_tokens > self.max_tokens
+            ):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += n_tokens
+
+        if batch:
+            yield batch
+
+    @retry(
+        wait=wait_random_exponential(min=1, max=10),
+        stop=stop_after_attempt(5),
+        before_sleep=count_retry("embeddings"),
+    )
+    def _create(self, texts: list[str]) -> list[list[float]]:
+        self.requests_sent += 1
+        with STAGE_SECONDS.time(stage="embed"):
+            response = self.client.embeddings.create(model=self.model, input=texts)
+        count_usage("embeddings", response)
+        # results carry the index of their input, don't rely on the response order
+        data = sorted(response.data, key=lambda d: d.index)
+        if len(data) != len(texts):
+            raise ValueError(f"expected {len(texts)} embeddings, got {len(data)}")
+        return [d.embedding for d in data]
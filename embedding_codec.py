@@ -0,0 +1,148 @@
+import struct
+from typing import Optional, Sequence
+import numpy as np
+
+# embeddings are stored in one of two layouts:
+# - legacy: raw little endian float32, no header. every row written before this module,
+#   and still the default since it's what datasette-faiss reads
+# - versioned: a 16 byte header followed by the values
+#       magic (4) | version (u8) | dtype (u8) | reserved (u16) | dim (u32) | scale (f32)
+#   the magic reads as a NaN when taken as float32, which an embedding never contains,
+#   so it can't be mistaken for the start of a legacy row
+MAGIC = b"PW\xff\x7f"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHIf")
+
+FORMATS = {"float32": 0, "float16": 1, "int8": 2}
+DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2"), 2: np.dtype("i1")}
+LEGACY = -1
+
+
+def encode_embedding(vector: Sequence[float], fmt: str = "float32") -> bytes:
+    values = np.asarray(vector, dtype=np.float32)
+    if fmt == "float32":
+        return values.astype("<f4").tobytes()
+
+    code = FORMATS[fmt]
+    scale = 1.0
+    if code == FORMATS["int8"]:
+        # symmetric per vector quantization
+        peak = float(np.max(np.abs(values))) if values.size else 0.0
+        scale = peak / 127 if peak > 0 else 1.0
+        stored = np.clip(np.rint(values / scale), -127, 127).astype("i1")
+    else:
+        stored = values.astype(DTYPES[code])
+
+    return HEADER.pack(MAGIC, VERSION, code, 0, values.shape[0], scale) + stored.tobytes()
+
+
+def decode_embedding(blob: bytes) -> np.ndarray:
+    matrix, valid = decode_embeddings([blob])
+    if not valid[0]:
+        if blob and _layout(blob) == LEGACY:
+            raise ValueError("The blob length is not a multiple of 4.")
+        return np.zeros(0, dtype=np.float32)
+    return matrix[0]
+
+
+def decode_embeddings(
+    blobs: Sequence[Optional[bytes]], dim: Optional[int] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    # decodes a whole column at once, rows of the same layout are joined and read with a
+    # single np.frombuffer. returns an (n, dim) float32 matrix and a mask of the rows
+    # that held a usable embedding
+    fast = _decode_uniform(blobs, dim)
+    if fast is not None:
+        return fast
+
+    layouts = [_layout(blob) if blob else None for blob in blobs]
+    if dim is None:
+        dim = next((_dim(blob, layout) for blob, layout in zip(blobs, layouts) if blob), 0)
+
+    matrix = np.zeros((len(blobs), dim), dtype=np.float32)
+    valid = np.zeros(len(blobs), dtype=bool)
+    if dim == 0:
+        return matrix, valid
+
+    groups: dict[int, list[int]] = {}
+    for i, (blob, layout) in enumerate(zip(blobs, layouts)):
+        if blob and _dim(blob, layout) == dim and _size_ok(blob, layout, dim):
+            groups.setdefault(layout, []).append(i)
+
+    for layout, rows in groups.items():
+        joined = b"".join(blobs[i] for i in rows)
+        if layout == LEGACY:
+            values = np.frombuffer(joined, dtype="<f4").reshape(len(rows), dim)
+            matrix[rows] = values
+        else:
+            record = np.dtype(
+                [("header", "V12"), ("scale", "<f4"), ("values", DTYPES[layout], (dim,))]
+            )
+            records = np.frombuffer(joined, dtype=record)
+            values = records["values"].astype(np.float32)
+            if layout == FORMATS["int8"]:
+                values *= records["scale"][:, None]
+            matrix[rows] = values
+        valid[rows] = True
+
+    return matrix, valid
+
+
+def _decode_uniform(
+    blobs: Sequence[Optional[bytes]], dim: Optional[int]
+) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    # every row the same length and layout, which is what a column written by one
+    # configuration looks like. legacy rows come back as a read only zero copy view
+    lengths = {len(blob) if blob else 0 for blob in blobs}
+    if len(lengths) != 1 or 0 in lengths:
+        return None
+
+    length = lengths.pop()
+    if length < HEADER.size:
+        return None
+
+    joined = b"".join(blobs)
+    raw = np.frombuffer(joined, dtype=np.uint8).reshape(len(blobs), length)
+    magic = (raw[:, :4] == np.frombuffer(MAGIC, dtype=np.uint8)).all(axis=1)
+    valid = np.ones(len(blobs), dtype=bool)
+
+    if not magic.any():
+        if length % 4 or (dim is not None and dim != length // 4):
+            return None
+        return np.frombuffer(joined, dtype="<f4").reshape(len(blobs), length // 4), valid
+
+    layouts = np.unique(raw[:, 5])
+    if not magic.all() or len(layouts) != 1 or int(layouts[0]) not in DTYPES:
+        return None
+
+    layout = int(layouts[0])
+    row_dim = (length - HEADER.size) // DTYPES[layout].itemsize
+    if dim is not None and dim != row_dim:
+        return None
+
+    record = np.dtype([("header", "V12"), ("scale", "<f4"), ("values", DTYPES[layout], (row_dim,))])
+    records = np.frombuffer(joined, dtype=record)
+    values = records["values"].astype(np.float32)
+    if layout == FORMATS["int8"]:
+        values *= records["scale"][:, None]
+    return values, valid
+
+
+def _layout(blob: bytes) -> int:
+    if len(blob) >= HEADER.size and blob[:4] == MAGIC:
+        return blob[5]
+    return LEGACY
+
+
+def _dim(blob: bytes, layout: int) -> int:
+    if layout == LEGACY:
+        return len(blob) // 4
+    return HEADER.unpack_from(blob)[4]
+
+
+def _size_ok(blob: bytes, layout: int, dim: int) -> bool:
+    if layout == LEGACY:
+        return len(blob) == dim * 4
+    if layout not in DTYPES:
+        return False
+    return len(blob) == HEADER.size + dim * DTYPES[layout].itemsize
@@ -0,0 +1,203 @@
+import json, logging, os, sqlite3, time
+from typing import Iterator, Optional
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from db import connect
+from embedding_codec import decode_embeddings
+
+EXPORT_BATCH_SIZE = 2_000  #    rows per record batch, about 12MB of 1536 dim embeddings
+TEXT_BATCH_SIZE = 100  #        with text, which can be 1MB a row
+STATE_FILE = "export_state.json"
+
+# the columns exported, in order, with their arrow type. everything but the pdf and
+# thumbnail bytes, which stay in the blob store and are referenced by their sha256
+COLUMNS = {
+    "url": pa.string(),
+    "status": pa.string(),
+    "title": pa.string(),
+    "authors": pa.list_(pa.string()),
+    "keywords": pa.list_(pa.string()),
+    "abstract": pa.string(),
+    "published_date": pa.string(),
+    "summary": pa.string(),
+    "institution": pa.string(),
+    "location": pa.string(),
+    "file_path": pa.string(),
+    "created_at": pa.timestamp("us", tz="UTC"),
+    "updated_at": pa.timestamp("us", tz="UTC"),
+    "written_at": pa.timestamp("us", tz="UTC"),
+    "write_seq": pa.int64(),
+    "text_complete": pa.bool_(),
+    "pdf_sha256": pa.string(),
+    "thumbnail_sha256": pa.string(),
+}
+TIMESTAMPS = ["created_at", "updated_at", "written_at"]
+
+
+def export_papers(
+    db_name: str,
+    path: str,
+    fmt: str = "parquet",
+    incremental: bool = False,
+    include_text: bool = False,
+    batch_size: Optional[int] = None,
+) -> int:
+    # streams papers to a parquet or arrow ipc file a batch at a time, memory stays at
+    # one batch whatever the library size. incremental exports go to a directory, one
+    # part per run with the rows written since the last one
+    batch_size = batch_size or (TEXT_BATCH_SIZE if include_text else EXPORT_BATCH_SIZE)
+    conn = connect(db_name, read_only=True)
+    try:
+        # one read transaction, the export is a consistent snapshot while the pipeline writes
+        conn.execute("BEGIN")
+        since = None
+        target = path
+        if incremental:
+            os.makedirs(path, exist_ok=True)
+            since = _read_state(path).get("write_seq")
+            target = os.path.join(path, f"part-{int(time.time() * 1000)}.{fmt}")
+
+        schema = papers_schema(embedding_dim(conn), include_text, fixed=fmt == "arrow")
+        high_water = conn.execute("SELECT COALESCE(MAX(write_seq), 0) FROM papers").fetchone()[0]
+        batches = record_batches(conn, schema, batch_size, since)
+        rows = write_batches(batches, schema, target, fmt)
+    finally:
+        conn.close()
+
+    if incremental:
+        if rows == 0:
+            os.remove(target)
+        # 0 when every row predates write_seq, they were all in this first part
+        _write_state(path, {"write_seq": max(high_water, since or 0)})
+    print(f"exported {rows} papers to {target if rows or not incremental else path}")
+    return rows
+
+
+def papers_schema(dim: int, include_text: bool, fixed: bool = True) -> pa.Schema:
+    fields = [pa.field(name, kind) for name, kind in COLUMNS.items()]
+    if include_text:
+        fields.append(pa.field("text", pa.large_string()))
+    # fixed size, the column is one contiguous float32 buffer a reader can view as (n, dim).
+    # parquet can't write a null fixed size list, it gets a plain list that casts back to one
+    if not dim:
+        embedding = pa.null()
+    elif fixed:
+        embedding = pa.list_(pa.float32(), dim)
+    else:
+        embedding = pa.list_(pa.float32())
+    fields.append(pa.field("embedding", embedding))
+    return pa.schema(fields, metadata={"embedding_dim": str(dim)})
+
+
+def embedding_dim(conn: sqlite3.Connection) -> int:
+    # the dimension of the first stored embedding, rows of another one export as null
+    row = conn.execute(
+        "SELECT embedding FROM papers WHERE length(embedding) > 0 LIMIT 1"
+    ).fetchone()
+    if row is None:
+        return 0
+    vectors, valid = decode_embeddings([row[0]])
+    return vectors.shape[1] if valid[0] else 0
+
+
+def record_batches(
+    conn: sqlite3.Connection, schema: pa.Schema, batch_size: int, since: Optional[int] = None
+) -> Iterator[pa.RecordBatch]:
+    names = [name for name in schema.names if name != "embedding"]
+    query = f"SELECT {', '.join(names)}, embedding FROM papers"
+    params: tuple = ()
+    if since is not None:
+        # rows from before write_seq existed were in the first export
+        query += " WHERE write_seq > ?"
+        params = (since,)
+    cursor = conn.execute(query + " ORDER BY rowid", params)
+
+    dim = int(schema.metadata[b"embedding_dim"])
+    fixed = isinstance(schema.field("embedding").type, pa.FixedSizeListType)
+    skipped = 0
+    while rows := cursor.fetchmany(batch_size):
+        columns = list(zip(*rows))
+        arrays = []
+        for name, values in zip(names, columns):
+            if name in ("authors", "keywords"):
+                values = [_json_list(value) for value in values]
+            elif name in TIMESTAMPS:
+                values = [None if value is None else int(value * 1_000_000) for value in values]
+            elif name == "text_complete":
+                values = [None if value is None else value != 0 for value in values]
+            arrays.append(pa.array(values, type=schema.field(name).type))
+
+        embeddings, skipped_now = _embedding_array(columns[-1], dim, fixed)
+        skipped += skipped_now
+        arrays.append(embeddings)
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    if skipped:
+        logging.info(f"{skipped} embeddings didn't decode to {dim} dimensions, exported as null")
+
+
+def write_batches(batches: Iterator[pa.RecordBatch], schema: pa.Schema, path: str, fmt: str) -> int:
+    rows = 0
+    if fmt == "arrow":
+        # the ipc file format uncompressed, pa.memory_map() reads it without a copy
+        with pa.OSFile(path, "wb") as sink, ipc.new_file(sink, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    else:
+        with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+            for batch in batches:
+                # a row group per batch, readers can skip through the file by group
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    return rows
+
+
+def _embedding_array(blobs: tuple, dim: int, fixed: bool) -> tuple[pa.Array, int]:
+    if not dim:
+        return pa.nulls(len(blobs)), 0
+    vectors, valid = decode_embeddings(blobs, dim)
+    mask = pa.array(~valid)
+    if fixed:
+        values = pa.array(np.ascontiguousarray(vectors).reshape(-1))
+        array = pa.FixedSizeListArray.from_arrays(values, dim, mask=mask)
+    else:
+        # null rows get no values, offsets step by dim over the valid ones
+        offsets = np.concatenate([[0], np.cumsum(valid * dim)]).astype(np.int32)
+        values = pa.array(vectors[valid].reshape(-1))
+        array = pa.ListArray.from_arrays(pa.array(offsets), values, mask=mask)
+    # rows that had an embedding but not one this export could decode
+    return array, int(sum(1 for blob, ok in zip(blobs, valid) if blob and not ok))
+
+
+def _json_list(value: Optional[str]) -> Optional[list[str]]:
+    # authors and keywords are stored as json, usually a list of strings
+    if value is None:
+        return None
+    try:
+        parsed = json.loads(value)
+    except (TypeError, ValueError):
+        return [value]
+    if parsed is None:
+        return None
+    if isinstance(parsed, list):
+        return [str(item) for item in parsed if item is not None]
+    return [str(parsed)]
+
+
+def _read_state(directory: str) -> dict:
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_state(directory: str, state: dict):
+    # written once the part is complete, an export that dies halfway is redone next time
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,208 @@
+import logging, multiprocessing, os, queue, threading
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional, Union
+from metrics import STAGE_SECONDS
+
+EXTRACT_TIMEOUT = 120  #                    seconds per pdf before its worker is killed
+EXTRACT_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024  #    ~2GB of address space per worker
+MAX_TASKS_PER_WORKER = 200  #               workers are replaced after this many pdfs
+
+
+class ExtractError(Exception):
+    pass
+
+
+class ExtractTimeoutError(ExtractError):
+    pass
+
+
+class WorkerDiedError(ExtractError):
+    pass
+
+
+# pdfs are parsed in separate processes so PyMuPDF never holds this process' GIL, and a
+# pdf that hangs or eats all memory only takes down its own worker. each worker is a
+# spawned process with a pipe, it is killed and replaced on timeout, crash or MemoryError
+class ExtractPool:
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        timeout: float = EXTRACT_TIMEOUT,
+        memory_limit: Optional[int] = EXTRACT_MEMORY_LIMIT,
+    ):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        # spawn rather than fork, the dash thread and downloaders are already running
+        self._context = multiprocessing.get_context("spawn")
+        self._idle: queue.Queue = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def extract(
+        self, source: Union[str, bytes, bytearray], **options
+    ) -> tuple[str, Optional[bytes], bool]:
+        # text, png thumbnail and whether the text is complete, given a path or the pdf's
+        # bytes. `options` go to text_extractor.read_pdf
+        # waiting for a free worker isn't parse time
+        worker = self._checkout()
+        with STAGE_SECONDS.time(stage="parse"):
+            shm = None
+            try:
+                if isinstance(source, str):
+                    task = ("path", source, 0, options)
+                else:
+                    # in memory pdfs go through shared memory, not pickled down the pipe
+                    shm = shared_memory.SharedMemory(create=True, size=max(1, len(source)))
+                    shm.buf[: len(source)] = source
+                    task = ("shm", shm.name, len(source), options)
+
+                try:
+                    worker.conn.send(task)
+                except (BrokenPipeError, OSError):
+                    # died while idle, killed by the oom killer or crashed between tasks
+                    exitcode = worker.kill()
+                    worker = None
+                    raise WorkerDiedError(f"idle worker exited with {exitcode}")
+                if not worker.conn.poll(self.timeout):
+                    worker.kill()
+                    worker = None
+                    raise ExtractTimeoutError(f"no result after {self.timeout}s")
+
+                try:
+                    status, result = worker.conn.recv()
+                except (EOFError, OSError):
+                    exitcode = worker.kill()
+                    worker = None
+                    raise WorkerDiedError(f"worker exited with {exitcode}")
+
+                if status == "ok":
+                    return result
+                if status == "memory":
+                    worker.kill()
+                    worker = None
+                raise ExtractError(result)
+            finally:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+                self._checkin(worker)
+
+    def close(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            worker.stop()
+        with self._lock:
+            self._started = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _checkout(self) -> "_Worker":
+        with self._lock:
+            if self._idle.empty() and self._started < self.workers:
+                self._started += 1
+                start = True
+            else:
+                start = False
+
+        if not start:
+            return self._idle.get()
+        try:
+            return _Worker(self._context, self.memory_limit)
+        except BaseException:
+            with self._lock:
+                self._started -= 1
+            raise
+
+    def _checkin(self, worker: Optional["_Worker"]):
+        if worker is not None:
+            worker.tasks += 1
+            if worker.tasks < MAX_TASKS_PER_WORKER:
+                self._idle.put(worker)
+                return
+            worker.stop()
+
+        # the slot is refilled by the next extract that finds no idle worker
+        with self._lock:
+            self._started -= 1
+
+
+class _Worker:
+    def __init__(self, context, memory_limit: Optional[int]):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, memory_limit), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def kill(self) -> Optional[int]:
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        return self.process.exitcode
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+            self.process.join(timeout=5)
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+
+
+def _worker_main(conn, memory_limit: Optional[int]):
+    if memory_limit:
+        try:
+            import resource
+
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        except (ImportError, ValueError, OSError) as e:
+            # no RLIMIT_AS on windows and macos, the timeout still applies
+            logging.info(f"can't cap extract worker memory: {e}")
+
+    from text_extractor import extract_pdf_contents
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+
+        kind, name, size, options = task
+        try:
+            conn.send(("ok", extract_pdf_contents(_task_source(kind, name, size), **options)))
+        except MemoryError as e:
+            conn.send(("memory", f"MemoryError: {e}"))
+            return
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def _task_source(kind: str, name: str, size: int) -> Union[str, bytes]:
+    if kind == "path":
+        return name
+    # on linux shared memory is a file, so fitz can read it without a copy
+    if os.path.exists(f"/dev/shm/{name}"):
+        return f"/dev/shm/{name}"
+
+    shm = shared_memory.SharedMemory(name=name)
+    # the parent owns and unlinks it
+    resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
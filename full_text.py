@@ -0,0 +1,130 @@
+import sqlite3
+from dataclasses import dataclass
+
+# columns of papers_fts, in order, and how much a match in each counts towards the rank
+FTS_COLUMNS = ["title", "authors", "keywords", "abstract", "summary", "text"]
+FTS_WEIGHTS = [10.0, 5.0, 5.0, 3.0, 2.0, 1.0]
+SNIPPET_TOKENS = 24
+# matches ranked per query. a query matching more papers than this, one made of words in
+# nearly every paper, only ranks the ones it matches in HEAD_COLUMNS, bm25 over all 50k would
+# take ~150ms. a match there outweighs one in the text
+RANK_WINDOW = 5000
+HEAD_COLUMNS = ["title", "authors", "keywords", "abstract"]
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+
+@dataclass
+class SearchHit:
+    url: str
+    title: str
+    # text around the best match, matched terms between HIGHLIGHT_START and HIGHLIGHT_END
+    snippet: str
+    # bm25, higher is a better match
+    score: float
+
+
+def create_fts_index(c: sqlite3.Cursor):
+    # an external content fts5 table over papers, it stores the index but not the text.
+    # triggers keep it in sync with every write to papers, whichever connection does it
+    exists = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'papers_fts'"
+    ).fetchone()
+    c.execute(
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(
+            {", ".join(FTS_COLUMNS)},
+            content = 'papers', content_rowid = 'rowid',
+            tokenize = 'porter unicode61 remove_diacritics 2'
+        )
+    """
+    )
+    columns = ", ".join(FTS_COLUMNS)
+    new_values = ", ".join(f"new.{column}" for column in FTS_COLUMNS)
+    old_values = ", ".join(f"old.{column}" for column in FTS_COLUMNS)
+    c.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS papers_fts_insert AFTER INSERT ON papers BEGIN
+            INSERT INTO papers_fts (rowid, {columns}) VALUES (new.rowid, {new_values});
+        END
+    """
+    )
+    c.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS papers_fts_delete AFTER DELETE ON papers BEGIN
+            INSERT INTO papers_fts (papers_fts, rowid, {columns})
+            VALUES ('delete', old.rowid, {old_values});
+        END
+    """
+    )
+    # blob store migrations and rechecks that don't touch the text don't reindex it
+    c.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS papers_fts_update AFTER UPDATE OF {columns} ON papers BEGIN
+            INSERT INTO papers_fts (papers_fts, rowid, {columns})
+            VALUES ('delete', old.rowid, {old_values});
+            INSERT INTO papers_fts (rowid, {columns}) VALUES (new.rowid, {new_values});
+        END
+    """
+    )
+    weights = ", ".join(str(weight) for weight in FTS_WEIGHTS)
+    c.execute(f"INSERT INTO papers_fts (papers_fts, rank) VALUES ('rank', 'bm25({weights})')")
+
+    if not exists:
+        # papers written before the index existed
+        count = c.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+        if count:
+            print(f"indexing the text of {count} papers for full text search")
+        c.execute("INSERT INTO papers_fts (papers_fts) VALUES ('rebuild')")
+
+
+def search_papers(
+    conn: sqlite3.Connection, query: str, limit: int = 20, window: int = RANK_WINDOW
+) -> list[SearchHit]:
+    # bm25 ranked, best first. fts5 sorts by rank itself, so snippets are only built for
+    # the rows returned. a broad query, matching more than `window` papers, is ranked over
+    # HEAD_COLUMNS only: once `limit` papers match there, papers matching only in the
+    # summary or text aren't returned, even ones bm25 over every column would rank higher
+    if not query.strip():
+        return []
+    try:
+        return _search(conn, query, limit, window)
+    except sqlite3.OperationalError:
+        # not valid fts5 query syntax, search for the words as they are
+        return _search(conn, quote_query(query), limit, window)
+
+
+def quote_query(query: str) -> str:
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def _search(conn: sqlite3.Connection, query: str, limit: int, window: int) -> list[SearchHit]:
+    # counting matches walks the index without scoring them, it's cheap
+    matches = conn.execute(
+        "SELECT COUNT(*) FROM (SELECT rowid FROM papers_fts WHERE papers_fts MATCH ? LIMIT ?)",
+        (query, window + 1),
+    ).fetchone()[0]
+    if matches > window:
+        # ranked by bm25 over HEAD_COLUMNS only, where the query's words are still rare enough
+        # to tell papers apart. a rowid IN (...) filter on the full query would look up each
+        # rowid separately, fts5 can't combine it with MATCH
+        hits = _ranked(conn, f"{{{' '.join(HEAD_COLUMNS)}}} : ({query})", limit)
+        # too few head matches to fill the page, rank them all
+        if len(hits) >= limit:
+            return hits
+    return _ranked(conn, query, limit)
+
+
+def _ranked(conn: sqlite3.Connection, query: str, limit: int) -> list[SearchHit]:
+    rows = conn.execute(
+        """
+        SELECT p.url, p.title, snippet(papers_fts, -1, ?, ?, '…', ?), papers_fts.rank
+        FROM papers_fts JOIN papers p ON p.rowid = papers_fts.rowid
+        WHERE papers_fts MATCH ?
+        ORDER BY papers_fts.rank
+        LIMIT ?
+    """,
+        (HIGHLIGHT_START, HIGHLIGHT_END, SNIPPET_TOKENS, query, limit),
+    ).fetchall()
+    # fts5's bm25 is negative, best first
+    return [SearchHit(url, title or "", snippet or "", -rank) for url, title, snippet, rank in rows]
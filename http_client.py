@@ -0,0 +1,96 @@
+import threading, time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CONNECT_TIMEOUT = 10  #         seconds
+READ_TIMEOUT = 60  #            seconds between bytes, not for the whole body
+PER_HOST_CONCURRENCY = 2
+PER_HOST_RATE = 1.0  #          requests started per second
+POOL_SIZE = 32
+
+
+class HostLimiter:
+    def __init__(self, concurrency: int, rate: float):
+        self.slots = threading.BoundedSemaphore(max(1, concurrency))
+        self.interval = 1 / rate if rate > 0 else 0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    @contextmanager
+    def hold(self) -> Iterator[None]:
+        with self.slots:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start)
+                self._next_start = start + self.interval
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+
+# one pooled, keep-alive session shared by every download, with per host politeness
+class HttpClient:
+    def __init__(
+        self,
+        per_host_concurrency: int = PER_HOST_CONCURRENCY,
+        per_host_rate: float = PER_HOST_RATE,
+        pool_size: int = POOL_SIZE,
+        timeout: tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+    ):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = (
+            "paperweight (+https://github.com/phonetonote/paperweight)"
+        )
+        retries = Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=["GET"],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._limiters: dict[str, HostLimiter] = defaultdict(
+            lambda: HostLimiter(per_host_concurrency, per_host_rate)
+        )
+        self._limiters_lock = threading.Lock()
+
+    def limiter(self, url: str) -> HostLimiter:
+        host = urlsplit(url).netloc.lower()
+        with self._limiters_lock:
+            return self._limiters[host]
+
+    @contextmanager
+    def get(self, url: str, headers: Optional[dict] = None) -> Iterator[requests.Response]:
+        # the host slot is held until the body has been read, not just the headers
+        with self.limiter(url).hold():
+            with self.session.get(
+                url, headers=headers, stream=True, timeout=self.timeout
+            ) as response:
+                yield response
+
+    def close(self):
+        self.session.close()
+
+
+_default_client: Optional[HttpClient] = None
+_default_client_lock = threading.Lock()
+
+
+def default_http_client() -> HttpClient:
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HttpClient()
+        return _default_client
@@ -1,11 +1,40 @@
-import os, re, struct, logging
-from typing import Set
+import re, logging
+from typing import Iterator, Optional, Set
 from dotenv import load_dotenv
 from openai import OpenAI
 from models import MyFile, Paper, ProcessedPaper
-from db import insert_paper, check_paper_exists
-from text_extractor import fetch_and_extract_text_from_pdf
-import numpy as np
+from db import (
+    PaperWriter,
+    connect,
+    insert_paper,
+    fetch_incomplete_papers,
+    fetch_unsaved_links,
+    fetch_papers_to_recheck,
+    mark_paper_checked,
+)
+from blob_store import iter_blob
+from text_extractor import (
+    MAX_TEXT_SIZE,
+    THUMBNAIL_CLIP,
+    THUMBNAIL_SCALE,
+    NotModifiedError,
+    PdfSpool,
+    build_paper,
+    default_extract_pool,
+    download_pdf,
+)
+from extract_pool import ExtractPool
+from async_api import AsyncApi
+from http_client import HttpClient, default_http_client
+from pipeline import Pipeline
+from work_queue import MAX_ATTEMPTS, RETRY_DELAY, WorkItem, WorkQueue, has_due_work
+from embedding_batcher import EmbeddingBatcher
+from chunker import chunk_text, pool_embeddings
+from api_cache import ApiCache
+from embedding_codec import encode_embedding
+from md_index import scan_markdown, scan_paths
+from dedup import simhash
+from metrics import STAGE_SECONDS
 
 
 class LinkExtractor:
@@ -13,74 +42,306 @@ class LinkExtractor:
     LINK_REGEX = re.compile(r"https?://[^\s]+\.pdf(?=\W|$)")
     EMBEDDING_CTX_LENGTH = 8191
 
-    def __init__(self, directory, db_name: str, model_name: str):
+    def __init__(
+        self,
+        directory,
+        db_name: str,
+        model_name: str,
+        cache: Optional[ApiCache] = None,
+        http: Optional[HttpClient] = None,
+        write_batch_size: int = 20,
+        embedding_format: str = "float32",
+        extract_pool: Optional[ExtractPool] = None,
+        max_text_chars: int = MAX_TEXT_SIZE,
+        thumbnail_scale: float = THUMBNAIL_SCALE,
+        thumbnail_clip: float = THUMBNAIL_CLIP,
+        async_api: Optional[AsyncApi] = None,
+        max_attempts: int = MAX_ATTEMPTS,
+        retry_delay: float = RETRY_DELAY,
+        dedup: bool = True,
+    ):
         load_dotenv()
 
         self.directory = directory
         self.client = OpenAI()
         self.db_name = db_name
         self.model_name = model_name
+        self.cache = cache
+        self.http = http or default_http_client()
+        self.write_batch_size = write_batch_size
+        self.embedding_format = embedding_format
+        self.extract_pool = extract_pool or default_extract_pool()
+        # pages past `max_text_chars` aren't parsed until complete_texts()
+        self.extract_options = dict(
+            max_chars=max_text_chars, thumbnail_scale=thumbnail_scale, thumbnail_clip=thumbnail_clip
+        )
+        # when set, openai calls go through AsyncApi and a batch of papers is enriched at once
+        self.async_api = async_api
+        self.embedding_batcher = EmbeddingBatcher(
+            self.client, self.EMBEDDING_MODEL, cache=cache, api=async_api
+        )
+        # links that turn out to be a stored or queued paper become aliases of it, see dedup
+        self.queue_options = dict(max_attempts=max_attempts, retry_delay=retry_delay, dedup=dedup)
 
-    def extract_links(self):
-        print("scanning for md files")
+    def extract_links(self, paths: Optional[list[str]] = None):
+        # scanned before the writer opens its transaction, the scan writes the md index
+        jobs = list(self.find_new_links(paths))
+        with PaperWriter(self.db_name, self.write_batch_size) as writer:
+            queue = self.work_queue(writer)
+            queue.enqueue(jobs)
+            # a claimed batch goes through each stage together, so its papers share
+            # embeddings requests
+            while items := queue.claim():
+                for item in items:
+                    print(f"processing {item.url.split('/')[-1]}")
+                items = self.fetch_items(queue, items)
+                items = self.extract_items(queue, items)
+                items = self.embed_items(queue, items)
+                for item in self.enrich_items(queue, items):
+                    queue.write(item)
+            self.log_queue(queue)
 
-        md_files = [
-            os.path.join(root, file)
-            for root, _, files in os.walk(self.directory)
-            for file in files
-            if file.endswith(".md")
-        ]
-        print(f"found {len(md_files)} md files, searching for pdf links")
+    def extract_links_concurrently(self, paths: Optional[list[str]] = None, **pipeline_args):
+        Pipeline(self, **pipeline_args).run(self.find_new_links(paths))
 
-        for file_path in md_files:
+    def work_queue(self, writer: PaperWriter) -> WorkQueue:
+        return WorkQueue(writer, **self.queue_options)
+
+    def has_due_work(self) -> bool:
+        return has_due_work(self.db_name)
+
+    def log_queue(self, queue: WorkQueue):
+        counts = queue.counts()
+        if counts:
+            print(f"links left in the work queue: {counts}")
+
+    def recheck_papers(self):
+        to_recheck = fetch_papers_to_recheck(self.db_name)
+        print(f"rechecking {len(to_recheck)} papers for changes")
+
+        for url, etag, last_modified, my_file in to_recheck:
             try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    links: Set[str] = set(self.LINK_REGEX.findall(f.read()))
-                for link in links:
-                    if not check_paper_exists(link, self.db_name):
-                        paper = fetch_and_extract_text_from_pdf(link)
-                        print(f"processing {paper.file_name()}")
-                        processed_paper = self.process_paper(paper)
-                        file_create = os.path.getctime(file_path)
-                        file_updated = os.path.getmtime(file_path)
-                        my_file = MyFile(file_path, file_create, file_updated)
-                        insert_paper(processed_paper, my_file, self.db_name)
-                    else:
-                        print(f"skipping {link.split('/')[-1]}, already exists")
+                # conditional GET, unchanged pdfs come back as an empty 304
+                spool = download_pdf(url, self.http, (etag, last_modified))
+            except NotModifiedError:
+                mark_paper_checked(url, self.db_name)
+                continue
             except Exception as e:
-                logging.info(f"Error reading file {file_path}: {e}")
+                logging.info(f"Error rechecking {url}: {e}")
+                continue
+
+            try:
+                text, png, complete = self.extract_pool.extract(
+                    spool.source(), **self.extract_options
+                )
+                paper = build_paper(url, spool, text, thumbnail=png, text_complete=complete)
+            except Exception as e:
+                spool.close()
+                logging.info(f"Error rechecking {url}: {e}")
+                continue
+
+            print(f"updating {paper.file_name()}, it changed")
+            try:
+                processed_paper = self.process_paper(paper)
+                insert_paper(processed_paper, my_file, self.db_name, replace=True)
+            except Exception as e:
+                logging.info(f"Error processing {url}: {e}")
                 logging.exception(e)
+            finally:
+                paper.release()
+
+    def complete_texts(self):
+        # papers extracted with a lower `max_text_chars` get the rest of their text, parsed
+        # from the pdf already in the blob store. metadata and the first chunks' embeddings
+        # come back from the api cache
+        incomplete = fetch_incomplete_papers(self.db_name)
+        print(f"completing the text of {len(incomplete)} papers")
+        options = dict(self.extract_options, max_chars=MAX_TEXT_SIZE)
+
+        for url, pdf_sha256, my_file in incomplete:
+            spool = PdfSpool()
+            try:
+                conn = connect(self.db_name, read_only=True)
+                try:
+                    for chunk in iter_blob(conn, pdf_sha256):
+                        spool.write(chunk)
+                finally:
+                    conn.close()
+                spool.finish()
+                text, png, complete = self.extract_pool.extract(spool.source(), **options)
+                paper = build_paper(url, spool, text, thumbnail=png, text_complete=complete)
+            except Exception as e:
+                spool.close()
+                logging.info(f"Error completing {url}: {e}")
+                continue
+
+            print(f"completing {paper.file_name()}")
+            try:
+                processed_paper = self.process_paper(paper)
+                insert_paper(processed_paper, my_file, self.db_name, replace=True)
+            except Exception as e:
+                logging.info(f"Error processing {url}: {e}")
+                logging.exception(e)
+            finally:
+                paper.release()
+
+    def find_new_links(self, paths: Optional[list[str]] = None) -> Iterator[tuple[str, MyFile]]:
+        # every md file under the directory, or only `paths` when the watch mode saw them change
+        if paths is None:
+            print("scanning for md files")
+            scan_markdown(self.directory, self.db_name, self.LINK_REGEX)
+        elif paths:
+            scan_paths(paths, self.db_name, self.LINK_REGEX)
+
+        # the same link in two files is only processed for the first one
+        seen: Set[str] = set()
+        for link, my_file in fetch_unsaved_links(self.db_name, paths):
+            if link not in seen:
+                seen.add(link)
+                yield link, my_file
 
     def process_paper(self, paper: Paper) -> ProcessedPaper:
-        processed_paper = ProcessedPaper(paper)
-
-        if paper.status == "success" and paper.text:
-            embedding = self.generate_embedding_for_text(paper.text)
-            encoded_embedding = encode_embedding(embedding)
-            processed_paper.embedding = encoded_embedding
-            processed_paper.encode_pic()
-            processed_paper.extract_data(self.client, self.model_name, self.EMBEDDING_CTX_LENGTH)
-            processed_paper.status = "success_and_processed"
+        return self.process_papers([paper])[0]
 
-        return processed_paper
+    def process_papers(self, papers: list[Paper]) -> list[ProcessedPaper]:
+        processed_papers = self.embed_papers(papers)
+        for error in self.enrich_papers(processed_papers):
+            if error is not None:
+                raise error
+        return processed_papers
 
-    def generate_embedding_for_text(self, text: str) -> list[float]:
-        truncated_text = text[: self.EMBEDDING_CTX_LENGTH]
-        response = self.client.embeddings.create(model=self.EMBEDDING_MODEL, input=[truncated_text])
+    # the stages of a queued link, each takes a batch and returns the items that got
+    # through it. a failed item is handed back to the queue, and a stage an earlier
+    # attempt finished is skipped
+    def fetch_items(self, queue: WorkQueue, items: list[WorkItem]) -> list[WorkItem]:
+        results = []
+        for item in items:
+            try:
+                if item.reached("extracted"):
+                    pass
+                elif item.reached("fetched"):
+                    item.spool = queue.pdf_spool(item)
+                else:
+                    if queue.alias_duplicate(item):
+                        continue
+                    item.spool = download_pdf(item.url, self.http)
+                    if not queue.fetched(item, item.spool):
+                        continue
+                results.append(item)
+            except Exception as e:
+                queue.failed(item, e)
+        return results
+
+    def extract_items(self, queue: WorkQueue, items: list[WorkItem]) -> list[WorkItem]:
+        results = []
+        for item in items:
+            try:
+                if not item.reached("extracted"):
+                    text, png, complete = self.extract_pool.extract(
+                        item.spool.source(), **self.extract_options
+                    )
+                    # a near duplicate is caught here, before embedding costs anything
+                    if not queue.extracted(item, text, png, complete, simhash(text)):
+                        continue
+                # the pdf is in the blob store, nothing after this needs it
+                item.release()
+                item.paper = item.restore(queue)
+                results.append(item)
+            except Exception as e:
+                queue.failed(item, e)
+        return results
+
+    def embed_items(self, queue: WorkQueue, items: list[WorkItem]) -> list[WorkItem]:
+        to_embed = [item for item in items if not item.reached("embedded")]
+        try:
+            processed_papers = self.embed_papers([item.paper for item in to_embed])
+        except Exception as e:
+            for item in to_embed:
+                queue.failed(item, e)
+            return [item for item in items if item.reached("embedded")]
+
+        for item, processed_paper in zip(to_embed, processed_papers):
+            queue.embedded(item, processed_paper.embedding, processed_paper.chunks)
+            # the text and chunks are in the queue row now, the item only keeps a reference
+            item.paper = item.restore(queue)
+        return items
+
+    def enrich_items(self, queue: WorkQueue, items: list[WorkItem]) -> list[WorkItem]:
+        to_enrich = [item for item in items if not item.reached("enriched")]
+        errors = self.enrich_papers([item.paper for item in to_enrich])
+
+        failed = set()
+        for item, error in zip(to_enrich, errors):
+            if error is None:
+                queue.enriched(item, item.paper.data)
+            else:
+                queue.failed(item, error)
+                failed.add(item.url)
+        return [item for item in items if item.url not in failed]
 
-        if response.data:
-            embedding = response.data[0].embedding
-            return embedding
-        else:
-            return []
+    def embed_papers(self, papers: list[Paper]) -> list[ProcessedPaper]:
+        processed_papers = [ProcessedPaper(paper) for paper in papers]
+        to_embed = [p for p in processed_papers if p.status == "success" and p.has_text()]
 
+        texts, token_counts = [], []
+        for processed_paper in to_embed:
+            text = processed_paper.text
+            with STAGE_SECONDS.time(stage="chunk"):
+                processed_paper.chunks = chunk_text(text, self.embedding_batcher.encoding)
+            for chunk in processed_paper.chunks:
+                texts.append(text[chunk.start : chunk.end])
+                token_counts.append(chunk.token_count)
 
-def encode_embedding(vector: list[float]) -> bytes:
-    return struct.pack("f" * len(vector), *vector)
+        # every chunk of every paper goes through the batcher together,
+        # one request per batch instead of one per paper
+        embeddings = self.embedding_batcher.embed(texts, token_counts)
+        vectors = iter(embeddings)
+        for processed_paper in to_embed:
+            chunk_vectors = []
+            for chunk in processed_paper.chunks:
+                vector = next(vectors)
+                chunk.embedding = encode_embedding(vector, self.embedding_format)
+                chunk_vectors.append(vector)
 
+            # the paper level vector is pooled from its chunks, no extra request needed
+            weights = [chunk.token_count for chunk in processed_paper.chunks]
+            processed_paper.embedding = encode_embedding(
+                pool_embeddings(chunk_vectors, weights), self.embedding_format
+            )
 
-def decode_embedding(blob: bytes) -> np.ndarray:
-    if len(blob) % 4 != 0:
-        raise ValueError("The blob length is not a multiple of 4.")
-    num_floats = len(blob) // 4
-    return np.array(struct.unpack(f"{num_floats}f", blob))
+        return processed_papers
+
+    def enrich_papers(self, processed_papers: list[ProcessedPaper]) -> list[Optional[Exception]]:
+        # the error each paper failed with, or None
+        if self.async_api is None:
+            errors = []
+            for processed_paper in processed_papers:
+                try:
+                    self.enrich_paper(processed_paper)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(e)
+            return errors
+
+        async def enrich(processed_paper: ProcessedPaper):
+            try:
+                if processed_paper.status == "success" and processed_paper.has_text():
+                    await processed_paper.extract_data_async(
+                        self.async_api, self.model_name, self.EMBEDDING_CTX_LENGTH, self.cache
+                    )
+                    processed_paper.status = "success_and_processed"
+            except Exception as e:
+                return e
+
+        return self.async_api.gather([enrich(p) for p in processed_papers])
+
+    def enrich_paper(self, processed_paper: ProcessedPaper):
+        if processed_paper.status == "success" and processed_paper.has_text():
+            processed_paper.extract_data(
+                self.client, self.model_name, self.EMBEDDING_CTX_LENGTH, self.cache
+            )
+            processed_paper.status = "success_and_processed"
+
+    def generate_embedding_for_text(self, text: str) -> list[float]:
+        truncated_text = text[: self.EMBEDDING_CTX_LENGTH]
+        return self.embedding_batcher.embed([truncated_text])[0]
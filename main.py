@@ -1,12 +1,24 @@
 import argparse
 import logging
 import os
-from cloud_backup import backup_db
-from db import init_db
+from ann_index import NPROBE, AnnIndex
+from api_cache import ApiCache
+from async_api import AsyncApi
+from cloud_backup import backup_db, backup_prefix, latest_manifest_key, restore_db, s3_client
+from db import connect, init_db
+from export import export_papers
+from extract_pool import ExtractPool
+from full_text import HIGHLIGHT_END, HIGHLIGHT_START, RANK_WINDOW, search_papers
+from http_client import HttpClient
 from link_extractor import LinkExtractor
+from md_watch import DEBOUNCE, MarkdownWatcher
+from metrics import REGISTRY
 from dotenv import load_dotenv
 from dash_app import DashApp
 import threading
+from typing import Optional
+
+WATCH_RETRY_INTERVAL = 60  #    seconds, how often the watch mode looks for links due a retry
 
 
 def parse_arguments():
@@ -29,7 +41,363 @@ def parse_arguments():
         "--remain-open", help="Remain open mode", action="store_true", default=remain_open_env
     )
 
-    return parser.parse_args()
+    concurrent_env = os.getenv("CONCURRENT", "False").lower() in ("true", "1", "t")
+    parser.add_argument(
+        "--concurrent", help="Run the staged pipeline", action="store_true", default=concurrent_env
+    )
+
+    download_workers = int(os.getenv("DOWNLOAD_WORKERS") or 8)
+    parser.add_argument(
+        "--download-workers", help="Concurrent pdf downloads", type=int, default=download_workers
+    )
+
+    parse_workers = int(os.getenv("PARSE_WORKERS") or os.cpu_count() or 1)
+    parser.add_argument(
+        "--parse-workers", help="Processes parsing pdfs", type=int, default=parse_workers
+    )
+
+    extract_timeout = float(os.getenv("EXTRACT_TIMEOUT") or 120)
+    parser.add_argument(
+        "--extract-timeout",
+        help="Seconds a pdf may take to parse before its worker is killed",
+        type=float,
+        default=extract_timeout,
+    )
+
+    extract_memory_mb = int(os.getenv("EXTRACT_MEMORY_MB") or 2048)
+    parser.add_argument(
+        "--extract-memory-mb",
+        help="Memory cap of each pdf parsing process, 0 for none",
+        type=int,
+        default=extract_memory_mb,
+    )
+
+    max_text_chars = int(os.getenv("MAX_TEXT_CHARS") or 1024 * 1024)
+    parser.add_argument(
+        "--max-text-chars",
+        help="Characters of text extracted per pdf, later pages aren't parsed",
+        type=int,
+        default=max_text_chars,
+    )
+
+    thumbnail_scale = float(os.getenv("THUMBNAIL_SCALE") or 0.5)
+    parser.add_argument(
+        "--thumbnail-scale",
+        help="Size of the first page thumbnail, 1 is 72 dpi",
+        type=float,
+        default=thumbnail_scale,
+    )
+
+    thumbnail_clip = float(os.getenv("THUMBNAIL_CLIP") or 1.0)
+    parser.add_argument(
+        "--thumbnail-clip",
+        help="Fraction of the first page, from the top, kept in the thumbnail",
+        type=float,
+        default=thumbnail_clip,
+    )
+
+    complete_text_env = os.getenv("COMPLETE_TEXT", "False").lower() in ("true", "1", "t")
+    parser.add_argument(
+        "--complete-text",
+        help="Extract the rest of papers cut short by a lower --max-text-chars",
+        action="store_true",
+        default=complete_text_env,
+    )
+
+    embed_batch_size = int(os.getenv("EMBED_BATCH_SIZE") or 100)
+    parser.add_argument(
+        "--embed-batch-size",
+        help="Papers embedded per OpenAI request",
+        type=int,
+        default=embed_batch_size,
+    )
+
+    enrich_workers = int(os.getenv("ENRICH_WORKERS") or 4)
+    parser.add_argument(
+        "--enrich-workers", help="Concurrent OpenAI workers", type=int, default=enrich_workers
+    )
+
+    queue_size = int(os.getenv("QUEUE_SIZE") or 32)
+    parser.add_argument(
+        "--queue-size", help="Max papers waiting between stages", type=int, default=queue_size
+    )
+
+    write_batch_size = int(os.getenv("WRITE_BATCH_SIZE") or 20)
+    parser.add_argument(
+        "--write-batch-size",
+        help="Papers committed per sqlite transaction",
+        type=int,
+        default=write_batch_size,
+    )
+
+    embedding_format = os.getenv("EMBEDDING_FORMAT") or "float32"
+    parser.add_argument(
+        "--embedding-format",
+        help="How embeddings are stored",
+        choices=["float32", "float16", "int8"],
+        default=embedding_format,
+    )
+
+    async_api_env = os.getenv("ASYNC_API", "False").lower() in ("true", "1", "t")
+    parser.add_argument(
+        "--async-api",
+        help="Make concurrent openai calls, paced by its rate limit headers",
+        action="store_true",
+        default=async_api_env,
+    )
+
+    max_in_flight = int(os.getenv("MAX_IN_FLIGHT") or 8)
+    parser.add_argument(
+        "--max-in-flight",
+        help="Max openai calls open at once with --async-api",
+        type=int,
+        default=max_in_flight,
+    )
+
+    max_attempts = int(os.getenv("MAX_ATTEMPTS") or 16)
+    parser.add_argument(
+        "--max-attempts",
+        help="Tries per link before it's saved as failed",
+        type=int,
+        default=max_attempts,
+    )
+
+    retry_delay = float(os.getenv("RETRY_DELAY") or 60)
+    parser.add_argument(
+        "--retry-delay",
+        help="Seconds before a failed link is retried, doubled on every attempt",
+        type=float,
+        default=retry_delay,
+    )
+
+    per_host_concurrency = int(os.getenv("PER_HOST_CONCURRENCY") or 2)
+    parser.add_argument(
+        "--per-host-concurrency",
+        help="Max concurrent downloads from one host",
+        type=int,
+        default=per_host_concurrency,
+    )
+
+    per_host_rate = float(os.getenv("PER_HOST_RATE") or 1.0)
+    parser.add_argument(
+        "--per-host-rate",
+        help="Max downloads started per second on one host",
+        type=float,
+        default=per_host_rate,
+    )
+
+    recheck_env = os.getenv("RECHECK", "False").lower() in ("true", "1", "t")
+    parser.add_argument(
+        "--recheck",
+        help="Re-fetch stored papers with a conditional GET",
+        action="store_true",
+        default=recheck_env,
+    )
+
+    cache_path = os.getenv("CACHE_PATH") or "api_cache.db"
+    parser.add_argument("--cache-path", help="OpenAI response cache file", default=cache_path)
+
+    cache_size_mb = int(os.getenv("CACHE_SIZE_MB") or 2048)
+    parser.add_argument(
+        "--cache-size-mb", help="Max OpenAI response cache size", type=int, default=cache_size_mb
+    )
+
+    no_cache_env = os.getenv("NO_CACHE", "False").lower() in ("true", "1", "t")
+    parser.add_argument(
+        "--no-cache", help="Always call the OpenAI api", action="store_true", default=no_cache_env
+    )
+
+    no_dedup_env = os.getenv("NO_DEDUP", "False").lower() in ("true", "1", "t")
+    parser.add_argument(
+        "--no-dedup",
+        help="Process every link, even the ones that are the same paper as another",
+        action="store_true",
+        default=no_dedup_env,
+    )
+
+    backup_mode = os.getenv("BACKUP_MODE") or "full"
+    parser.add_argument(
+        "--backup-mode",
+        help="Upload a full copy of the db, or only the chunks changed since the last backup",
+        choices=["full", "incremental"],
+        default=backup_mode,
+    )
+
+    backup_concurrency = int(os.getenv("BACKUP_CONCURRENCY") or 8)
+    parser.add_argument(
+        "--backup-concurrency",
+        help="Parts uploaded at once by the cloud backup",
+        type=int,
+        default=backup_concurrency,
+    )
+
+    run_summary = os.getenv("RUN_SUMMARY") or "run_summary.json"
+    parser.add_argument(
+        "--run-summary",
+        help="Where to write the json summary of a run's timings and counters",
+        default=run_summary,
+    )
+
+    watch_env = os.getenv("WATCH", "False").lower() in ("true", "1", "t")
+    parser.add_argument(
+        "--watch",
+        help="Keep running and process new links as soon as md files change",
+        action="store_true",
+        default=watch_env,
+    )
+
+    watch_debounce = float(os.getenv("WATCH_DEBOUNCE") or DEBOUNCE)
+    parser.add_argument(
+        "--watch-debounce",
+        help="Seconds without changes before a burst of saves is processed",
+        type=float,
+        default=watch_debounce,
+    )
+
+    watch_polling_env = os.getenv("WATCH_POLLING", "False").lower() in ("true", "1", "t")
+    parser.add_argument(
+        "--watch-polling",
+        help="Poll for changes instead of using inotify",
+        action="store_true",
+        default=watch_polling_env,
+    )
+
+    subparsers = parser.add_subparsers(dest="command")
+    similar = subparsers.add_parser("similar", help="Find papers similar to a query or a paper")
+    similar.add_argument("query", nargs="?", help="Text to search for, embedded with openai")
+    similar.add_argument("--url", help="Find papers similar to this stored paper instead")
+    similar.add_argument("-k", help="Number of results", type=int, default=10)
+    similar.add_argument(
+        "--nprobe",
+        help="Index lists scanned, more is slower and more exact",
+        type=int,
+        default=NPROBE,
+    )
+
+    search = subparsers.add_parser("search", help="Full text search over the papers' text")
+    search.add_argument(
+        "query",
+        help='Words, "a phrase", prefix* or fts5 query syntax. A query matching more than'
+        f" {RANK_WINDOW} papers is ranked over their title, authors, keywords and abstract only",
+    )
+    search.add_argument("-k", help="Number of results", type=int, default=10)
+
+    export = subparsers.add_parser("export", help="Write the papers to a parquet or arrow file")
+    export.add_argument("path", help="File to write, a directory of parts with --incremental")
+    export.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    export.add_argument(
+        "--incremental",
+        help="Only write the papers stored since the last export to `path`",
+        action="store_true",
+    )
+    export.add_argument("--include-text", help="Include the full text column", action="store_true")
+    export.add_argument("--batch-size", help="Rows per record batch", type=int)
+
+    restore = subparsers.add_parser("restore", help="Rebuild the db from an incremental backup")
+    restore.add_argument("target", help="Path to write the restored db to")
+    restore.add_argument("--manifest", help="Manifest key to restore, defaults to the latest")
+    restore.add_argument("--force", help="Overwrite `target` if it exists", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "similar" and not (args.query or args.url):
+        parser.error("similar needs a query or --url")
+    return args
+
+
+def run_similar(args, cache):
+    index = AnnIndex.for_db(args.db_name, nprobe=args.nprobe)
+    changed = index.sync(args.db_name)
+    if changed:
+        print(f"updated {changed} papers in the index")
+
+    if args.url:
+        try:
+            hits = index.similar_to(args.url, args.k)
+        except KeyError:
+            print(f"{args.url} has no embedding in {args.db_name}")
+            return
+    else:
+        link_extractor = LinkExtractor(args.directory, args.db_name, args.model_name, cache)
+        hits = index.search(link_extractor.generate_embedding_for_text(args.query), args.k)
+
+    for url, score in hits:
+        print(f"{score:.3f}  {url}")
+
+
+def run_search(args):
+    conn = connect(args.db_name, read_only=True)
+    try:
+        hits = search_papers(conn, args.query, args.k)
+    finally:
+        conn.close()
+
+    if not hits:
+        print(f"no papers match {args.query}")
+    for hit in hits:
+        snippet = hit.snippet.replace(HIGHLIGHT_START, "*").replace(HIGHLIGHT_END, "*")
+        print(f"{hit.score:.2f}  {hit.url}\n       {hit.title}\n       {' '.join(snippet.split())}")
+
+
+def s3_settings() -> Optional[tuple[str, str, str, str, str]]:
+    settings = (
+        os.getenv("S3_BUCKET_NAME"),
+        os.getenv("S3_ENDPOINT_URL"),
+        os.getenv("AWS_ACCESS_KEY_ID"),
+        os.getenv("AWS_SECRET_ACCESS_KEY"),
+        os.getenv("S3_REGION_NAME") or "auto",
+    )
+    return settings if all(settings) else None
+
+
+def run_restore(args):
+    if os.path.exists(args.target) and not args.force:
+        print(f"{args.target} already exists, pass --force to overwrite it")
+        return
+    settings = s3_settings()
+    if settings is None:
+        print("can't restore, missing s3 info")
+        return
+    bucket_name, *credentials = settings
+    s3 = s3_client(*credentials)
+
+    manifest = args.manifest or latest_manifest_key(s3, bucket_name, backup_prefix(args.db_name))
+    if manifest is None:
+        print(f"no incremental backups of {args.db_name} in {bucket_name}")
+        return
+    print(f"restoring {manifest} to {args.target}")
+    restore_db(s3, bucket_name, manifest, args.target)
+
+
+def run_ingest(args, link_extractor: LinkExtractor, paths: Optional[list[str]] = None):
+    if args.concurrent:
+        link_extractor.extract_links_concurrently(
+            paths,
+            download_workers=args.download_workers,
+            parse_workers=args.parse_workers,
+            embed_batch_size=args.embed_batch_size,
+            enrich_workers=args.enrich_workers,
+            queue_size=args.queue_size,
+        )
+    else:
+        link_extractor.extract_links(paths)
+
+
+def run_watch(args, link_extractor: LinkExtractor, watcher: MarkdownWatcher):
+    # only the notes that changed are read again, and only their new links processed.
+    # a quiet spell also runs whatever the work queue has due for a retry
+    print(f"watching {args.directory} for changes ({watcher.kind}), ctrl-c to stop")
+    try:
+        while True:
+            paths = watcher.wait(timeout=WATCH_RETRY_INTERVAL)
+            if paths is None:
+                print("file events were missed, rescanning every md file")
+                run_ingest(args, link_extractor)
+            elif paths or link_extractor.has_due_work():
+                run_ingest(args, link_extractor, sorted(paths))
+    except KeyboardInterrupt:
+        print("stopped watching")
+    finally:
+        watcher.close()
 
 
 def run_dash_app(dash_app):
@@ -48,33 +416,87 @@ def main():
     else:
         logging.basicConfig(level=logging.CRITICAL)
 
+    if args.command == "restore":
+        run_restore(args)
+        return
+
     init_db(db_name=args.db_name)
+    cache = None if args.no_cache else ApiCache(args.cache_path, args.cache_size_mb * 1024 * 1024)
+
+    if args.command == "similar":
+        run_similar(args, cache)
+        if cache:
+            cache.close()
+        return
+    if args.command == "search":
+        run_search(args)
+        return
+    if args.command == "export":
+        export_papers(
+            args.db_name,
+            args.path,
+            args.format,
+            args.incremental,
+            args.include_text,
+            args.batch_size,
+        )
+        return
 
-    dash_app = DashApp(db_name=args.db_name)
+    dash_app = DashApp(db_name=args.db_name, live=args.watch)
     dash_thread = threading.Thread(target=run_dash_app, args=(dash_app,), daemon=False)
     dash_thread.start()
 
-    LinkExtractor(args.directory, args.db_name, args.model_name).extract_links()
+    http = HttpClient(args.per_host_concurrency, args.per_host_rate)
+    extract_pool = ExtractPool(
+        args.parse_workers, args.extract_timeout, args.extract_memory_mb * 1024 * 1024
+    )
+    async_api = AsyncApi(max_in_flight=args.max_in_flight) if args.async_api else None
+    link_extractor = LinkExtractor(
+        args.directory,
+        args.db_name,
+        args.model_name,
+        cache,
+        http,
+        args.write_batch_size,
+        args.embedding_format,
+        extract_pool,
+        args.max_text_chars,
+        args.thumbnail_scale,
+        args.thumbnail_clip,
+        async_api,
+        args.max_attempts,
+        args.retry_delay,
+        not args.no_dedup,
+    )
+    # set up before the first pass, notes saved while it runs aren't missed
+    watcher = (
+        MarkdownWatcher(args.directory, args.watch_debounce, polling=args.watch_polling)
+        if args.watch
+        else None
+    )
+    run_ingest(args, link_extractor)
+
+    if args.recheck:
+        link_extractor.recheck_papers()
 
-    s3_bucket_name = os.getenv("S3_BUCKET_NAME")
-    s3_endpoint_url = os.getenv("S3_ENDPOINT_URL")
-    aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID")
-    aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
-    s3_region_name = os.getenv("S3_REGION_NAME") or "auto"
+    if args.complete_text:
+        link_extractor.complete_texts()
 
-    if not all(
-        [s3_bucket_name, s3_endpoint_url, aws_access_key_id, aws_secret_access_key, args.db_name]
-    ):
+    if cache:
+        cache.log_stats()
+    REGISTRY.write_summary(args.run_summary)
+
+    settings = s3_settings()
+    if settings is None or not args.db_name:
         print("skip backup, missing s3 info")
     else:
-        backup_db(
-            args.db_name,
-            s3_bucket_name,
-            s3_endpoint_url,
-            aws_access_key_id,
-            aws_secret_access_key,
-            s3_region_name,
-        )
+        backup_db(args.db_name, *settings, args.backup_mode, args.backup_concurrency)
+
+    if watcher is not None:
+        run_watch(args, link_extractor, watcher)
+    if cache:
+        # writes the last_used of the last hits
+        cache.close()
 
     if not args.remain_open:
         print("shutting down dash app")
@@ -0,0 +1,67 @@
+import os, logging, re
+from typing import Iterable, Iterator, Optional
+from db import fetch_md_index, update_md_index
+
+
+def scan_markdown(directory: str, db_name: str, link_regex: re.Pattern):
+    # only files whose mtime or size changed since the last run are read again,
+    # the links of the rest are already in the md_links table
+    index = fetch_md_index(db_name)
+    changed = []
+    found = 0
+
+    for path, stat in walk_markdown(directory):
+        found += 1
+        if index.pop(path, None) == (stat.st_mtime, stat.st_size):
+            continue
+
+        links = read_links(path, link_regex)
+        if links is not None:
+            changed.append((path, stat.st_mtime, stat.st_ctime, stat.st_size, links))
+
+    # whatever is left in the index was deleted or moved since the last run
+    removed = list(index)
+    update_md_index(changed, removed, db_name)
+    print(f"found {found} md files, {len(changed)} new or changed, {len(removed)} removed")
+
+
+def scan_paths(paths: Iterable[str], db_name: str, link_regex: re.Pattern):
+    # the watch mode's scan, only the notes it was told about are read again
+    changed = []
+    removed = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            removed.append(path)
+            continue
+        links = read_links(path, link_regex)
+        if links is not None:
+            changed.append((path, stat.st_mtime, stat.st_ctime, stat.st_size, links))
+
+    update_md_index(changed, removed, db_name)
+    print(f"{len(changed)} md files new or changed, {len(removed)} removed")
+
+
+def read_links(path: str, link_regex: re.Pattern) -> Optional[set[str]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return set(link_regex.findall(f.read()))
+    except Exception as e:
+        logging.info(f"Error reading file {path}: {e}")
+        logging.exception(e)
+        return None
+
+
+def walk_markdown(directory: str) -> Iterator[tuple[str, os.stat_result]]:
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".md") and entry.is_file():
+                        yield entry.path, entry.stat()
+        except OSError as e:
+            logging.info(f"Error scanning {directory}: {e}")
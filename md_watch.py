@@ -0,0 +1,202 @@
+import ctypes, ctypes.util, logging, os, select, struct, sys, time
+from typing import Optional
+from md_index import walk_markdown
+
+DEBOUNCE = 1.0  #           seconds without events before a burst of saves is handed over
+MAX_DELAY = 10.0  #         a note saved over and over is still picked up after this
+POLL_INTERVAL = 2.0  #      seconds between walks of the polling fallback
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+# written and closed, not every write, so a note is never read half saved. editors that
+# save to a temp file and rename it show up as a move
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII")  #    wd, mask, cookie, len, then `len` bytes of name
+READ_SIZE = 64 * 1024
+
+
+# inotify through ctypes, one watch per directory. the kernel says which files changed,
+# nothing is walked after the watches are set up
+class InotifyBackend:
+    kind = "inotify"
+
+    def __init__(self, directory: str):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is linux only")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._init = libc.inotify_init1
+        self._init.argtypes = [ctypes.c_int]
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.directory = directory
+        self.fd = -1
+        self._start()
+
+    def _start(self):
+        self.fd = self._init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.dirs: dict[int, str] = {}
+        self._watch_tree(self.directory)
+
+    def _watch_tree(self, directory: str) -> set[str]:
+        # watches `directory` and everything under it, returns the notes already in there
+        notes = set()
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                # most likely fs.inotify.max_user_watches, the rest of the tree still works
+                error = ctypes.get_errno()
+                logging.info(f"can't watch {path}: {os.strerror(error)}")
+                continue
+            self.dirs[wd] = path
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.endswith(".md"):
+                            notes.add(entry.path)
+            except OSError as e:
+                logging.info(f"Error scanning {path}: {e}")
+        return notes
+
+    def read(self, timeout: Optional[float]) -> Optional[set[str]]:
+        # notes changed, created or removed. None when events were lost, or a directory
+        # moved and the paths of its watches went stale, then the caller rescans
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        lost = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size : offset + EVENT.size + length].rstrip(b"\0")
+            offset += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                lost = True
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    lost = True
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # notes can land in a new folder before its watch is set up
+                    changed |= self._watch_tree(path)
+            elif path.endswith(".md"):
+                changed.add(path)
+
+        if lost:
+            self.close()
+            self._start()
+            return None
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+# walks the directory every `interval` and compares mtimes and sizes. only the notes
+# that differ are read, like scan_markdown does on startup
+class PollingBackend:
+    kind = "polling"
+
+    def __init__(self, directory: str, interval: float = POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.snapshot = self._stat()
+
+    def _stat(self) -> dict[str, tuple[float, int]]:
+        return {path: (stat.st_mtime, stat.st_size) for path, stat in walk_markdown(self.directory)}
+
+    def read(self, timeout: Optional[float]) -> Optional[set[str]]:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        previous, self.snapshot = self.snapshot, self._stat()
+        return {
+            path
+            for path in previous.keys() | self.snapshot.keys()
+            if previous.get(path) != self.snapshot.get(path)
+        }
+
+    def close(self):
+        pass
+
+
+class MarkdownWatcher:
+    def __init__(
+        self,
+        directory: str,
+        debounce: float = DEBOUNCE,
+        max_delay: float = MAX_DELAY,
+        polling: bool = False,
+    ):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.backend = None
+        if not polling:
+            try:
+                self.backend = InotifyBackend(directory)
+            except (OSError, AttributeError) as e:
+                logging.info(f"inotify unavailable, polling {directory} instead: {e}")
+        if self.backend is None:
+            self.backend = PollingBackend(directory)
+
+    @property
+    def kind(self) -> str:
+        return self.backend.kind
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[set[str]]:
+        # blocks until a burst of changes has settled, an editor's save can be several
+        # events. returns the notes touched, an empty set if `timeout` passed without any,
+        # or None when changes may have been missed and everything should be rescanned
+        started = time.monotonic()
+        first = None
+        changed: set[str] = set()
+        while True:
+            now = time.monotonic()
+            if first is None:
+                wait = None if timeout is None else started + timeout - now
+                if wait is not None and wait <= 0:
+                    return changed
+            else:
+                if now - first >= self.max_delay:
+                    return changed
+                wait = min(self.debounce, first + self.max_delay - now)
+
+            events = self.backend.read(wait)
+            if events is None:
+                return None
+            if events:
+                changed |= events
+                first = first or time.monotonic()
+            elif first is not None:
+                return changed
+
+    def close(self):
+        self.backend.close()
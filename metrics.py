@@ -0,0 +1,228 @@
+import bisect, json, math, threading, time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+# in process metrics for a run: how long each stage takes, what went over the wire and
+# what had to be retried. exposed as prometheus text on the dash app's /metrics and
+# written as a json summary when a run ends
+
+# seconds, from a sqlite commit to a slow openai call or a big download
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.kind = "counter"
+        self._values: dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name + "_total", labels, value
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {_summary_key(labels): value for labels, value in self._values.items()}
+
+
+class Gauge:
+    # read when scraped, from callbacks registered by whoever owns the value
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.kind = "gauge"
+        self._callbacks: dict[Labels, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def track(self, fn: Callable[[], float], **labels):
+        with self._lock:
+            self._callbacks[_labels(labels)] = fn
+
+    def untrack(self, **labels):
+        with self._lock:
+            self._callbacks.pop(_labels(labels), None)
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        with self._lock:
+            callbacks = list(self._callbacks.items())
+        for labels, fn in callbacks:
+            yield self.name, labels, fn()
+
+    def summary(self) -> dict:
+        return {_summary_key(labels): value for _, labels, value in self.samples()}
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: list[float] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.kind = "histogram"
+        self.buckets = sorted(buckets) + [math.inf]
+        # per label set: a count per bucket (not cumulative), the sum and the max
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * len(self.buckets), [0.0, 0.0])
+            counts, totals = self._values[key]
+            counts[i] += 1
+            totals[0] += value
+            totals[1] = max(totals[1], value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        # errors are timed too, a failing call is still time spent
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        with self._lock:
+            values = [
+                (labels, list(counts), totals[0])
+                for labels, (counts, totals) in self._values.items()
+            ]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + "_bucket", labels + (("le", _format_value(bound)),), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+    def summary(self) -> dict:
+        with self._lock:
+            values = {
+                labels: (list(counts), list(totals))
+                for labels, (counts, totals) in self._values.items()
+            }
+        result = {}
+        for labels, (counts, (total, largest)) in values.items():
+            count = sum(counts)
+            result[_summary_key(labels)] = {
+                "count": count,
+                "sum": round(total, 4),
+                "mean": round(total / count, 4),
+                "p50": round(self._quantile(counts, 0.5, largest), 4),
+                "p90": round(self._quantile(counts, 0.9, largest), 4),
+                "p99": round(self._quantile(counts, 0.99, largest), 4),
+                "max": round(largest, 4),
+            }
+        return result
+
+    def _quantile(self, counts: list[int], q: float, largest: float) -> float:
+        # interpolated within the bucket it falls in, like prometheus' histogram_quantile
+        rank = q * sum(counts)
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = min(self.buckets[i], largest)
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return largest
+
+
+def _summary_key(labels: Labels) -> str:
+    return ",".join(value for _, value in labels) or "all"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+        self.started_at = time.time()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        # the prometheus text exposition format
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "seconds": round(time.time() - self.started_at, 3),
+            **{metric.name: metric.summary() for metric in self.metrics},
+        }
+
+    def write_summary(self, path: str, **extra):
+        with open(path, "w") as f:
+            json.dump({**self.summary(), **extra}, f, indent=2)
+        print(f"run summary written to {path}")
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.add(
+    Histogram(
+        "paperweight_stage_seconds",
+        "time spent per call of a stage: download, parse, chunk, embed, enrich, write, commit",
+    )
+)
+DOWNLOAD_BYTES = REGISTRY.add(Counter("paperweight_download_bytes", "pdf bytes downloaded"))
+API_REQUESTS = REGISTRY.add(Counter("paperweight_api_requests", "openai requests sent"))
+TOKENS_SENT = REGISTRY.add(Counter("paperweight_tokens_sent", "prompt tokens sent to openai"))
+RETRIES = REGISTRY.add(Counter("paperweight_retries", "calls retried, by what was retried"))
+PAPERS = REGISTRY.add(
+    Counter("paperweight_papers", "queued links by outcome: written, failed, retry or duplicate")
+)
+QUEUE_DEPTH = REGISTRY.add(
+    Gauge("paperweight_queue_depth", "items waiting between two pipeline stages")
+)
+
+
+def count_retry(kind: str) -> Callable:
+    # a tenacity before_sleep hook
+    return lambda retry_state: RETRIES.inc(kind=kind)
+
+
+def count_usage(endpoint: str, response):
+    API_REQUESTS.inc(endpoint=endpoint)
+    usage = getattr(response, "usage", None)
+    if usage is not None and usage.prompt_tokens:
+        TOKENS_SENT.inc(usage.prompt_tokens, endpoint=endpoint)
@@ -1,11 +1,11 @@
 from dataclasses import dataclass
-import base64, json
+import asyncio, hashlib, json
 from typing import Optional
-from fitz import Pixmap
 from tenacity import retry, wait_random_exponential, stop_after_attempt
+from metrics import RETRIES, STAGE_SECONDS, count_retry, count_usage
 
 
-@dataclass
+@dataclass(slots=True)
 class MyFile:
     full_path: str
     created_at: float
@@ -21,20 +21,94 @@ class MyFile:
         """
 
 
+# start and end are character offsets into the paper's text, papers.text[start:end]
+@dataclass(slots=True)
+class PaperChunk:
+    index: int
+    start: int
+    end: int
+    token_count: int
+    embedding: bytes = b""
+
+
+# a paper on its way to the db. slotted and without the pdf's bytes, it points at them
+# through `spool` or `pdf_sha256`. the text can live in a store instead (the work queue),
+# then it is read back each time a stage asks for it and an in flight paper is a few KB
 class Paper:
+    __slots__ = (
+        "url",
+        "status",
+        "spool",
+        "thumbnail",
+        "text_complete",
+        "pdf_sha256",
+        "thumbnail_sha256",
+        "text_length",
+        "simhash",
+        "store",
+        "_text",
+    )
+
     def __init__(
         self,
         url: str,
         status: str,
         text: Optional[str] = None,
-        blob: Optional[bytes] = None,
-        pic: Optional[Pixmap] = None,
+        spool=None,
+        thumbnail: Optional[bytes] = None,
+        text_complete: bool = True,
+        pdf_sha256: Optional[str] = None,
+        thumbnail_sha256: Optional[str] = None,
+        store=None,
+        text_length: int = 0,
+        simhash: Optional[int] = None,
     ):
         self.url = url
         self.status = status
-        self.text = text
-        self.blob = blob
-        self.pic = pic
+        # a text_extractor.PdfSpool, downloads are streamed to it instead of held in memory
+        self.spool = spool
+        # raw png of the first page, encoded once by the extract worker
+        self.thumbnail = thumbnail
+        # False when only the first pages were extracted, see LinkExtractor.complete_texts
+        self.text_complete = text_complete
+        # blob store keys of a pdf and thumbnail stored before the paper, see work_queue
+        self.pdf_sha256 = pdf_sha256
+        self.thumbnail_sha256 = thumbnail_sha256
+        # has read_text(url, limit) and read_chunks(url), for a paper whose text is stored
+        self.store = store
+        self._text = None
+        self.text_length = text_length
+        # dedup.simhash of the text, near duplicates of a stored paper are found with it
+        self.simhash = simhash
+        if text is not None:
+            self.text = text
+
+    @property
+    def text(self) -> Optional[str]:
+        return self.read_text()
+
+    @text.setter
+    def text(self, text: Optional[str]):
+        self._text = text
+        self.text_length = len(text) if text else 0
+
+    def read_text(self, limit: Optional[int] = None) -> Optional[str]:
+        # the first `limit` characters are all a store reads
+        if self._text is None and self.store is not None:
+            return self.store.read_text(self.url, limit)
+        if self._text is None or limit is None:
+            return self._text
+        return self._text[:limit]
+
+    def has_text(self) -> bool:
+        return self.text_length > 0
+
+    def blob_size(self) -> int:
+        return self.spool.size if self.spool is not None else 0
+
+    def release(self):
+        if self.spool is not None:
+            self.spool.close()
 
     def file_name(self):
         return self.url.split("/")[-1]
@@ -44,18 +118,33 @@ class Paper:
             Paper(
                 url={self.url},
                 status={self.status},
-                text_length={len(self.text) if self.text else 0}
-                blob_size={len(self.blob) if self.blob else 0}
-                pic_size={len(self.pic) if self.pic else 0}
+                text_length={self.text_length}
+                blob_size={self.blob_size()}
+                thumbnail_size={len(self.thumbnail) if self.thumbnail else 0}
             )
         """
 
 
 class ProcessedPaper(Paper):
+    __slots__ = (
+        "embedding",
+        "title",
+        "keywords",
+        "authors",
+        "abstract",
+        "published_date",
+        "summary",
+        "institution",
+        "location",
+        "data",
+        "_chunks",
+    )
+
     def __init__(self, paper: Paper):
-        super().__init__(paper.url, paper.status, paper.text, paper.blob, paper.pic)
-        self.encoded_pic: Optional[str] = None
+        for name in Paper.__slots__:
+            setattr(self, name, getattr(paper, name))
         self.embedding: bytes = b""
+        self._chunks: Optional[list[PaperChunk]] = None
         self.title = None
         self.keywords = []
         self.authors = []
@@ -64,26 +153,50 @@ class ProcessedPaper(Paper):
         self.summary = None
         self.institution = None
         self.location = None
+        # the extraction's raw json, checkpointed by the work queue
+        self.data: Optional[bytes] = None
 
-    def encode_pic(self):
-        if self.pic is None:
-            return
+    @property
+    def chunks(self) -> list[PaperChunk]:
+        # like the text, read back from the store when they aren't held
+        if self._chunks is None:
+            return self.store.read_chunks(self.url) if self.store is not None else []
+        return self._chunks
 
-        image_bytes = self.pic.tobytes("png")
-        self.encoded_pic = base64.b64encode(image_bytes).decode("utf-8")
+    @chunks.setter
+    def chunks(self, chunks: Optional[list[PaperChunk]]):
+        self._chunks = chunks
 
-    @retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(5))
-    def extract_data(self, client, model_name: str, ctx_length: int):
-        # LATER improve with 1 shotting
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": self.text[:ctx_length]}],
-            functions=extractor,
-            function_call={"name": "find_data"},
+    def extract_data(self, client, model_name: str, ctx_length: int, cache=None):
+        content, key, data = self._cached_data(model_name, ctx_length, cache)
+        if data is None:
+            with STAGE_SECONDS.time(stage="enrich"):
+                data = self._request_data(client, model_name, content).encode("utf-8")
+            if cache:
+                cache.put(key, data)
+        self.apply_data(data)
+
+    async def extract_data_async(self, api, model_name: str, ctx_length: int, cache=None):
+        # same as extract_data, on an async_api.AsyncApi. the cache and the text are read
+        # and written in a thread, sqlite would block every call in flight on the loop
+        content, key, data = await asyncio.to_thread(
+            self._cached_data, model_name, ctx_length, cache
         )
+        if data is None:
+            with STAGE_SECONDS.time(stage="enrich"):
+                data = await self._request_data_async(api, model_name, content)
+            if cache:
+                await asyncio.to_thread(cache.put, key, data)
+        self.apply_data(data)
 
-        data = response.choices[0].message.function_call.arguments
+    def _cached_data(self, model_name: str, ctx_length: int, cache) -> tuple:
+        content = self.read_text(ctx_length) or ""
+        key = cache.key("extract", model_name, EXTRACTOR_VERSION, content) if cache else None
+        return content, key, cache.get(key) if cache else None
+
+    def apply_data(self, data: bytes):
         json_data = json.loads(data)
+        self.data = data
 
         self.title = json_data.get("title")
         self.keywords = json_data.get("keywords")
@@ -94,6 +207,38 @@ class ProcessedPaper(Paper):
         self.institution = json_data.get("institution")
         self.location = json_data.get("location")
 
+    @retry(
+        wait=wait_random_exponential(min=1, max=10),
+        stop=stop_after_attempt(5),
+        before_sleep=count_retry("chat"),
+    )
+    def _request_data(self, client, model_name: str, content: str) -> str:
+        # LATER improve with 1 shotting
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=[{"role": "user", "content": content}],
+            functions=extractor,
+            function_call={"name": "find_data"},
+        )
+        count_usage("chat", response)
+
+        arguments = response.choices[0].message.function_call.arguments
+        # parse here so malformed json is retried like any other failure
+        json.loads(arguments)
+        return arguments
+
+    async def _request_data_async(self, api, model_name: str, content: str) -> bytes:
+        # api errors are retried by the api, malformed json here
+        for attempt in range(3):
+            arguments = await api.chat_function_call(model_name, content, extractor)
+            try:
+                json.loads(arguments)
+                return arguments.encode("utf-8")
+            except json.JSONDecodeError:
+                if attempt == 2:
+                    raise
+                RETRIES.inc(kind="chat")
+
     def __str__(self):
         base_str = super().__str__()
         return f"""
@@ -156,3 +301,6 @@ extractor = [
         "required": ["title"],
     }
 ]
+
+# cached extractions are keyed on this, editing the schema invalidates them
+EXTRACTOR_VERSION = hashlib.sha256(json.dumps(extractor, sort_keys=True).encode()).hexdigest()[:16]
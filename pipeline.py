@@ -0,0 +1,232 @@
+import functools, logging, queue, threading
+from typing import Callable, Iterable, Optional
+from models import MyFile
+from db import PaperWriter
+from work_queue import WorkItem, WorkQueue
+from metrics import QUEUE_DEPTH
+
+# marks the end of a queue, every worker puts it back so its siblings see it too
+_DONE = object()
+
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[list], list],
+        workers: int,
+        inbox: queue.Queue,
+        outbox: Optional[queue.Queue],
+        batch_size: int = 1,
+        batch_wait: float = 0.5,
+        on_error: Optional[Callable[[list, Exception], None]] = None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.inbox = inbox
+        self.outbox = outbox
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        # gets the batch `fn` raised on, so its items aren't dropped
+        self.on_error = on_error
+        self.threads: list[threading.Thread] = []
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+        threading.Thread(target=self._close, name=f"{self.name}-closer", daemon=True).start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _close(self):
+        self.join()
+        if self.outbox is not None:
+            self.outbox.put(_DONE)
+
+    def _work(self):
+        while True:
+            batch, done = self._take_batch()
+            if batch:
+                try:
+                    results = self.fn(batch)
+                except Exception as e:
+                    logging.info(f"{self.name} stage failed on {len(batch)} item(s): {e}")
+                    logging.exception(e)
+                    results = []
+                    if self.on_error is not None:
+                        try:
+                            self.on_error(batch, e)
+                        except Exception as error:
+                            logging.info(f"{self.name} stage couldn't hand its batch back: {error}")
+
+                if self.outbox is not None:
+                    for result in results:
+                        # blocks when the next stage is behind, which is our backpressure
+                        self.outbox.put(result)
+            if done:
+                self.inbox.put(_DONE)
+                return
+
+    def _take_batch(self) -> tuple[list, bool]:
+        item = self.inbox.get()
+        if item is _DONE:
+            return [], True
+
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self.inbox.get(timeout=self.batch_wait)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+
+class Pipeline:
+    def __init__(
+        self,
+        link_extractor,
+        download_workers: int = 8,
+        parse_workers: Optional[int] = None,
+        embed_batch_size: int = 100,
+        enrich_workers: int = 4,
+        queue_size: int = 32,
+    ):
+        self.link_extractor = link_extractor
+        self.db_name = link_extractor.db_name
+        self.download_workers = download_workers
+        # threads handing pdfs to the extract pool, one per worker process by default
+        self.parse_workers = parse_workers or link_extractor.extract_pool.workers
+        self.embed_batch_size = embed_batch_size
+        self.enrich_workers = enrich_workers
+        self.queue_size = queue_size
+
+    def run(self, jobs: Iterable[tuple[str, MyFile]]):
+        links = queue.Queue(maxsize=self.queue_size)
+        downloaded = queue.Queue(maxsize=self.queue_size)
+        parsed = queue.Queue(maxsize=self.queue_size)
+        embedded = queue.Queue(maxsize=self.queue_size)
+        processed = queue.Queue(maxsize=self.queue_size)
+
+        link_extractor = self.link_extractor
+        # scanned before the writer opens its transaction, the scan writes the md index
+        jobs = list(jobs)
+        with PaperWriter(self.db_name, batch_size=link_extractor.write_batch_size) as writer:
+            # the pipeline runs whatever is due in the work queue, new links and the ones
+            # an earlier run didn't finish
+            work = link_extractor.work_queue(writer)
+            work.enqueue(jobs)
+            # a batch a stage raised on goes back to the queue for a retry, instead of
+            # staying leased until the lease runs out. not for the write stage, whose
+            # items may already be written when it fails
+            failed = functools.partial(self._failed, work)
+
+            stages = [
+                Stage(
+                    "download",
+                    lambda batch: link_extractor.fetch_items(work, batch),
+                    self.download_workers,
+                    links,
+                    downloaded,
+                    on_error=failed,
+                ),
+                Stage(
+                    "parse",
+                    lambda batch: link_extractor.extract_items(work, batch),
+                    self.parse_workers,
+                    downloaded,
+                    parsed,
+                    on_error=failed,
+                ),
+                Stage(
+                    "embed",
+                    lambda batch: link_extractor.embed_items(work, batch),
+                    1,
+                    parsed,
+                    embedded,
+                    batch_size=self.embed_batch_size,
+                    batch_wait=2.0,
+                    on_error=failed,
+                ),
+                self._enrich_stage(work, embedded, processed),
+                # sqlite gets a single writer, each batch it takes is one transaction
+                Stage(
+                    "write",
+                    lambda batch: self._write(work, writer, batch),
+                    1,
+                    processed,
+                    None,
+                    batch_size=link_extractor.write_batch_size,
+                    batch_wait=1.0,
+                ),
+            ]
+            # how far behind each stage is, on /metrics while the run goes
+            depths = dict(
+                links=links,
+                downloaded=downloaded,
+                parsed=parsed,
+                embedded=embedded,
+                processed=processed,
+            )
+            for name, inbox in depths.items():
+                QUEUE_DEPTH.track(inbox.qsize, queue=name)
+
+            for stage in stages:
+                stage.start()
+
+            try:
+                for item in work.claim_all():
+                    links.put(item)
+            finally:
+                # also when claiming raised, the stages finish what they hold and stop
+                # before the writer under them is closed
+                links.put(_DONE)
+                for stage in stages:
+                    stage.join()
+                for name in depths:
+                    QUEUE_DEPTH.untrack(queue=name)
+            link_extractor.log_queue(work)
+
+    def _enrich(self, work: WorkQueue, batch: list[WorkItem]) -> list[WorkItem]:
+        for item in batch:
+            print(f"processing {item.paper.file_name()}")
+        return self.link_extractor.enrich_items(work, batch)
+
+    def _failed(self, work: WorkQueue, batch: list[WorkItem], error: Exception):
+        for item in batch:
+            work.failed(item, error)
+
+    def _enrich_stage(self, work: WorkQueue, inbox: queue.Queue, outbox: queue.Queue) -> Stage:
+        api = self.link_extractor.async_api
+        enrich = functools.partial(self._enrich, work)
+        failed = functools.partial(self._failed, work)
+        if api is None:
+            return Stage("enrich", enrich, self.enrich_workers, inbox, outbox, on_error=failed)
+        # one thread is enough, each batch is sent concurrently on the api's event loop
+        return Stage(
+            "enrich",
+            enrich,
+            1,
+            inbox,
+            outbox,
+            batch_size=api.max_in_flight,
+            batch_wait=0.5,
+            on_error=failed,
+        )
+
+    def _write(self, work: WorkQueue, writer: PaperWriter, batch: list[WorkItem]) -> list:
+        for item in batch:
+            work.write(item)
+        writer.flush()
+        return []
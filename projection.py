@@ -0,0 +1,96 @@
+import threading
+from typing import Optional
+import numpy as np
+from sklearn.decomposition import PCA
+from dash_state import DashState
+
+FIT_SAMPLE = 20_000  #      vectors the basis is fitted on
+REBASE_GROWTH = 2  #        the basis is refit each time the library doubles
+MAX_POINTS = 20_000  #      most points ever sent to the browser
+TRANSFORM_CHUNK = 65_536
+
+
+# 3d coordinates for every paper with an embedding, aligned with DashState positions.
+# the pca basis is cached, so a refresh only projects the rows that changed. it is only
+# refit (and everything reprojected) once the library has doubled since the last fit
+class Projection:
+    def __init__(self, state: DashState, seed: int = 0):
+        self.state = state
+        self.version = 0
+        self.components: Optional[np.ndarray] = None
+        self.offset: Optional[np.ndarray] = None
+        self.basis_size = 0
+        self.coords = np.zeros((0, 3), dtype=np.float32)
+        self.projected = np.zeros(0, dtype=bool)
+        # a fixed random rank per paper, the sample shown is always the lowest ranks so
+        # points don't jump around between refreshes and a finer level only adds points
+        self._rng = np.random.default_rng(seed)
+        self.rank = np.zeros(0, dtype=np.float64)
+        self._lock = threading.Lock()
+
+    def update(self) -> int:
+        with self._lock:
+            version, positions, vectors = self.state.changed_since(self.version)
+            self._grow(self.state.size)
+            # rows replaced without an embedding drop out
+            self.projected[: self.state.size] &= self.state.has_embedding[: self.state.size]
+
+            total = int(self.projected.sum()) + int((~self.projected[positions]).sum())
+            if total <= 3:
+                # too few to fit a basis, they are picked up again on the next update
+                return 0
+
+            if self.components is None or total >= self.basis_size * REBASE_GROWTH:
+                self._fit(total)
+                positions, vectors = self.state.vectors()
+
+            for start in range(0, len(positions), TRANSFORM_CHUNK):
+                chunk = positions[start : start + TRANSFORM_CHUNK]
+                self.coords[chunk] = self._transform(vectors[start : start + TRANSFORM_CHUNK])
+            self.projected[positions] = True
+            self.version = version
+            return len(positions)
+
+    def sample(self, max_points: int) -> np.ndarray:
+        # positions to draw, at most `max_points` of them
+        with self._lock:
+            positions = np.flatnonzero(self.projected)
+            max_points = min(max_points, MAX_POINTS)
+            if len(positions) <= max_points:
+                return positions
+            keep = np.argpartition(self.rank[positions], max_points - 1)[:max_points]
+            return np.sort(positions[keep])
+
+    def _fit(self, total: int):
+        positions, vectors = self.state.vectors()
+        if len(positions) > FIT_SAMPLE:
+            rng = np.random.default_rng(0)
+            vectors = vectors[np.sort(rng.choice(len(positions), FIT_SAMPLE, replace=False))]
+
+        pca = PCA(n_components=3, svd_solver="randomized", random_state=0).fit(vectors)
+        components = pca.components_.astype(np.float32)
+        if self.components is not None:
+            # keep the axes pointing the same way as before the refit
+            signs = np.sign(np.sum(components * self.components, axis=1))
+            components *= np.where(signs == 0, 1, signs)[:, None]
+
+        self.components = components
+        # (x - mean) @ C.T without materializing x - mean
+        self.offset = pca.mean_.astype(np.float32) @ components.T
+        self.basis_size = total
+
+    def _transform(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors @ self.components.T - self.offset
+
+    def _grow(self, needed: int):
+        capacity = self.projected.shape[0]
+        if needed <= capacity:
+            return
+
+        capacity = max(capacity * 2, needed)
+        coords = np.zeros((capacity, 3), dtype=np.float32)
+        coords[: len(self.coords)] = self.coords
+        projected = np.zeros(capacity, dtype=bool)
+        projected[: len(self.projected)] = self.projected
+        self.coords, self.projected = coords, projected
+        self.rank = np.concatenate([self.rank, self._rng.random(capacity - len(self.rank))])
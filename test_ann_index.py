@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import pytest
+import ann_index
+from ann_index import AnnIndex
+from db import init_db, insert_paper
+from embedding_codec import encode_embedding
+from models import MyFile, Paper, ProcessedPaper
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = AnnIndex(str(tmp_path / "papers.ann"))
+    yield index
+    index.close()
+
+
+def clusters(n: int, dim: int = 16, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(8, dim))
+    return (centers[rng.integers(8, size=n)] + 0.1 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def test_exact_search_before_training(index):
+    vectors = clusters(100)
+    index.add([f"u{i}" for i in range(100)], vectors)
+
+    assert len(index) == 100
+    assert index.search(vectors[7], k=1)[0][0] == "u7"
+    assert [url for url, _ in index.similar_to("u7", k=3)] != ["u7"]
+    with pytest.raises(KeyError):
+        index.similar_to("missing")
+
+
+def test_replaced_and_removed_keys(index):
+    vectors = clusters(20)
+    index.add([f"u{i}" for i in range(20)], vectors)
+    index.add(["u0"], vectors[1:2])
+    index.add_blobs(["u2"], [b""])
+
+    assert len(index) == 19
+    assert np.allclose(index.vector("u0"), index.vector("u1"))
+    assert index.vector("u2") is None
+    urls = [url for url, _ in index.search(vectors[2], k=20)]
+    assert "u2" not in urls and urls.count("u0") == 1
+
+
+def test_trained_index_reads_only_probed_lists(index, monkeypatch):
+    monkeypatch.setattr(ann_index, "TRAIN_MIN", 500)
+    vectors = clusters(2000)
+    for start in range(0, 2000, 100):
+        index.add([f"u{i}" for i in range(start, start + 100)], vectors[start : start + 100])
+
+    assert index.centroids is not None and index.nlist > 1
+    # rewritten as it grew, only the last generation's files are kept
+    generations = {name.split(".")[1] for name in os.listdir(index.path) if name[0] != "i"}
+    assert generations == {str(index.meta["generation"])}
+    assert index.meta["built"] > 0
+
+    hits = index.search(vectors[1234], k=5)
+    assert hits[0][0] == "u1234"
+    assert hits == AnnIndex(index.path).search(vectors[1234], k=5)
+
+    index.add(["u1234"], vectors[:1])
+    assert index.search(vectors[1234], k=1)[0][0] != "u1234"
+    assert index.search(vectors[0], k=2)[1][0] in {"u0", "u1234"}
+
+
+def test_sync_follows_replaced_papers(tmp_path):
+    db_name = str(tmp_path / "papers.db")
+    init_db(db_name)
+
+    def store(url: str, embedding: list[float], replace: bool = False):
+        paper = ProcessedPaper(Paper(url, "success_and_processed", text="text"))
+        paper.embedding = encode_embedding(embedding) if embedding else b""
+        insert_paper(paper, MyFile("notes.md", 0.0, 0.0), db_name, replace=replace)
+
+    store("https://example.com/a.pdf", [1.0, 0.0])
+    store("https://example.com/b.pdf", [0.0, 1.0])
+    # an index that missed the writes
+    index = AnnIndex(str(tmp_path / "other.ann"))
+    assert index.sync(db_name) == 2
+    assert index.sync(db_name) == 0
+
+    store("https://example.com/a.pdf", [0.0, 1.0], replace=True)
+    store("https://example.com/b.pdf", [], replace=True)
+    assert index.sync(db_name) == 2
+    assert len(index) == 1
+    assert np.allclose(index.vector("https://example.com/a.pdf"), [0.0, 1.0])
+
+    # the writer keeps the index next to the db up to date itself
+    writer_index = AnnIndex.for_db(db_name)
+    assert writer_index.vector("https://example.com/b.pdf") is None
+    assert np.allclose(writer_index.vector("https://example.com/a.pdf"), [0.0, 1.0])
+    index.close()
+    writer_index.close()
@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from api_cache import ApiCache
+from embedding_batcher import EmbeddingBatcher
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ApiCache(str(tmp_path / "cache.db"))
+    yield cache
+    cache.close()
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.requests = 0
+
+    def create(self, model: str, input: list[str]):
+        self.requests += 1
+        data = [
+            SimpleNamespace(index=i, embedding=[float(len(text)), 1.0])
+            for i, text in enumerate(input)
+        ]
+        return SimpleNamespace(data=data, usage=None)
+
+
+def test_put_many_is_one_commit(cache):
+    commits = []
+    cache._conn.set_trace_callback(lambda sql: sql == "COMMIT" and commits.append(sql))
+    cache.put_many([(f"key{i}", b"x" * i) for i in range(1, 101)])
+
+    assert len(commits) == 1
+    assert cache.get("key7") == b"xxxxxxx"
+    assert cache.total_bytes == sum(range(1, 101))
+
+
+def test_put_many_evicts_least_recently_used(tmp_path):
+    cache = ApiCache(str(tmp_path / "cache.db"), max_bytes=30)
+    cache.put_many([("a", b"x" * 10), ("b", b"x" * 10)])
+    cache.get("a")
+    cache.put_many([("c", b"x" * 10), ("d", b"x" * 5)])
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.total_bytes == 25
+    cache.close()
+
+
+def test_embeddings_are_cached_per_request(cache):
+    embeddings = FakeEmbeddings()
+    batcher = EmbeddingBatcher(
+        SimpleNamespace(embeddings=embeddings), "model", cache=cache, max_inputs=2
+    )
+    texts = ["one", "three", "fifteen", ""]
+
+    first = batcher.embed(texts, token_counts=[1, 1, 1, 0])
+    assert embeddings.requests == 2
+    assert batcher.embed(texts, token_counts=[1, 1, 1, 0]) == first
+    assert embeddings.requests == 2
+    assert np.allclose(first[1], [5.0, 1.0])
+    assert first[3] == []
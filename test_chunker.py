@@ -0,0 +1,67 @@
+import sqlite3
+import pytest
+import tiktoken
+from chunker import chunk_offsets, chunk_text
+from db import init_db, insert_paper
+from models import MyFile, Paper, ProcessedPaper
+
+
+@pytest.fixture
+def encoding():
+    # one token per byte, so multi byte characters are split across tokens
+    return tiktoken.Encoding(
+        "bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+
+
+def test_chunks_are_offsets_into_the_text(encoding):
+    text = "naïve résumé " * 20
+    chunks = chunk_text(text, encoding, chunk_tokens=50, overlap=10)
+
+    assert chunks[0].start == 0 and chunks[-1].end == len(text)
+    assert all(chunk.token_count <= 50 for chunk in chunks)
+    assert all(a.start < b.start < a.end for a, b in zip(chunks, chunks[1:]))
+    # a slice is the window's text, up to a character the window split
+    for chunk in chunks:
+        tokens = encoding.encode(text)
+        window = encoding.decode(tokens[chunk.index * 40 : chunk.index * 40 + 50])
+        assert window.strip("�") in text[chunk.start : chunk.end]
+
+
+def test_chunk_offsets_of_copies():
+    text = "one two three two one"
+    assert chunk_offsets(text, ["two three", "three two", "�one", "missing"]) == [
+        (4, 13),
+        (8, 17),
+        (18, 21),
+        None,
+    ]
+
+
+def test_old_chunk_text_is_moved_to_offsets(tmp_path, encoding):
+    db_name = str(tmp_path / "papers.db")
+    init_db(db_name)
+    text = " ".join(f"word{i}" for i in range(100))
+    paper = ProcessedPaper(Paper("https://example.com/a.pdf", "success_and_processed", text=text))
+    paper.chunks = chunk_text(text, encoding, chunk_tokens=64, overlap=16)
+    insert_paper(paper, MyFile("notes.md", 0.0, 0.0), db_name)
+
+    # as written before chunks were offsets
+    conn = sqlite3.connect(db_name)
+    conn.execute("ALTER TABLE paper_chunks ADD COLUMN text TEXT")
+    conn.execute(
+        "UPDATE paper_chunks SET text = substr(?, start_char + 1, end_char - start_char)", (text,)
+    )
+    conn.execute("UPDATE paper_chunks SET start_char = NULL, end_char = NULL")
+    conn.commit()
+    init_db(db_name)
+
+    rows = conn.execute(
+        "SELECT chunk_index, start_char, end_char FROM paper_chunks ORDER BY chunk_index"
+    ).fetchall()
+    assert rows == [(chunk.index, chunk.start, chunk.end) for chunk in paper.chunks]
+    assert "text" not in {row[1] for row in conn.execute("PRAGMA table_info(paper_chunks)")}
+    conn.close()
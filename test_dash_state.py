@@ -0,0 +1,58 @@
+import pytest
+from dash_state import DashState
+from db import ReaderPool, fetch_papers_as_df, init_db, insert_paper
+from models import MyFile, Paper, ProcessedPaper
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    name = str(tmp_path / "papers.db")
+    init_db(name)
+    return name
+
+
+def store(db_name: str, url: str, title: str, replace: bool = False):
+    paper = ProcessedPaper(Paper(url, "success_and_processed", text="text"))
+    paper.title = title
+    insert_paper(paper, MyFile("notes.md", 0.0, 0.0), db_name, replace=replace)
+
+
+def titles(state: DashState) -> dict[str, str]:
+    frame = state.frame()
+    return dict(zip(frame["url"], frame["title"]))
+
+
+def test_refresh_reads_only_new_rows(db_name):
+    store(db_name, "https://example.com/1.pdf", "one")
+    state = DashState(ReaderPool(db_name, size=1))
+    assert state.refresh() == 1
+    assert state.refresh() == 0
+
+    store(db_name, "https://example.com/2.pdf", "two")
+    assert state.refresh() == 1
+    assert state.size == 2
+
+
+def test_refresh_sees_a_replaced_newest_paper(db_name):
+    for i in range(1, 4):
+        store(db_name, f"https://example.com/{i}.pdf", "old")
+    state = DashState(ReaderPool(db_name, size=1))
+    assert state.refresh() == 3
+
+    # replacing the newest row can give it back the same rowid
+    store(db_name, "https://example.com/3.pdf", "new", replace=True)
+    assert state.refresh() == 1
+    store(db_name, "https://example.com/2.pdf", "new", replace=True)
+    assert state.refresh() == 1
+    assert state.size == 3
+    assert titles(state) == {
+        "https://example.com/1.pdf": "old",
+        "https://example.com/2.pdf": "new",
+        "https://example.com/3.pdf": "new",
+    }
+
+
+def test_fetch_papers_as_df_takes_a_path(db_name):
+    store(db_name, "https://example.com/1.pdf", "one")
+    assert list(fetch_papers_as_df(db_name)["title"]) == ["one"]
+    assert list(fetch_papers_as_df(ReaderPool(db_name, size=1))["title"]) == ["one"]
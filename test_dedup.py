@@ -0,0 +1,170 @@
+import random, sqlite3
+import pytest
+from db import init_db
+from dedup import (
+    BANDS,
+    MAX_DISTANCE,
+    add_fingerprint,
+    bands,
+    distance,
+    fill_fingerprints,
+    find_duplicate,
+    simhash,
+    url_key,
+)
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://arxiv.org/abs/2101.00001",
+        "https://arxiv.org/abs/2101.00001v2",
+        "https://arxiv.org/pdf/2101.00001",
+        "https://arxiv.org/pdf/2101.00001v3.pdf",
+        "http://www.arxiv.org/pdf/2101.00001.pdf",
+        "https://export.arxiv.org/abs/2101.00001/",
+        "https://arxiv.org/abs/2101.00001?utm_source=twitter#section",
+    ],
+)
+def test_arxiv_variants_share_a_key(url):
+    assert url_key(url) == "arxiv:2101.00001"
+
+
+def test_old_style_arxiv_ids():
+    assert url_key("https://arxiv.org/abs/hep-th/9901001v1") == "arxiv:hep-th/9901001"
+    assert url_key("https://xxx.lanl.gov/pdf/math.GT/0309136") == "arxiv:math.GT/0309136"
+    assert url_key("https://arxiv.org/abs/2101.00001") != url_key(
+        "https://arxiv.org/abs/2101.00002"
+    )
+
+
+def test_tracking_params_are_stripped_and_query_sorted():
+    assert (
+        url_key("https://example.com/paper.pdf?utm_source=x&b=2&fbclid=y&a=1&ref=feed")
+        == url_key("https://example.com/paper.pdf?a=1&b=2")
+        == "https://example.com/paper.pdf?a=1&b=2"
+    )
+
+
+def test_scheme_www_port_and_fragment_are_ignored():
+    key = url_key("https://example.com/paper.pdf")
+    assert url_key("http://www.example.com/paper.pdf") == key
+    assert url_key("https://example.com:443/paper.pdf/") == key
+    assert url_key("https://EXAMPLE.com/paper.pdf#page=2") == key
+    assert url_key("https://example.com:8443/paper.pdf") != key
+
+
+def test_non_arxiv_hosts_stay_distinct():
+    assert url_key("https://mirror.org/abs/2101.00001") == "https://mirror.org/abs/2101.00001"
+    assert url_key("https://example.com/a.pdf") != url_key("https://example.org/a.pdf")
+    assert url_key("https://example.com/a.pdf") != url_key("https://example.com/b.pdf")
+    # a param that picks the file isn't tracking
+    assert url_key("https://example.com/get?id=1") != url_key("https://example.com/get?id=2")
+
+
+def words(seed: int, n: int = 500) -> list[str]:
+    rng = random.Random(seed)
+    return [f"word{rng.randrange(5000)}" for _ in range(n)]
+
+
+def test_simhash_needs_enough_text():
+    assert simhash(None) is None
+    assert simhash(" ".join(words(0, 10))) is None
+
+
+def test_simhash_is_close_for_near_duplicates():
+    text = words(1)
+    edited = text[:250] + ["inserted"] + text[250:]
+    assert distance(simhash(" ".join(text)), simhash(" ".join(edited))) <= MAX_DISTANCE
+    assert distance(simhash(" ".join(text)), simhash(" ".join(words(2)))) > MAX_DISTANCE
+
+
+def test_bands_pigeonhole():
+    # MAX_DISTANCE flipped bits fall in at most MAX_DISTANCE of the BANDS bands
+    assert BANDS > MAX_DISTANCE
+    rng = random.Random(3)
+    for _ in range(2000):
+        value = rng.getrandbits(64) - (1 << 63)
+        other = value
+        for bit in rng.sample(range(64), rng.randint(0, MAX_DISTANCE)):
+            other ^= 1 << bit
+        other = (other + (1 << 63)) % (1 << 64) - (1 << 63)
+        assert distance(value, other) <= MAX_DISTANCE
+        assert set(bands(value)) & set(bands(other))
+
+
+def test_bands_round_trip():
+    value = -0x123456789ABCDEF
+    unsigned = sum(bits << (band * 64 // BANDS) for band, bits in bands(value))
+    assert unsigned == value & ((1 << 64) - 1)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    name = str(tmp_path / "papers.db")
+    init_db(name)
+    conn = sqlite3.connect(name)
+    yield conn
+    conn.close()
+
+
+def store(conn: sqlite3.Connection, url: str, status: str = "success", **columns):
+    names = ["url", "status", "url_key", *columns]
+    conn.execute(
+        f"INSERT INTO papers ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+        (url, status, url_key(url), *columns.values()),
+    )
+
+
+def test_find_duplicate_by_url_key(conn):
+    store(conn, "https://arxiv.org/abs/2101.00001")
+    url = "https://arxiv.org/pdf/2101.00001v2.pdf"
+    assert find_duplicate(conn, url, key=url_key(url)) == (
+        "https://arxiv.org/abs/2101.00001",
+        "url",
+    )
+    # a paper isn't its own duplicate
+    url = "https://arxiv.org/abs/2101.00001"
+    assert find_duplicate(conn, url, key=url_key(url)) is None
+
+
+def test_failed_papers_are_not_duplicates(conn):
+    store(conn, "https://arxiv.org/abs/2101.00001", status="unable_to_fetch")
+    url = "https://arxiv.org/pdf/2101.00001"
+    assert find_duplicate(conn, url, key=url_key(url)) is None
+
+
+def test_find_duplicate_by_pdf_and_text(conn):
+    store(conn, "https://example.com/a.pdf", pdf_sha256="abc")
+    assert find_duplicate(conn, "https://mirror.org/a.pdf", pdf_sha256="abc") == (
+        "https://example.com/a.pdf",
+        "pdf",
+    )
+
+    fingerprint = simhash(" ".join(words(4)))
+    store(conn, "https://example.com/b.pdf")
+    add_fingerprint(conn, "https://example.com/b.pdf", fingerprint)
+    close = fingerprint ^ 0b101
+    far = fingerprint ^ 0xFFFF
+    assert find_duplicate(conn, "https://mirror.org/b.pdf", fingerprint=close) == (
+        "https://example.com/b.pdf",
+        "text",
+    )
+    assert find_duplicate(conn, "https://mirror.org/b.pdf", fingerprint=far) is None
+
+
+def test_old_papers_are_fingerprinted(conn):
+    text = " ".join(words(5))
+    store(conn, "https://example.com/a.pdf", text=text)
+    store(conn, "https://example.com/b.pdf", status="unable_to_fetch", text=text)
+    # as in a db from before fingerprints
+    conn.execute("DELETE FROM counters WHERE name = 'fingerprints'")
+    fill_fingerprints(conn)
+
+    assert find_duplicate(conn, "https://mirror.org/a.pdf", fingerprint=simhash(text)) == (
+        "https://example.com/a.pdf",
+        "text",
+    )
+    assert conn.execute("SELECT value FROM counters WHERE name = 'fingerprints'").fetchone() == (
+        -1,
+    )
@@ -0,0 +1,66 @@
+import threading
+from types import SimpleNamespace
+import pytest
+from db import init_db
+from pipeline import Pipeline
+
+
+class FakeQueue:
+    def __init__(self, writer):
+        self.writer = writer
+
+    def enqueue(self, jobs):
+        pass
+
+    def claim_all(self):
+        yield SimpleNamespace(url="https://example.com/a.pdf")
+        raise ConnectionError("db went away")
+
+
+class FakeExtractor:
+    def __init__(self, db_name: str):
+        self.db_name = db_name
+        self.write_batch_size = 1
+        self.extract_pool = SimpleNamespace(workers=2)
+        self.async_api = None
+        self.writes = []
+
+    def work_queue(self, writer):
+        return FakeQueue(writer)
+
+    def fetch_items(self, work, batch):
+        return batch
+
+    def extract_items(self, work, batch):
+        return batch
+
+    def embed_items(self, work, batch):
+        return batch
+
+    def enrich_items(self, work, batch):
+        return batch
+
+
+def test_stages_stop_when_claiming_fails(tmp_path, monkeypatch):
+    db_name = str(tmp_path / "papers.db")
+    init_db(db_name)
+    extractor = FakeExtractor(db_name)
+    pipeline = Pipeline(extractor)
+    # the write stage sees whether its writer is still open
+    monkeypatch.setattr(
+        Pipeline,
+        "_write",
+        lambda self, work, writer, batch: extractor.writes.extend(
+            (item.url, writer.conn.execute("SELECT 1").fetchone()) for item in batch
+        )
+        or [],
+    )
+    monkeypatch.setattr(Pipeline, "_enrich", lambda self, work, batch: batch)
+
+    with pytest.raises(ConnectionError):
+        pipeline.run([])
+    assert extractor.writes == [("https://example.com/a.pdf", (1,))]
+    # every stage's workers have exited
+    names = ("download", "parse", "embed", "enrich", "write")
+    workers = [t for t in threading.enumerate() if t.name.split("-")[0] in names]
+    assert [t.name for t in workers if not t.name.endswith("closer")] == []
@@ -0,0 +1,36 @@
+import fitz
+import pytest
+from text_extractor import read_pdf
+
+
+def make_pdf(*pages: str) -> bytes:
+    doc = fitz.open()
+    for text in pages:
+        doc.new_page().insert_text((72, 72), text)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+@pytest.fixture
+def pdf():
+    return make_pdf("first page", "second page")
+
+
+def test_text_that_fits_is_complete(pdf):
+    text, _, complete = read_pdf(pdf)
+    assert "second page" in text and complete
+
+    # exactly max_chars long, nothing was left out
+    text, _, complete = read_pdf(pdf, max_chars=len(text))
+    assert complete
+
+
+def test_text_cut_short_is_incomplete(pdf):
+    full, _, _ = read_pdf(pdf)
+    # the second page is never parsed
+    text, _, complete = read_pdf(pdf, max_chars=len(full.split("second")[0]))
+    assert "second" not in text and not complete
+
+    text, _, complete = read_pdf(pdf, max_chars=len(full) - 1)
+    assert text == full[:-1] and not complete
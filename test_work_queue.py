@@ -0,0 +1,251 @@
+import os, socket, sqlite3, time
+import pytest
+from db import PaperWriter, init_db
+from extract_pool import ExtractError, ExtractTimeoutError
+from models import MyFile
+from work_queue import WorkQueue
+
+
+@pytest.fixture
+def db_name(tmp_path):
+    name = str(tmp_path / "papers.db")
+    init_db(name)
+    return name
+
+
+@pytest.fixture
+def writer(db_name):
+    writer = PaperWriter(db_name)
+    yield writer
+    writer.close()
+
+
+def queue_row(db_name: str, url: str):
+    conn = sqlite3.connect(db_name)
+    try:
+        return conn.execute(
+            "SELECT stage, attempts, next_attempt_at, lease_until, lease_owner FROM work_queue"
+            " WHERE url = ?",
+            (url,),
+        ).fetchone()
+    finally:
+        conn.close()
+
+
+def paper_status(db_name: str, url: str):
+    conn = sqlite3.connect(db_name)
+    try:
+        row = conn.execute("SELECT status FROM papers WHERE url = ?", (url,)).fetchone()
+    finally:
+        conn.close()
+    return row and row[0]
+
+
+def enqueue(queue: WorkQueue, *urls: str):
+    queue.enqueue((url, MyFile("notes.md", 0.0, 0.0)) for url in urls)
+
+
+def note_links(writer: PaperWriter, path: str, *urls: str):
+    with writer.transaction() as conn:
+        conn.execute(
+            "INSERT INTO md_files (path, mtime, ctime, size) VALUES (?, 0.0, 0.0, 0)", (path,)
+        )
+        conn.executemany(
+            "INSERT INTO md_links (path, url) VALUES (?, ?)", [(path, url) for url in urls]
+        )
+
+
+def test_lease_blocks_a_second_claim(writer):
+    first = WorkQueue(writer)
+    second = WorkQueue(writer)
+    enqueue(first, "https://example.com/a.pdf", "https://example.com/b.pdf")
+
+    assert [item.url for item in first.claim(limit=1)] == ["https://example.com/a.pdf"]
+    assert [item.url for item in second.claim()] == ["https://example.com/b.pdf"]
+    assert second.claim() == []
+
+
+def test_expired_lease_is_claimed_again(writer):
+    queue = WorkQueue(writer, lease_seconds=-1)
+    enqueue(queue, "https://example.com/a.pdf")
+
+    assert len(queue.claim()) == 1
+    assert len(queue.claim()) == 1
+
+
+def test_dead_owners_leases_are_released(writer, db_name):
+    queue = WorkQueue(writer)
+    enqueue(queue, "https://example.com/a.pdf", "https://example.com/b.pdf")
+    queue.claim()
+    # a run on this host whose process is gone, and one on another host
+    with writer.transaction() as conn:
+        conn.execute(
+            "UPDATE work_queue SET lease_owner = ? WHERE url = ?",
+            (f"{socket.gethostname()}:999999999:dead", "https://example.com/a.pdf"),
+        )
+        conn.execute(
+            "UPDATE work_queue SET lease_owner = ? WHERE url = ?",
+            ("elsewhere:999999999:other", "https://example.com/b.pdf"),
+        )
+
+    assert queue.release_dead_leases() == 1
+    writer.flush()
+    assert queue_row(db_name, "https://example.com/a.pdf")[3] is None
+    assert queue_row(db_name, "https://example.com/b.pdf")[3] is not None
+    assert [item.url for item in queue.claim()] == ["https://example.com/a.pdf"]
+
+
+def test_own_leases_are_kept(writer):
+    queue = WorkQueue(writer)
+    enqueue(queue, "https://example.com/a.pdf")
+    queue.claim()
+
+    assert queue.release_dead_leases() == 0
+    assert queue.claim() == []
+    # another queue in this process, like the next run in watch mode
+    assert WorkQueue(writer).claim() == []
+
+
+def test_earlier_process_with_our_pid_is_dead(writer):
+    queue = WorkQueue(writer)
+    enqueue(queue, "https://example.com/a.pdf")
+    queue.claim()
+    with writer.transaction() as conn:
+        conn.execute(
+            "UPDATE work_queue SET lease_owner = ?",
+            (f"{socket.gethostname()}:{os.getpid()}:earlier:run",),
+        )
+
+    assert queue.release_dead_leases() == 1
+    assert len(queue.claim()) == 1
+
+
+def test_failed_item_is_retried_with_backoff(writer, db_name):
+    queue = WorkQueue(writer, retry_delay=60)
+    enqueue(queue, "https://example.com/a.pdf")
+
+    [item] = queue.claim()
+    before = time.time()
+    queue.failed(item, ExtractTimeoutError("no result after 120s"))
+    writer.flush()
+    stage, attempts, next_attempt_at, lease_until, _ = queue_row(db_name, item.url)
+    assert (stage, attempts, lease_until) == ("queued", 1, None)
+    assert before + 60 <= next_attempt_at <= time.time() + 60
+    # not due yet
+    assert queue.claim() == []
+
+    before = time.time()
+    queue.failed(item, ExtractTimeoutError("no result after 120s"))
+    writer.flush()
+    _, attempts, next_attempt_at, _, _ = queue_row(db_name, item.url)
+    assert attempts == 2
+    assert before + 120 <= next_attempt_at <= time.time() + 120
+
+
+def test_retry_keeps_finished_stages(writer, db_name):
+    queue = WorkQueue(writer, retry_delay=0)
+    enqueue(queue, "https://example.com/a.pdf")
+
+    [item] = queue.claim()
+    queue.extracted(item, "some text", None, True)
+    queue.failed(item, ConnectionError("reset"))
+    [item] = queue.claim()
+    assert (item.stage, item.attempts) == ("extracted", 1)
+    assert queue.read_text(item.url) == "some text"
+
+
+def test_permanent_error_writes_a_failed_paper(writer, db_name):
+    queue = WorkQueue(writer)
+    enqueue(queue, "https://example.com/a.pdf")
+
+    [item] = queue.claim()
+    queue.failed(item, ExtractError("not a pdf"))
+    writer.flush()
+    assert queue_row(db_name, item.url) is None
+    assert paper_status(db_name, item.url) == "processing_failed"
+
+
+def test_last_attempt_writes_a_failed_paper(writer, db_name):
+    queue = WorkQueue(writer, retry_delay=0, max_attempts=2)
+    enqueue(queue, "https://example.com/a.pdf")
+
+    [item] = queue.claim()
+    queue.failed(item, ExtractTimeoutError("no result after 120s"))
+    [item] = queue.claim()
+    queue.failed(item, ExtractTimeoutError("no result after 120s"))
+    writer.flush()
+    assert queue_row(db_name, item.url) is None
+    assert paper_status(db_name, item.url) == "processing_failed"
+    assert queue.claim() == []
+
+
+def test_duplicates_of_a_failed_link_are_queued_again(writer, db_name):
+    queue = WorkQueue(writer)
+    canonical, mirror = "https://arxiv.org/abs/2101.00001", "https://arxiv.org/pdf/2101.00001"
+    note_links(writer, "notes.md", canonical, mirror)
+    enqueue(queue, canonical, mirror)
+
+    first, second = queue.claim()
+    assert not queue.alias_duplicate(first)
+    assert queue.alias_duplicate(second)
+    assert queue.claim() == []
+
+    queue.failed(first, ExtractError("not a pdf"))
+    [item] = queue.claim()
+    assert item.url == mirror
+    # the failed paper doesn't make it a duplicate again
+    assert not queue.alias_duplicate(item)
+    writer.flush()
+    assert paper_status(db_name, canonical) == "processing_failed"
+
+
+def store_failed(writer: PaperWriter, url: str, status: str, written_at):
+    with writer.transaction() as conn:
+        conn.execute(
+            "INSERT INTO papers (url, status, file_path, written_at) VALUES (?, ?, 'notes.md', ?)",
+            (url, status, written_at),
+        )
+
+
+def test_failed_papers_are_queued_again(writer):
+    # from before the queue, saved a moment ago, and a paper no retry will fix
+    store_failed(writer, "https://example.com/old.pdf", "unable_to_fetch", None)
+    store_failed(writer, "https://example.com/new.pdf", "processing_failed", time.time())
+    store_failed(writer, "https://example.com/big.pdf", "pdf_too_large", None)
+
+    assert [item.url for item in WorkQueue(writer).claim()] == ["https://example.com/old.pdf"]
+    queue = WorkQueue(writer, failed_retry_delay=-1)
+    assert [item.url for item in queue.claim()] == ["https://example.com/new.pdf"]
+    assert queue.requeue_failed() == 0
+
+
+def test_retried_failed_paper_is_replaced(writer, db_name):
+    store_failed(writer, "https://example.com/a.pdf", "unable_to_fetch", None)
+    queue = WorkQueue(writer)
+    [item] = queue.claim()
+
+    queue.failed(item, ExtractError("not a pdf"))
+    writer.flush()
+    assert paper_status(db_name, item.url) == "processing_failed"
+    assert queue_row(db_name, item.url) is None
+    # saved again just now, not due for a while
+    assert WorkQueue(writer).claim() == []
+
+
+def test_chunks_queued_as_text_are_read_as_offsets(writer):
+    queue = WorkQueue(writer)
+    enqueue(queue, "https://example.com/a.pdf")
+    [item] = queue.claim()
+    queue.extracted(item, "one two three four", None, True)
+    # as checkpointed before chunks were offsets
+    with writer.transaction() as conn:
+        conn.execute(
+            "UPDATE work_queue SET chunks = ? WHERE url = ?",
+            ('[[0, "one two three", 3, ""], [1, "three four", 2, ""]]', item.url),
+        )
+
+    chunks = queue.read_chunks(item.url)
+    assert [(chunk.start, chunk.end, chunk.token_count) for chunk in chunks] == [
+        (0, 13, 3),
+        (8, 18, 2),
+    ]
@@ -1,59 +1,262 @@
-from io import BytesIO
+import hashlib, os, tempfile, threading
+from typing import Generator, Iterator, Optional, Union
 import requests, logging
-from fitz import open as fitzopen, Pixmap
+from fitz import open as fitzopen, Matrix, Pixmap, Rect
 from models import Paper
+from dedup import simhash
+from http_client import HttpClient, default_http_client
+from extract_pool import ExtractError, ExtractPool, ExtractTimeoutError
+from metrics import DOWNLOAD_BYTES, RETRIES, STAGE_SECONDS
 
 MAX_PDF_SIZE = 1 * 1024 * 1024 * 1024  #    ~1GB
 MAX_TEXT_SIZE = 1 * 1024 * 1024  #          ~1MB
+SPOOL_MAX_MEMORY = 16 * 1024 * 1024  #      ~16MB, bigger pdfs are spooled to a temp file
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  #        ~1MB
+THUMBNAIL_SCALE = 0.5  #                    of the page's size at 72 dpi
+THUMBNAIL_CLIP = 1.0  #                     fraction of the page, from the top
 
 
-def fetch_and_extract_text_from_pdf(url: str) -> Paper:
-    try:
-        head_response = requests.head(url)
-        content_length = int(head_response.headers.get("Content-Length", 0))
-        status = "success"
+class PdfTooLargeError(Exception):
+    pass
+
+
+class NotModifiedError(Exception):
+    pass
 
-        if content_length > MAX_PDF_SIZE:
-            logging.info(
-                f"PDF is too large (> {MAX_PDF_SIZE / 1024 / 1024}MB), skipping blob storage for {url}"
+
+# holds a downloaded pdf in memory while it is small and on disk once it is not,
+# so fitz and the db can read it without another copy of the bytes
+class PdfSpool:
+    def __init__(self, max_memory: int = SPOOL_MAX_MEMORY):
+        self.max_memory = max_memory
+        self.size = 0
+        self.path: Optional[str] = None
+        self._buffer: Optional[bytearray] = bytearray()
+        self._file = None
+        # hashed while downloading, it's the pdf's key in the blob store
+        self._digest = hashlib.sha256()
+        # validators for a conditional re-fetch, saved with the paper
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+
+    def write(self, chunk: bytes):
+        if self._file is None and self.size + len(chunk) > self.max_memory:
+            self._file = tempfile.NamedTemporaryFile(
+                prefix="paperweight_", suffix=".pdf", delete=False
             )
-            store_blob = False
-            status = "pdf_too_large"
+            self.path = self._file.name
+            self._file.write(self._buffer)
+            self._buffer = None
+
+        if self._file is not None:
+            self._file.write(chunk)
         else:
-            store_blob = True
-
-        response = requests.get(url)
-        response.raise_for_status()
-
-        text = ""
-        with fitzopen(stream=BytesIO(response.content), filetype="pdf") as doc:
-            for page in doc:
-                if page.number == 0:
-                    pic: Pixmap = page.get_pixmap()
-                if len(text) < MAX_TEXT_SIZE:
-                    new_text = page.get_text()
-                    if len(text) + len(new_text) > MAX_TEXT_SIZE:
-                        text += new_text[: MAX_TEXT_SIZE - len(text)]
-                        break
-                    else:
-                        text += new_text
-                else:
-                    break
-
-        maybe_blob = response.content if store_blob else None
-        return Paper(
-            url=url,
-            status=status,
-            text=text,
-            blob=maybe_blob,
-            pic=pic,
+            self._buffer += chunk
+        self._digest.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self) -> str:
+        return self._digest.hexdigest()
+
+    def finish(self):
+        if self._file is not None:
+            self._file.close()
+
+    def source(self) -> Union[str, bytearray]:
+        return self.path if self.path else self._buffer
+
+    def iter_chunks(self, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+        if not self.path:
+            yield self._buffer
+            return
+
+        with open(self.path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    def close(self):
+        self.finish()
+        self._buffer = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def fetch_and_extract_text_from_pdf(
+    url: str,
+    http: Optional[HttpClient] = None,
+    pool: Optional[ExtractPool] = None,
+    **extract_options,
+) -> Paper:
+    spool = None
+    try:
+        spool = download_pdf(url, http)
+        text, png, complete = (pool or default_extract_pool()).extract(
+            spool.source(), **extract_options
         )
+        return build_paper(url, spool, text, thumbnail=png, text_complete=complete)
+    except Exception as e:
+        if spool:
+            spool.close()
+        return failed_paper(url, e)
+
+
+def download_pdf(
+    url: str,
+    http: Optional[HttpClient] = None,
+    validators: Optional[tuple[Optional[str], Optional[str]]] = None,
+) -> PdfSpool:
+    http = http or default_http_client()
+    headers = {}
+    if validators:
+        etag, last_modified = validators
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    # timed from asking for the host's slot, a polite wait is part of the download
+    with STAGE_SECONDS.time(stage="download"):
+        # a single streamed GET, the size limit is enforced while reading
+        # since Content-Length can be missing or wrong
+        with http.get(url, headers=headers) as response:
+            if response.status_code == 304:
+                raise NotModifiedError(url)
+            # urllib3's retries of 429s and 5xx, the ones that got a response
+            retries = getattr(response.raw, "retries", None)
+            if retries is not None and retries.history:
+                RETRIES.inc(len(retries.history), kind="download")
+            response.raise_for_status()
+
+            content_length = int(response.headers.get("Content-Length") or 0)
+            if content_length > MAX_PDF_SIZE:
+                raise PdfTooLargeError(f"Content-Length is {content_length}")
+
+            spool = PdfSpool()
+            spool.etag = response.headers.get("ETag")
+            spool.last_modified = response.headers.get("Last-Modified")
+            try:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    spool.write(chunk)
+                    DOWNLOAD_BYTES.inc(len(chunk))
+                    if spool.size > MAX_PDF_SIZE:
+                        raise PdfTooLargeError(f"read more than {MAX_PDF_SIZE} bytes")
+                spool.finish()
+            except BaseException:
+                spool.close()
+                raise
+
+    return spool
 
-    except requests.exceptions.RequestException as e:
+
+def read_pdf(
+    source: Union[str, bytes, bytearray],
+    max_chars: int = MAX_TEXT_SIZE,
+    thumbnail_scale: float = THUMBNAIL_SCALE,
+    thumbnail_clip: float = THUMBNAIL_CLIP,
+) -> tuple[str, Optional[Pixmap], bool]:
+    # text of the first pages up to `max_chars`, a thumbnail of page 0, and whether the
+    # text is the whole document. pages past the limit are never parsed
+    if isinstance(source, str):
+        doc = fitzopen(source, filetype="pdf")
+    else:
+        doc = fitzopen(stream=source, filetype="pdf")
+
+    with doc:
+        pic = render_thumbnail(doc[0], thumbnail_scale, thumbnail_clip) if len(doc) else None
+        pages, texts = iter_page_texts(doc, max_chars), []
+        try:
+            while True:
+                texts.append(next(pages))
+        except StopIteration as stop:
+            truncated = stop.value
+        text = "".join(texts)
+
+    # MAX_TEXT_SIZE is as far as text ever goes, a lower limit leaves the rest for later
+    complete = not truncated or max_chars >= MAX_TEXT_SIZE
+    return text, pic, complete
+
+
+def iter_page_texts(doc, max_chars: int) -> Generator[str, None, bool]:
+    # page by page until `max_chars`, the page that crosses it is cut short. returns
+    # whether text was left out, pages left unread or the last one cut
+    remaining = max_chars
+    for page in doc:
+        if remaining <= 0:
+            return True
+        page_text = page.get_text()
+        yield page_text[:remaining]
+        remaining -= len(page_text)
+    return remaining < 0
+
+
+def render_thumbnail(page, scale: float, clip: float) -> Pixmap:
+    # `clip` keeps the top fraction of the page, titles and abstracts live there
+    rect = page.rect
+    if clip < 1:
+        rect = Rect(rect.x0, rect.y0, rect.x1, rect.y0 + rect.height * clip)
+    return page.get_pixmap(matrix=Matrix(scale, scale), clip=rect)
+
+
+def extract_pdf_contents(
+    source: Union[str, bytes, bytearray], **options
+) -> tuple[str, Optional[bytes], bool]:
+    # extract worker entrypoint, a Pixmap can't be pickled so it is sent back as png bytes
+    text, pic, complete = read_pdf(source, **options)
+    png = pic.tobytes("png") if pic is not None else None
+    del pic
+    return text, png, complete
+
+
+def build_paper(
+    url: str,
+    spool: PdfSpool,
+    text: str,
+    thumbnail: Optional[bytes] = None,
+    text_complete: bool = True,
+) -> Paper:
+    return Paper(
+        url=url,
+        status="success",
+        text=text,
+        spool=spool,
+        thumbnail=thumbnail,
+        text_complete=text_complete,
+        simhash=simhash(text),
+    )
+
+
+def failed_paper(url: str, e: Exception) -> Paper:
+    # also called outside the except block, by the work queue, so the traceback comes from e
+    if isinstance(e, PdfTooLargeError):
+        logging.info(f"PDF is too large (> {MAX_PDF_SIZE / 1024 / 1024}MB), skipping {url}: {e}")
+        return Paper(url=url, status="pdf_too_large")
+
+    if isinstance(e, requests.exceptions.RequestException):
         logging.info(f"request failed - {url}: {e}")
-        logging.exception(e)
-        return Paper(url=url, status="unable_to_fetch", text=None, blob=None)
-    except Exception as e:
-        logging.info(f"Error processing PDF {url}: {e}")
-        logging.exception(e)
-        return Paper(url=url, status="processing_failed", text=None, blob=None)
+        logging.error(e, exc_info=e)
+        return Paper(url=url, status="unable_to_fetch")
+
+    if isinstance(e, ExtractTimeoutError):
+        logging.info(f"PDF took too long to parse, skipping {url}: {e}")
+        return Paper(url=url, status="processing_failed")
+
+    if isinstance(e, ExtractError):
+        logging.info(f"Error parsing PDF {url}: {e}")
+        return Paper(url=url, status="processing_failed")
+
+    logging.info(f"Error processing PDF {url}: {e}")
+    logging.error(e, exc_info=e)
+    return Paper(url=url, status="processing_failed")
+
+
+_default_pool: Optional[ExtractPool] = None
+_default_pool_lock = threading.Lock()
+
+
+def default_extract_pool() -> ExtractPool:
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ExtractPool()
+        return _default_pool
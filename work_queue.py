@@ -0,0 +1,482 @@
+import base64, json, logging, os, socket, sqlite3, time, uuid
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, Optional
+import requests
+from tenacity import RetryError
+from chunker import chunk_offsets
+from models import MyFile, Paper, PaperChunk, ProcessedPaper
+from db import connect
+from blob_store import delete_unreferenced, iter_blob, put_blob, put_bytes
+from dedup import add_alias, find_duplicate, pop_aliases, url_key
+from extract_pool import ExtractError, ExtractTimeoutError, WorkerDiedError
+from metrics import PAPERS
+from text_extractor import PdfSpool, PdfTooLargeError, failed_paper
+
+# every link goes through these in order. each one is checkpointed, so a restart picks
+# a link up after the last stage it finished
+STAGES = ["queued", "fetched", "extracted", "embedded", "enriched"]
+
+LEASE_SECONDS = 30 * 60  #          a claimed link is free to claim again after this
+RETRY_DELAY = 60  #                 seconds before the first retry, doubled on every attempt
+MAX_RETRY_DELAY = 24 * 60 * 60
+MAX_ATTEMPTS = 16  #                ~5 days of retries, the last few a day apart
+FAILED_RETRY_DELAY = 7 * 24 * 60 * 60  # a failed paper is queued again after this
+CLAIM_BATCH = 50
+
+# failed papers worth another go, not the ones that were too large. `written_at` is NULL on
+# papers from before the queue, they're due right away
+FAILED_PAPERS = """
+    status NOT LIKE 'success%' AND status != 'pdf_too_large' AND COALESCE(written_at, 0) <= ?
+    AND NOT EXISTS (SELECT 1 FROM work_queue q WHERE q.url = papers.url)
+"""
+
+# the same for every queue in this process, it tells this process apart from an earlier
+# one that had its pid
+_PROCESS = uuid.uuid4().hex[:8]
+
+
+@dataclass(slots=True)
+class WorkItem:
+    url: str
+    my_file: MyFile
+    stage: str = "queued"
+    attempts: int = 0
+    pdf_sha256: Optional[str] = None
+    thumbnail_sha256: Optional[str] = None
+    # the text and chunks stay in the queue row, papers read them back when they need them
+    text_length: int = 0
+    text_complete: bool = True
+    simhash: Optional[int] = None
+    embedding: Optional[bytes] = None
+    data: Optional[bytes] = None
+    # not stored, the download and the paper this run is building
+    spool: Optional[PdfSpool] = None
+    paper: Optional[Paper] = None
+
+    def reached(self, stage: str) -> bool:
+        return STAGES.index(self.stage) >= STAGES.index(stage)
+
+    def restore(self, queue: "WorkQueue") -> Paper:
+        # the paper as of the last finished stage, pdf and thumbnail stay in the blob store
+        paper = Paper(
+            self.url,
+            "success",
+            text_complete=self.text_complete,
+            pdf_sha256=self.pdf_sha256,
+            thumbnail_sha256=self.thumbnail_sha256,
+            store=queue,
+            text_length=self.text_length,
+            simhash=self.simhash,
+        )
+        if not self.reached("embedded"):
+            return paper
+
+        processed_paper = ProcessedPaper(paper)
+        processed_paper.embedding = self.embedding or b""
+        if self.data is not None:
+            processed_paper.apply_data(self.data)
+            processed_paper.status = "success_and_processed"
+        return processed_paper
+
+    def release(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+
+# links waiting to become papers, in the work_queue table of the papers db. a claimed
+# link is leased so a second run leaves it alone, and the result of each stage is stored
+# on its row. a failed link is retried after an exponential backoff, from the stage it
+# failed at, and written as a failed paper once it runs out of attempts.
+# everything goes through the PaperWriter's connection, checkpoints are committed with
+# its batches and a link leaves the queue in the transaction that writes its paper
+class WorkQueue:
+    def __init__(
+        self,
+        writer,
+        lease_seconds: float = LEASE_SECONDS,
+        retry_delay: float = RETRY_DELAY,
+        max_attempts: int = MAX_ATTEMPTS,
+        dedup: bool = True,
+        failed_retry_delay: float = FAILED_RETRY_DELAY,
+    ):
+        self.writer = writer
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.dedup = dedup
+        self.failed_retry_delay = failed_retry_delay
+        # the host, pid and process tell if the owner is alive, the rest tells runs apart
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{_PROCESS}:{uuid.uuid4().hex[:8]}"
+        self.release_dead_leases()
+        self.requeue_failed()
+
+    def release_dead_leases(self) -> int:
+        # a run that crashed or was killed leaves its leases behind, free the ones held
+        # by processes on this host that are gone so a restart doesn't wait them out
+        host = socket.gethostname()
+        with self.writer.transaction() as conn:
+            owners = conn.execute(
+                "SELECT DISTINCT lease_owner FROM work_queue WHERE lease_until IS NOT NULL"
+            ).fetchall()
+            dead = [
+                (owner,)
+                for (owner,) in owners
+                if owner and owner.split(":")[0] == host and not self._alive(owner)
+            ]
+            conn.executemany("UPDATE work_queue SET lease_until = NULL WHERE lease_owner = ?", dead)
+        if dead:
+            logging.info(f"released the leases of {len(dead)} dead run(s)")
+        return len(dead)
+
+    def requeue_failed(self) -> int:
+        # a failed paper isn't final, it's queued again once failed_retry_delay has passed
+        # since it was written. it stays until the retry replaces it
+        with self.writer.transaction() as conn:
+            rows = conn.execute(
+                f"SELECT url, file_path, created_at, updated_at FROM papers WHERE {FAILED_PAPERS}",
+                (time.time() - self.failed_retry_delay,),
+            ).fetchall()
+            queued = _enqueue(conn, [(url, MyFile(*file_info)) for url, *file_info in rows])
+        if queued:
+            logging.info(f"queued {queued} failed paper(s) for another try")
+        return queued
+
+    def enqueue(self, jobs: Iterable[tuple[str, MyFile]]) -> int:
+        # links already queued keep their progress
+        with self.writer.transaction() as conn:
+            return _enqueue(conn, jobs)
+
+    def claim(self, limit: int = CLAIM_BATCH) -> list[WorkItem]:
+        # due links nobody holds a lease on, in the order they were queued
+        now = time.time()
+        with self.writer.transaction() as conn:
+            rows = conn.execute(
+                """
+                SELECT url, file_path, created_at, updated_at, stage, attempts, pdf_sha256,
+                    thumbnail_sha256, length(text), text_complete, simhash, embedding, data
+                FROM work_queue
+                WHERE next_attempt_at <= ? AND (lease_until IS NULL OR lease_until < ?)
+                ORDER BY next_attempt_at, rowid
+                LIMIT ?
+            """,
+                (now, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE work_queue SET lease_until = ?, lease_owner = ? WHERE url = ?",
+                [(now + self.lease_seconds, self.owner, row[0]) for row in rows],
+            )
+        # leases are committed right away, checkpoints go in with the writer's next batch
+        self.writer.flush()
+        return [_item(row) for row in rows]
+
+    def claim_all(self) -> Iterator[WorkItem]:
+        # a batch at a time as the caller gets to them, so leases don't run out in a backlog
+        while items := self.claim():
+            yield from items
+
+    # the checks for a paper that's already stored or queued under another url, each one
+    # is made in the transaction that checkpoints the stage, so of two links to the same
+    # paper one always sees the other. a duplicate leaves the queue as an alias of it and
+    # the stage returns False
+    def alias_duplicate(self, item: WorkItem) -> bool:
+        # by url, before anything is downloaded
+        with self.writer.transaction() as conn:
+            return self._alias_duplicate(conn, item, key=url_key(item.url))
+
+    def fetched(self, item: WorkItem, spool: PdfSpool) -> bool:
+        # the pdf goes into the blob store now, a retry doesn't download it again
+        with self.writer.transaction() as conn:
+            if self._alias_duplicate(conn, item, pdf_sha256=spool.sha256):
+                return False
+            put_blob(conn, spool.sha256, spool.size, spool.iter_chunks())
+            if spool.etag or spool.last_modified:
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO http_validators (url, etag, last_modified, checked_at)
+                    VALUES (?, ?, ?, ?)
+                """,
+                    (item.url, spool.etag, spool.last_modified, time.time()),
+                )
+            self._checkpoint(conn, item, "fetched", pdf_sha256=spool.sha256)
+        item.pdf_sha256 = spool.sha256
+        return True
+
+    def extracted(
+        self,
+        item: WorkItem,
+        text: str,
+        thumbnail: Optional[bytes],
+        complete: bool,
+        simhash: Optional[int] = None,
+    ) -> bool:
+        with self.writer.transaction() as conn:
+            if self._alias_duplicate(conn, item, fingerprint=simhash):
+                return False
+            thumbnail_sha256 = put_bytes(conn, thumbnail) if thumbnail else None
+            self._checkpoint(
+                conn,
+                item,
+                "extracted",
+                text=text,
+                text_complete=int(complete),
+                thumbnail_sha256=thumbnail_sha256,
+                simhash=simhash,
+            )
+        item.text_length, item.text_complete = len(text or ""), complete
+        item.thumbnail_sha256, item.simhash = thumbnail_sha256, simhash
+        return True
+
+    def embedded(self, item: WorkItem, embedding: bytes, chunks: list[PaperChunk]):
+        with self.writer.transaction() as conn:
+            self._checkpoint(
+                conn, item, "embedded", embedding=embedding, chunks=_dump_chunks(chunks)
+            )
+        item.embedding = embedding
+
+    def enriched(self, item: WorkItem, data: Optional[bytes]):
+        with self.writer.transaction() as conn:
+            self._checkpoint(conn, item, "enriched", data=data)
+        item.data = data
+
+    # a restored paper's store. on the writer's connection, like the other reads here,
+    # so checkpoints that aren't committed yet are seen
+    def read_text(self, url: str, limit: Optional[int] = None) -> Optional[str]:
+        if limit is None:
+            row = self.writer.read("SELECT text FROM work_queue WHERE url = ?", (url,))
+        else:
+            row = self.writer.read(
+                "SELECT substr(text, 1, ?) FROM work_queue WHERE url = ?", (limit, url)
+            )
+        return row[0] if row else None
+
+    def read_chunks(self, url: str) -> list[PaperChunk]:
+        row = self.writer.read("SELECT chunks FROM work_queue WHERE url = ?", (url,))
+        return _load_chunks(row[0] if row else None, lambda: self.read_text(url))
+
+    def pdf_spool(self, item: WorkItem) -> PdfSpool:
+        # the pdf an earlier attempt downloaded, read back from the blob store. on the
+        # writer's connection, its last checkpoints may not be committed yet
+        spool = PdfSpool()
+        try:
+            with self.writer.transaction() as conn:
+                for chunk in iter_blob(conn, item.pdf_sha256):
+                    spool.write(chunk)
+            spool.finish()
+        except BaseException:
+            spool.close()
+            raise
+        return spool
+
+    def write(self, item: WorkItem):
+        # the paper and the end of its queue row, in one transaction
+        def done(conn: sqlite3.Connection, error: Optional[Exception]):
+            if error is None:
+                conn.execute("DELETE FROM work_queue WHERE url = ?", (item.url,))
+                succeeded = item.paper.status.startswith("success")
+                PAPERS.inc(result="written" if succeeded else "failed")
+                if not succeeded:
+                    self._requeue_aliases(conn, item)
+                # a given up link's pdf isn't referenced by its failed paper
+                delete_unreferenced(conn, [item.pdf_sha256, item.thumbnail_sha256])
+            else:
+                self._retry_later(conn, item, error)
+
+        self.writer.insert(item.paper, item.my_file, replace=True, done=done)
+
+    def failed(self, item: WorkItem, error: Exception):
+        item.release()
+        if isinstance(error, RetryError):
+            # tenacity gave up, what matters is why
+            error = error.last_attempt.exception() or error
+        permanent = is_permanent(error)
+        if permanent or item.attempts + 1 >= self.max_attempts:
+            # saved like before the queue, so it shows up with its failed status
+            item.paper = ProcessedPaper(failed_paper(item.url, error))
+            self.write(item)
+            return
+
+        logging.info(f"Error processing {item.url}: {error}")
+        with self.writer.transaction() as conn:
+            self._retry_later(conn, item, error)
+
+    def counts(self) -> dict[str, int]:
+        # links by the stage they're waiting at, `given_up` ones failed to be written
+        self.writer.flush()
+        conn = connect(self.writer.db_name, read_only=True)
+        try:
+            rows = conn.execute(
+                """
+                SELECT CASE WHEN next_attempt_at IS NULL THEN 'given_up' ELSE stage END, COUNT(*)
+                FROM work_queue GROUP BY 1
+            """
+            ).fetchall()
+        finally:
+            conn.close()
+        return dict(rows)
+
+    def _alive(self, owner: str) -> bool:
+        _, pid, process = owner.split(":")[:3]
+        if int(pid) == os.getpid():
+            # this process, or an earlier one with our pid in a restarted container
+            return process == _PROCESS
+        if os.name == "nt":
+            # no signal 0 on windows, leases there run out on their own
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            # exists, but isn't ours to signal
+            pass
+        return True
+
+    def _alias_duplicate(self, conn: sqlite3.Connection, item: WorkItem, **fingerprints) -> bool:
+        duplicate = find_duplicate(conn, item.url, **fingerprints) if self.dedup else None
+        if duplicate is None:
+            return False
+        canonical_url, reason = duplicate
+        print(f"skipping {item.url.split('/')[-1]}, same {reason} as {canonical_url}")
+        add_alias(conn, item.url, canonical_url, reason, item.my_file)
+        conn.execute("DELETE FROM work_queue WHERE url = ?", (item.url,))
+        # a pdf an earlier stage stored is only this link's
+        delete_unreferenced(conn, [item.pdf_sha256, item.thumbnail_sha256])
+        item.release()
+        PAPERS.inc(result="duplicate")
+        return True
+
+    def _requeue_aliases(self, conn: sqlite3.Connection, item: WorkItem):
+        # the duplicates of a link that failed for good get their own go
+        if queued := _enqueue(conn, pop_aliases(conn, item.url)):
+            logging.info(f"queued {queued} duplicate(s) of {item.url} again, it failed")
+
+    def _checkpoint(self, conn: sqlite3.Connection, item: WorkItem, stage: str, **columns):
+        assignments = "".join(f", {name} = ?" for name in columns)
+        conn.execute(
+            f"UPDATE work_queue SET stage = ?, lease_until = ?{assignments} WHERE url = ?",
+            (stage, time.time() + self.lease_seconds, *columns.values(), item.url),
+        )
+        item.stage = stage
+
+    def _retry_later(self, conn: sqlite3.Connection, item: WorkItem, error: Exception):
+        # the stages it finished are kept, the next attempt starts where this one failed
+        item.attempts += 1
+        next_attempt_at = None
+        if item.attempts < self.max_attempts:
+            delay = min(MAX_RETRY_DELAY, self.retry_delay * 2 ** (item.attempts - 1))
+            next_attempt_at = time.time() + delay
+            logging.info(f"retrying {item.url} in {delay:.0f}s, attempt {item.attempts}")
+        PAPERS.inc(result="retry" if next_attempt_at else "given_up")
+        if next_attempt_at is None:
+            self._requeue_aliases(conn, item)
+        conn.execute(
+            """
+            UPDATE work_queue SET attempts = ?, next_attempt_at = ?, lease_until = NULL,
+                last_error = ?
+            WHERE url = ?
+        """,
+            (item.attempts, next_attempt_at, f"{type(error).__name__}: {error}", item.url),
+        )
+
+
+def has_due_work(db_name: str, failed_retry_delay: float = FAILED_RETRY_DELAY) -> bool:
+    # whether a run now would claim anything, without opening a writer
+    now = time.time()
+    conn = connect(db_name, read_only=True)
+    try:
+        row = conn.execute(
+            """
+            SELECT 1 FROM work_queue
+            WHERE next_attempt_at <= ? AND (lease_until IS NULL OR lease_until < ?)
+            LIMIT 1
+        """,
+            (now, now),
+        ).fetchone()
+        row = (
+            row
+            or conn.execute(
+                f"SELECT 1 FROM papers WHERE {FAILED_PAPERS} LIMIT 1", (now - failed_retry_delay,)
+            ).fetchone()
+        )
+    finally:
+        conn.close()
+    return row is not None
+
+
+def is_permanent(error: Exception) -> bool:
+    # errors a retry won't fix. a pdf that failed to parse is retried from the stored
+    # bytes, so only a timeout or a dead worker is worth another go
+    if isinstance(error, PdfTooLargeError):
+        return True
+    if isinstance(error, ExtractError):
+        return not isinstance(error, (ExtractTimeoutError, WorkerDiedError))
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return 400 <= status < 500 and status not in (408, 429)
+    return False
+
+
+def _enqueue(conn: sqlite3.Connection, jobs: Iterable[tuple[str, MyFile]]) -> int:
+    before = conn.total_changes
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO work_queue (
+            url, file_path, created_at, updated_at, stage, attempts, next_attempt_at, url_key
+        )
+        VALUES (?, ?, ?, ?, 'queued', 0, 0, ?)
+    """,
+        [(url, f.full_path, f.created_at, f.updated_at, url_key(url)) for url, f in jobs],
+    )
+    return conn.total_changes - before
+
+
+def _item(row: tuple) -> WorkItem:
+    url, file_path, created_at, updated_at, stage, attempts, *stored = row
+    pdf_sha256, thumbnail_sha256, text_length, text_complete, simhash, embedding, data = stored
+    return WorkItem(
+        url=url,
+        my_file=MyFile(file_path, created_at, updated_at),
+        stage=stage,
+        attempts=attempts,
+        pdf_sha256=pdf_sha256,
+        thumbnail_sha256=thumbnail_sha256,
+        text_length=text_length or 0,
+        text_complete=text_complete != 0,
+        simhash=simhash,
+        embedding=embedding,
+        data=data,
+    )
+
+
+def _dump_chunks(chunks: list[PaperChunk]) -> str:
+    return json.dumps(
+        [
+            [
+                chunk.index,
+                chunk.start,
+                chunk.end,
+                chunk.token_count,
+                base64.b64encode(chunk.embedding).decode(),
+            ]
+            for chunk in chunks
+        ]
+    )
+
+
+def _load_chunks(data: Optional[str], text: Callable[[], str]) -> list[PaperChunk]:
+    if not data:
+        return []
+    rows = json.loads(data)
+    if rows and len(rows[0]) == 4:
+        # queued before chunks were offsets, they held a copy of their text
+        offsets = chunk_offsets(text() or "", [row[1] for row in rows])
+        rows = [
+            [index, *offset, token_count, embedding]
+            for (index, _, token_count, embedding), offset in zip(rows, offsets)
+            if offset is not None
+        ]
+    return [
+        PaperChunk(index, start, end, token_count, base64.b64decode(embedding))
+        for index, start, end, token_count, embedding in rows
+    ]